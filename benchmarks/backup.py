@@ -0,0 +1,146 @@
+"""Throughput of whole back-ups on synthetic trees
+
+Runs :func:`bups.preparations.start_backup` in the scenarios
+
+``full``
+    the first back-up into an empty destination
+``noop``
+    a second back-up of the unchanged tree
+``changed``
+    a back-up after 1 % of the files were rewritten
+``deleted``
+    a back-up after half of the top-level directories were removed
+``small``
+    a back-up after a directory of many small files was added
+
+and reports files per second, megabytes copied per second and file
+system calls per file for each.  The tree is made by
+:mod:`benchmarks.tree` with the given parameters.
+
+Run from the repository root::
+
+    python -m benchmarks.backup --depth 3 --fan-out 8 --files 50
+
+Compare the ``small`` scenario with and without ``--batch-small-files``
+to see the effect of copying small files in batches in inode order,
+ideally with the destination on a spinning disk given by ``--dir``.
+
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from os.path import join
+from bups import preparations
+from .tree import TreeSpec, SIZE_DISTRIBUTIONS, generate_tree, change_files
+
+
+SCENARIOS = ['full', 'noop', 'changed', 'deleted', 'small']
+
+CHANGE_RATIO = 0.01
+
+SMALL_FILES = 10000
+SMALL_SIZE = 512
+
+
+def _prepare(scenario, source, files, opts):
+    """Change the source tree for ``scenario``, return the files left"""
+    if scenario == 'changed':
+        change_files(files, opts.change_ratio, opts.seed)
+    elif scenario == 'deleted':
+        top = sorted(name for name in os.listdir(source)
+                     if name.startswith('d'))
+        for name in top[:len(top) // 2]:
+            shutil.rmtree(join(source, name))
+        files = [path for path in files if os.path.exists(path)]
+    elif scenario == 'small':
+        directory = join(source, 'small')
+        os.mkdir(directory)
+        data = b'x' * opts.small_size
+        for i in range(opts.small_files):
+            path = join(directory, 's{:06d}'.format(i))
+            with open(path, 'wb') as f:
+                f.write(data)
+            files.append(path)
+    return files
+
+
+def run(opts, options):
+    """Run the scenarios in order, return a result for each"""
+    spec = TreeSpec(opts.depth, opts.fan_out, opts.files, opts.mean_size,
+                    distribution=opts.distribution, seed=opts.seed)
+    results = []
+    with tempfile.TemporaryDirectory(dir=opts.dir) as directory:
+        source = join(directory, 'source')
+        os.mkdir(source)
+        os.mkdir(join(directory, 'dest'))
+        files = generate_tree(source, spec)
+        preparations.create_default_config(source)
+        for scenario in opts.scenarios:
+            files = _prepare(scenario, source, files, opts)
+            start = time.perf_counter()
+            stats = preparations.start_backup(source, join(directory, 'dest'),
+                                              **options)
+            elapsed = time.perf_counter() - start
+            report = stats.report()
+            syscalls = sum(report['syscalls'].values())
+            results.append(dict(
+                scenario=scenario,
+                files=len(files),
+                seconds=elapsed,
+                files_per_second=len(files) / elapsed,
+                mb_per_second=(report['counts'].get('bytes_copied', 0) /
+                               elapsed / 1e6),
+                syscalls_per_file=syscalls / max(len(files), 1),
+                stats=report))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fan-out', type=int, default=4)
+    parser.add_argument('--files', type=int, default=20,
+                        help='Files in each directory')
+    parser.add_argument('--mean-size', type=int, default=4096)
+    parser.add_argument('--distribution', choices=SIZE_DISTRIBUTIONS,
+                        default='lognormal')
+    parser.add_argument('--change-ratio', type=float, default=CHANGE_RATIO)
+    parser.add_argument('--small-files', type=int, default=SMALL_FILES,
+                        help='Files added in the small scenario')
+    parser.add_argument('--small-size', type=int, default=SMALL_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=SCENARIOS)
+    parser.add_argument('--copy-workers', type=int)
+    parser.add_argument('--scan-workers', type=int)
+    parser.add_argument('--batch-small-files', action='store_true',
+                        default=None)
+    parser.add_argument('--fadvise', action='store_true', default=None)
+    parser.add_argument('--dir', help='Make the trees in this directory')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write the results with all statistics')
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(opts, dict(copy_workers=opts.copy_workers,
+                             scan_workers=opts.scan_workers,
+                             batch_small_files=opts.batch_small_files,
+                             fadvise=opts.fadvise))
+
+    print('{:>8} {:>8} {:>9} {:>10} {:>8} {:>13}'.format(
+        'scenario', 'files', 'seconds', 'files/s', 'MB/s', 'syscalls/file'))
+    for result in results:
+        print('{scenario:>8} {files:>8} {seconds:9.3f} '
+              '{files_per_second:10.0f} {mb_per_second:8.1f} '
+              '{syscalls_per_file:13.2f}'.format(**result))
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
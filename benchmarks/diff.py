@@ -0,0 +1,85 @@
+"""Scaling of pairing source and destination entries of one directory
+
+Compares :func:`bups.backup_loop.diff_children` with the list lookup
+that ``match_directories`` used to do, on a synthetic directory where
+a tenth of the entries are new and a tenth obsolete.  By default the
+entries only exist in memory; with ``--on-disk`` a real directory is
+created and listed, which takes a while for a million entries.
+
+Run from the repository root::
+
+    python -m benchmarks.diff --sizes 10000 100000 1000000
+
+"""
+import argparse
+import os
+import tempfile
+import time
+from os.path import join
+from bups.backup_loop import diff_children
+
+# The quadratic version is not run above this size
+QUADRATIC_LIMIT = 20000
+
+
+class _Entry(object):
+    __slots__ = ['name']
+
+    def __init__(self, name):
+        self.name = name
+
+
+def synthetic_entries(size):
+    """Source entries and destination stats sharing 90 % of the names"""
+    new = size // 10
+    source = [_Entry('f{:08d}'.format(i)) for i in range(size)]
+    dest = {'f{:08d}'.format(i): None for i in range(new, size + new)}
+    return source, dest
+
+
+def on_disk_entries(size, directory):
+    source, dest = synthetic_entries(size)
+    for entry in source:
+        open(join(directory, entry.name), 'w').close()
+    with os.scandir(directory) as entries:
+        return list(entries), dest
+
+
+def quadratic_diff(source_contents, dest_stats):
+    """The list based pairing that diff_children replaced"""
+    source_names = [entry.name for entry in source_contents]
+    return [name for name in dest_stats if name not in source_names]
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--on-disk', action='store_true')
+    opts = parser.parse_args()
+
+    print('{:>10} {:>14} {:>14}'.format('entries', 'diff_children',
+                                        'list lookup'))
+    for size in opts.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            if opts.on_disk:
+                source, dest = on_disk_entries(size, directory)
+            else:
+                source, dest = synthetic_entries(size)
+            fast = measure(diff_children, source, dest)
+            if size <= QUADRATIC_LIMIT:
+                slow = '{:13.3f}s'.format(measure(quadratic_diff,
+                                                  source, dest))
+            else:
+                slow = '{:>14}'.format('skipped')
+            print('{:>10} {:13.3f}s {}'.format(size, fast, slow))
+
+
+if __name__ == '__main__':
+    main()
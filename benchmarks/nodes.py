@@ -0,0 +1,89 @@
+"""Memory and time of making the nodes of a wide directory
+
+Compares :class:`bups.backup_loop.BackupNode`, which has slots and
+joins its relative path to the one of its parent on first use, with
+the plain object that it used to be, which joined the relative path
+when it was made.  Both join the absolute paths again on every access.
+Every node is made with ``join_item``.  The paths of an unchanged file
+are not read at all, those of a copied file about three times.  Memory is measured with
+:mod:`tracemalloc` while all nodes are alive.
+
+Run from the repository root::
+
+    python -m benchmarks.nodes --entries 100000
+
+"""
+import argparse
+import time
+import tracemalloc
+from os.path import join
+from bups.backup_loop import BackupNode
+
+
+class PlainNode(object):
+    """The node before it had slots and a parent"""
+    def __init__(self, source_root, dest_root, item, config):
+        self.source_root = source_root
+        self.dest_root = dest_root
+        self.item = item
+        self.config = config
+        self._source_stat = None
+        self._dest_stat = None
+
+    @property
+    def source_item(self):
+        return join(self.source_root, self.item)
+
+    @property
+    def dest_item(self):
+        return join(self.dest_root, self.item)
+
+    def join_item(self, item):
+        return PlainNode(self.source_root, self.dest_root,
+                         join(self.item, item), self.config)
+
+
+def make_nodes(node_class, names, path_reads):
+    parent = node_class('/source/root', '/destination/root',
+                        join('some', 'deep', 'directory'), {})
+    nodes = []
+    for name in names:
+        node = parent.join_item(name)
+        for _ in range(path_reads):
+            node.source_item
+            node.dest_item
+        nodes.append(node)
+    return nodes
+
+
+def measure(node_class, names, path_reads):
+    """Bytes per node while all are alive and microseconds per node"""
+    tracemalloc.start()
+    nodes = make_nodes(node_class, names, path_reads)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del nodes
+    start = time.perf_counter()
+    make_nodes(node_class, names, path_reads)
+    elapsed = time.perf_counter() - start
+    return size / len(names), elapsed / len(names) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=100000)
+    opts = parser.parse_args()
+
+    # The names exist anyway in the listing of the directory
+    names = ['file{:08d}'.format(i) for i in range(opts.entries)]
+    print('{:>10} {:>12} {:>12} {:>12}'.format('entries', 'node',
+                                               'bytes/node', 'us/node'))
+    for label, path_reads in [('unchanged', 0), ('copied', 3)]:
+        for node_class in [PlainNode, BackupNode]:
+            size, micros = measure(node_class, names, path_reads)
+            print('{:>10} {:>12} {:12.0f} {:12.2f}'.format(
+                label, node_class.__name__, size, micros))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Reproducible synthetic trees for the benchmarks
+
+A tree is described by its depth, the number of subdirectories and
+files in each directory and the distribution of the file sizes.  The
+same parameters and seed always give the same tree.
+
+"""
+import math
+import os
+import random
+from os.path import join
+
+
+SIZE_DISTRIBUTIONS = ['fixed', 'lognormal']
+
+
+class TreeSpec(object):
+    """Parameters of a synthetic tree"""
+    def __init__(self, depth=3, fan_out=4, files_per_dir=20,
+                 mean_size=4096, max_size=1024 * 1024,
+                 distribution='lognormal', seed=0):
+        if distribution not in SIZE_DISTRIBUTIONS:
+            raise ValueError('Unknown size distribution {!r}'
+                             ''.format(distribution))
+        self.depth = depth
+        self.fan_out = fan_out
+        self.files_per_dir = files_per_dir
+        self.mean_size = mean_size
+        self.max_size = max_size
+        self.distribution = distribution
+        self.seed = seed
+
+    def file_size(self, rng):
+        if self.distribution == 'fixed':
+            return self.mean_size
+        # Many small files and a few large ones, with the given mean
+        sigma = 1.0
+        size = (rng.lognormvariate(0, sigma) * self.mean_size /
+                math.exp(sigma ** 2 / 2))
+        return min(int(size), self.max_size)
+
+
+def generate_tree(root, spec):
+    """Make the tree of ``spec`` under ``root``, return the files made"""
+    rng = random.Random(spec.seed)
+    files = []
+    directories = [root]
+    for level in range(spec.depth + 1):
+        children = []
+        for directory in directories:
+            for i in range(spec.files_per_dir):
+                path = join(directory, 'f{:04d}'.format(i))
+                _write(path, rng, spec.file_size(rng))
+                files.append(path)
+            if level < spec.depth:
+                for i in range(spec.fan_out):
+                    child = join(directory, 'd{:03d}'.format(i))
+                    os.mkdir(child)
+                    children.append(child)
+        directories = children
+    return files
+
+
+def change_files(files, ratio, seed=0):
+    """Rewrite a ``ratio`` of ``files``, return the changed ones"""
+    rng = random.Random(seed)
+    changed = rng.sample(files, int(len(files) * ratio))
+    for path in changed:
+        _write(path, rng, os.stat(path).st_size)
+    return changed
+
+
+def _write(path, rng, size):
+    with open(path, 'wb') as f:
+        f.write(rng.getrandbits(8 * size).to_bytes(size, 'little')
+                if size else b'')
@@ -0,0 +1,218 @@
+"""Walking the tree with asyncio for high-latency file systems
+
+On network file systems every stat, listing, copy and removal waits
+for a round trip.  :class:`AsyncWalk` keeps many of them in flight:
+the blocking calls run in threads driven by tasks of an asyncio event
+loop.  Directories are listed in one thread pool and their entries
+handled in another, each entry as a task, and a semaphore shared by
+the pools lets at most ``concurrency`` threads work at a time.  At
+most a few times ``concurrency`` entries wait for a thread at a time,
+so a huge directory is handed over in batches as the earlier entries
+get done.
+
+The walk acts as the scanner of :mod:`bups.scanning` in its threads,
+so the decisions about each entry are the ones of
+:func:`bups.backup_loop.make_backup`.  An unexpected error in a task
+stops the walk and is raised from :meth:`AsyncWalk.run`, as in the
+scanners.
+The entries are handled in other threads than the one that listed
+their directory, so small files cannot be batched per directory, see
+:class:`bups.backup_loop.CopyBatch`, and ``batch_small_files`` is
+refused with ``concurrency``.
+
+:func:`injected_latency` slows the file system calls of the walk down
+to test and measure this without a network.
+
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from . import backup_loop
+from .backup_loop import make_backup, match_directories, remove_later
+from .scanning import set_current_scanner
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 16
+
+# Entries handed from a listing thread to the event loop at a time
+BATCH_SIZE = 64
+
+
+class AsyncWalk(object):
+    """Back up a tree with up to ``concurrency`` blocking calls at a time"""
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        if concurrency < 1:
+            raise ValueError('Concurrency must be at least one')
+        self.concurrency = concurrency
+        self.loop = None
+        self.tasks = set()
+        self.handoffs = set()
+        self.lock = threading.Lock()
+        # Held by the threads of both pools while they work
+        self.working = threading.BoundedSemaphore(concurrency)
+        # The first unexpected error of a task
+        self.error = None
+
+    async def run(self, root):
+        """Back up the tree of the node ``root``"""
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(4 * self.concurrency)
+        initializer = functools.partial(set_current_scanner, self)
+        self.handlers = ThreadPoolExecutor(self.concurrency,
+                                           thread_name_prefix='bups-async',
+                                           initializer=initializer)
+        self.listers = ThreadPoolExecutor(self.concurrency,
+                                          thread_name_prefix='bups-list',
+                                          initializer=initializer)
+        try:
+            await self.loop.run_in_executor(self.handlers, self._work,
+                                            make_backup, root)
+            while self.tasks and self.error is None:
+                await asyncio.wait(list(self.tasks),
+                                   return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            self._cancel()
+            self.handlers.shutdown()
+            self.listers.shutdown()
+        if self.error is not None:
+            raise self.error
+
+    def schedule(self, node):
+        """Match a directory later, called in the threads of the walk"""
+        self.loop.call_soon_threadsafe(self._spawn, self._match(node))
+
+    def _spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Unexpected error in the walk',
+                         exc_info=task.exception())
+            if self.error is None:
+                self.error = task.exception()
+
+    def _work(self, func, *args):
+        with self.working:
+            return func(*args)
+
+    async def _match(self, directory):
+        await self.loop.run_in_executor(self.listers, self._work,
+                                        self._match_batched, directory)
+
+    def _match_batched(self, directory):
+        """List a directory and hand its entries over in batches"""
+        batch = []
+
+        def add(func):
+            def callback(node):
+                batch.append((func, node))
+                if len(batch) >= BATCH_SIZE:
+                    self._hand_over(batch)
+            return callback
+
+        match_directories(directory, add(make_backup), add(remove_later))
+        self._hand_over(batch)
+
+    def _hand_over(self, batch):
+        """Start tasks for the batch, blocking until there is room"""
+        if not batch:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._start(list(batch)),
+                                                  self.loop)
+        del batch[:]
+        with self.lock:
+            self.handoffs.add(future)
+        # Let the handlers work while waiting for them
+        self.working.release()
+        try:
+            future.result()
+        finally:
+            self.working.acquire()
+            with self.lock:
+                self.handoffs.discard(future)
+
+    async def _start(self, batch):
+        for func, node in batch:
+            await self.slots.acquire()
+            self._spawn(self._handle(func, node))
+
+    async def _handle(self, func, node):
+        try:
+            await self.loop.run_in_executor(self.handlers, self._work,
+                                            func, node)
+        finally:
+            self.slots.release()
+
+    def _cancel(self):
+        for task in self.tasks:
+            task.cancel()
+        with self.lock:
+            for future in self.handoffs:
+                future.cancel()
+
+
+async def backup_async(root, concurrency=None):
+    """Back up the tree of the node ``root`` in an :class:`AsyncWalk`"""
+    await AsyncWalk(concurrency or DEFAULT_CONCURRENCY).run(root)
+
+
+# The file system calls of :mod:`bups.backup_loop`
+_SLOWED_CALLS = ['stat', 'scandir', 'mkdir', 'remove', 'link', 'copy_file']
+
+
+class InFlight(object):
+    """Count the calls in progress and the most of them at a time"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    @contextmanager
+    def call(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.current -= 1
+
+
+@contextmanager
+def injected_latency(seconds):
+    """Delay each file system call of the walk by ``seconds``
+
+    Simulates a file system behind a network.  The calls are replaced
+    in :mod:`bups.backup_loop` for the duration of the ``with`` block,
+    so this affects every walk in the process.  Yields an
+    :class:`InFlight` of the slowed calls.
+
+    """
+    originals = {name: getattr(backup_loop, name) for name in _SLOWED_CALLS}
+    in_flight = InFlight()
+
+    def slowed(func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            with in_flight.call():
+                time.sleep(seconds)
+                return func(*args, **kwargs)
+        return call
+
+    for name, func in originals.items():
+        setattr(backup_loop, name, slowed(func))
+    try:
+        yield in_flight
+    finally:
+        for name, func in originals.items():
+            setattr(backup_loop, name, func)
@@ -1,30 +1,113 @@
-import fnmatch
 import shutil
 import logging
-from os import stat, listdir, remove, mkdir
-from os.path import join, exists, isdir, isfile, basename, sep
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from os import stat, scandir, remove, mkdir, link, rename, fsencode
+from os.path import join, sep, dirname
+from stat import S_ISDIR, S_ISREG, S_IFDIR
+from .change_detection import get_strategy
+from .manifest import MANIFEST_FILES, ManifestStat
+from .dedup import STORE_DIRNAME
+from .snapshots import SNAPSHOTS_DIRNAME
+from .verify import HASH_CACHE_FILES
+from .journal import JOURNAL_FILENAME, PARTIAL_PREFIX
+from .changes import CHANGES_FILES
+from .summary import SUMMARY_FILES
+from .scanning import current_scanner, make_scanner
+from .matching import Matcher
+from .copying import (copy_file, delta_copy, UnsupportedBackend,
+                      DELTA_BLOCK_SIZE)
+from .context import RunContext
+from .streaming import (STREAM_THRESHOLD, SpilledNames, collect,
+                        sorted_names, merge)
 
 
 logger = logging.getLogger(__name__)
+# One record per file operation, with ``op`` and ``item`` attributes
+file_logger = logging.getLogger('bups.files')
 
-COPIED = []
-ERRORS = []
+# Bookkeeping files of bups in the destination root.  They are never
+# removed or listed as part of the back-up.
+INTERNAL_NAMES = frozenset(MANIFEST_FILES | HASH_CACHE_FILES |
+                           CHANGES_FILES | SUMMARY_FILES |
+                           {STORE_DIRNAME, SNAPSHOTS_DIRNAME,
+                            JOURNAL_FILENAME})
+
+# Copies that do not write file contents, see :func:`BackupNode._copy`
+_NO_DATA_BACKENDS = frozenset(['hardlink', 'link', 'delta'])
+
+# Marks a stat result that has not been fetched yet
+_UNKNOWN = object()
+
+# Files of at most this size are batched, see :class:`CopyBatch`
+SMALL_FILE_SIZE = 64 * 1024
+# A batch is copied when it has this many files
+BATCH_FILES = 256
+
+# The batch of the directory being matched in this thread
+_local = threading.local()
+
+# The include and ignore lists last compiled and their matcher
+_compiled = (None, None, None)
 
 
 class BackupNode(object):
     """Data structure controlling copying files and folders to destination"""
-    def __init__(self, source_root, dest_root, item, config):
+    __slots__ = ['source_root', 'dest_root', 'config', 'run', 'parent',
+                 'name', '_item', '_source_stat', '_dest_stat']
+
+    def __init__(self, source_root, dest_root, item, config,
+                 source_stat=_UNKNOWN, dest_stat=_UNKNOWN, parent=None,
+                 name=None, run=None):
         """Store parameters for copying one file or directory
 
         ``item`` is a relative path that is present ``source_root``
         and is copied to ``dest_root`` if it is not there or if it is
         modified.
 
+        ``source_stat`` and ``dest_stat`` are the stat results of the
+        item on both sides, or ``None`` if the item does not exist
+        there.  When they are not given they are fetched on first use
+        and cached, so that the whole decision path in
+        :func:`make_backup` costs at most one stat per side.  If the
+        run has a ``manifest``, the destination is looked up from it
+        instead of the file system.
+
+        ``config`` holds the options of the run and ``run`` the
+        :class:`bups.context.RunContext` of the objects made from
+        them.  A root node without ``run`` gets a context of its own
+        and the nodes made by :meth:`join_item` share it.
+
+        Nodes made by :meth:`join_item` know their ``parent`` and their
+        ``name`` relative to it, and join their ``item`` to the one of
+        the parent only when it is first used.  The absolute paths are
+        joined on every use and not kept, as most nodes are of files
+        that are unchanged and never need them.
+
         """
         self.source_root = source_root
         self.dest_root = dest_root
-        self.item = item
         self.config = config
+        self.run = RunContext() if run is None else run
+        self.parent = parent
+        self.name = item if name is None else name
+        self._item = item if parent is None else None
+        self._source_stat = source_stat
+        self._dest_stat = dest_stat
+
+    @property
+    def item(self):
+        if self._item is None:
+            # Not recursive, the parents may not know theirs either
+            names = []
+            node = self
+            while node._item is None:
+                names.append(node.name)
+                node = node.parent
+            self._item = join(node._item, *reversed(names))
+        return self._item
 
     @property
     def source_item(self):
@@ -34,68 +117,407 @@ class BackupNode(object):
     def dest_item(self):
         return join(self.dest_root, self.item)
 
-    def join_item(self, item):
-        new_item = join(self.item, item)
-        return BackupNode(self.source_root, self.dest_root, new_item,
-                         self.config)
+    @contextmanager
+    def _location(self, dest):
+        """The item in source or ``dest`` as ``(path, dir_fd)``
+
+        With ``dir_fds`` in the run the path is the name of the item
+        relative to the open directory ``dir_fd`` of its parent, see
+        :mod:`bups.fsio`.  Otherwise the path is absolute and
+        ``dir_fd`` is ``None``.
+
+        """
+        fds = self.run.dir_fds
+        if fds is None or self.parent is None:
+            yield (self.dest_item if dest else self.source_item), None
+            return
+        parent = self.parent.dest_item if dest else self.parent.source_item
+        with fds.lease(parent) as fd:
+            if fd is None:
+                yield (self.dest_item if dest else self.source_item), None
+            else:
+                yield self.name, fd
+
+    @property
+    def source_stat(self):
+        if self._source_stat is _UNKNOWN:
+            with self._location(False) as (path, dir_fd):
+                self._source_stat = _stat(path, self.stats, dir_fd)
+        return self._source_stat
+
+    @property
+    def dest_stat(self):
+        if self._dest_stat is _UNKNOWN:
+            manifest = self.run.manifest
+            if manifest is None:
+                with self._location(True) as (path, dir_fd):
+                    self._dest_stat = _stat(path, self.stats, dir_fd)
+            else:
+                self._dest_stat = manifest.lookup(self.item)
+        return self._dest_stat
+
+    @property
+    def stats(self):
+        return self.run.stats
+
+    def join_item(self, item, source_stat=_UNKNOWN, dest_stat=_UNKNOWN):
+        return BackupNode(self.source_root, self.dest_root, None,
+                          self.config, source_stat, dest_stat, self, item,
+                          self.run)
 
     def modified_contents(self):
-        """Is the item in source newer than in destination"""
-        source_mod_t = stat(self.source_item).st_mtime
-        if not exists(self.dest_item):
-            return True
-        elif source_mod_t > stat(self.dest_item).st_mtime:
-            return True
-        else:
-            return False
+        """Has the item in source changed since it was backed up
+
+        The comparison is done by the strategy named in the
+        ``change_detection`` option, see :mod:`bups.change_detection`.
+
+        """
+        with self.stats.timer('compare'):
+            if self.dest_stat is None:
+                return True
+            strategy = get_strategy(get_option(self.config,
+                                               'change_detection'))
+            return strategy(self.source_stat, self.dest_stat)
 
     def copy(self):
-        logger.info('Copy {}'.format(self))
+        """Copy the file now or submit it to the ``copy_pool`` of the run
+
+        Small files may be left to the :class:`CopyBatch` of their
+        directory instead.
+
+        """
+        plan = self.run.plan
+        if plan is not None:
+            plan.copy(self.item, self.source_stat.st_size)
+            return
+        journal = self.run.journal
+        if journal is not None:
+            journal.hold(dirname(self.item))
+        batch = getattr(_local, 'batch', None)
+        if batch is not None and batch.add(self):
+            return
+        pool = self.run.copy_pool
+        if pool is None:
+            self._copy()
+        else:
+            pool.submit(self._copy)
+
+    def _copy(self):
+        file_logger.info('Copy %s', self, extra={'op': 'copy',
+                                                 'item': self.item})
+        stats = self.stats
+        start = time.perf_counter()
+        failed = True
         try:
-            shutil.copy(self.source_item, self.dest_item)
-            COPIED.append(self.item)
+            backend = self._delta_copy() or self._full_copy()
+            logger.debug('Copied %s with %s', self, backend)
+            stats.syscall('link' if backend in _NO_DATA_BACKENDS else 'copy')
+            size = (0 if backend in _NO_DATA_BACKENDS
+                    else self.source_stat.st_size)
+            stats.copied(self.item, size, backend,
+                         time.perf_counter() - start)
+            manifest = self.run.manifest
+            if manifest is not None:
+                stats.syscall('stat')
+                manifest.record(self.item, stat(self.dest_item))
+            failed = False
         except Exception:
             logger.error('Unable to copy', exc_info=True)
-            ERRORS.append(self.item)
+            stats.error(self.item)
+        finally:
+            journal = self.run.journal
+            if journal is not None:
+                journal.release(dirname(self.item), failed)
+
+    def _full_copy(self):
+        """Copy the file, through the ``content_store`` if there is one"""
+        if self._link_previous():
+            return 'hardlink'
+
+        backend = get_option(self.config, 'copy_backend', 'auto')
+        store = self.run.content_store
+        journal = self.run.journal
+        if store is None:
+            advise = get_option(self.config, 'fadvise', False)
+            with self._location(False) as (source, source_fd), \
+                    self._location(True) as (dest, dest_fd):
+                if journal is None:
+                    return copy_file(source, dest, backend, source_fd,
+                                     dest_fd, advise)
+                # Into a partial file first, see :mod:`bups.journal`
+                return journal.copy(
+                    self.item,
+                    lambda partial: copy_file(source, partial, backend,
+                                              source_fd, dest_fd, advise),
+                    dest, dest_fd)
+
+        def copy(source, dest):
+            if journal is None:
+                return copy_file(source, dest, backend)
+            return journal.copy(
+                self.item,
+                lambda partial: copy_file(source, partial, backend), dest)
+
+        return store.link_or_copy(self.source_item, self.dest_item, copy)
+
+    def _link_previous(self):
+        """Hard link an unchanged file from the snapshot in ``link_dest``
+
+        Returns ``True`` if the file was linked, see :mod:`bups.snapshots`.
+
+        """
+        link_dest = self.run.link_dest
+        if link_dest is None:
+            return False
+        previous = join(link_dest, self.item)
+        previous_stat = _stat(previous, self.stats)
+        if previous_stat is None or not S_ISREG(previous_stat.st_mode):
+            return False
+        strategy = get_strategy(get_option(self.config, 'change_detection'))
+        if strategy(self.source_stat, previous_stat):
+            return False
+        try:
+            link(previous, self.dest_item)
+        except OSError:
+            # E.g., too many links, the file is copied instead
+            return False
+        return True
+
+    def _delta_copy(self):
+        """Update a large file in place if the config asks for it
+
+        Files of at least ``delta_threshold`` bytes that already exist
+        in destination are compared in blocks of ``delta_block_size``
+        bytes.  Returns ``'delta'`` if the file was updated so.
+
+        """
+        threshold = get_option(self.config, 'delta_threshold')
+        if (threshold is None or self.source_stat.st_size < threshold or
+                self.dest_stat is None or not S_ISREG(self.dest_stat.st_mode)):
+            return None
+        block_size = get_option(self.config, 'delta_block_size',
+                                DELTA_BLOCK_SIZE)
+        journal = self.run.journal
+        if journal is not None:
+            journal.in_place(self.item)
+        try:
+            bytes_read, bytes_written = delta_copy(
+                self.source_item, self.dest_item, block_size)
+        except (UnsupportedBackend, FileNotFoundError):
+            return None
+        logger.debug('Updated %s, read %d and wrote %d bytes',
+                     self, bytes_read, bytes_written)
+        self.stats.delta(bytes_read, bytes_written)
+        return 'delta'
 
     def create_folder(self):
-        logger.info('Make directory {}'.format(self))
+        """Make the directory in destination, return ``True`` on success"""
+        plan = self.run.plan
+        if plan is not None:
+            plan.mkdir(self.item)
+            return True
+        file_logger.info('Make directory %s', self,
+                         extra={'op': 'mkdir', 'item': self.item})
         try:
-            mkdir(self.dest_item)
+            self.stats.syscall('mkdir')
+            with self._location(True) as (path, dir_fd):
+                _at(mkdir, path, dir_fd)
+            self.stats.count('directories_made')
+            manifest = self.run.manifest
+            if manifest is not None:
+                manifest.record(self.item,
+                                ManifestStat(S_IFDIR, 0, time.time(), None))
+            return True
         except Exception:
             logger.error('Cannot make directory', exc_info=True)
-            ERRORS.append(self.item)
+            self.stats.error(self.item)
+            return False
 
     def remove(self):
         """Remove a file or folder from back-up"""
-        item = self.dest_item
-        logger.info('Removing from back-up: {}'.format(self))
+        plan = self.run.plan
+        if plan is not None:
+            plan.remove(self.item, _file_size(self.dest_stat))
+            self._dest_stat = None
+            return
+        file_logger.info('Removing from back-up: %s', self,
+                         extra={'op': 'remove', 'item': self.item})
+        stats = self.stats
         try:
-            if isdir(item):
-                shutil.rmtree(item)
-            else:
-                remove(item)
+            with stats.timer('remove'):
+                if (self.dest_stat is not None and
+                        S_ISDIR(self.dest_stat.st_mode)):
+                    stats.syscall('rmtree')
+                    shutil.rmtree(self.dest_item)
+                    fds = self.run.dir_fds
+                    if fds is not None:
+                        fds.forget(self.dest_item)
+                else:
+                    stats.syscall('unlink')
+                    with self._location(True) as (path, dir_fd):
+                        _at(remove, path, dir_fd)
+            stats.count('removed')
+            self._dest_stat = None
+            manifest = self.run.manifest
+            if manifest is not None:
+                manifest.discard(self.item)
         except Exception:
             logger.error('Cannot remove  {}'.format(self), exc_info=True)
-            ERRORS.append(self.dest_item)
+            stats.error(self.item)
+
+    def move_from(self, other):
+        """Rename the obsolete item of ``other`` in destination to this"""
+        file_logger.info('Move %s to %s', other, self,
+                         extra={'op': 'move', 'item': self.item})
+        stats = self.stats
+        try:
+            stats.syscall('rename')
+            rename(other.dest_item, self.dest_item)
+        except OSError:
+            logger.error('Cannot move {}'.format(other), exc_info=True)
+            return False
+        if S_ISDIR(other.dest_stat.st_mode):
+            fds = self.run.dir_fds
+            if fds is not None:
+                fds.forget(other.dest_item)
+        self._dest_stat = other.dest_stat
+        stats.count('moved')
+        return True
 
     def get_children(self):
+        """List the included entries of the directory on both sides
+
+        Returns a list of :class:`os.DirEntry` objects in source and a
+        dictionary mapping names in destination to their stat results.
+        The destination is not listed if it did not exist before the
+        run, and it is read from the manifest if there is one.
+
+        A side with more than ``stream_threshold`` entries is returned
+        as :class:`bups.streaming.SpilledNames` instead.
+
+        """
+        stats = self.stats
+        start = time.perf_counter()
         try:
-            dest_contents = listdir(self.dest_item)
-            source_contents = listdir(self.source_item)
+            source_contents = self._list(self.source_item)
+            manifest = self.run.manifest
+            if self.dest_stat is None:
+                dest_stats = {}
+            elif manifest is not None:
+                dest_stats = self._list_manifest(manifest)
+            else:
+                dest_stats = self._list(self.dest_item)
+                if not isinstance(dest_stats, SpilledNames):
+                    dest_stats = {entry.name: _entry_stat(entry, stats)
+                                  for entry in dest_stats}
         except Exception:
             logger.error('Problem in listing contents of {}'
                          ''.format(self), exc_info=True)
-            return [], []
+            stats.error(self.item)
+            journal = self.run.journal
+            if journal is not None:
+                journal.fail(self.item)
+            return [], {}
+
+        stats.scanned(time.perf_counter() - start,
+                      len(source_contents) + len(dest_stats))
+        summary = self.run.summary
+        if (summary is not None and
+                not isinstance(source_contents, SpilledNames)):
+            summary.record(self.item, self.source_stat, source_contents)
+        return source_contents, dest_stats
+
+    def _list(self, directory):
+        """Included entries of ``directory``, or their names if too many"""
+        fds = self.run.dir_fds
+        if fds is None:
+            return self._list_entries(directory)
+        with fds.lease(directory) as fd:
+            return self._list_entries(directory if fd is None else fd)
+
+    def _list_entries(self, directory):
+        threshold = get_option(self.config, 'stream_threshold',
+                               STREAM_THRESHOLD)
+        self.stats.syscall('scandir')
+        with scandir(directory) as entries:
+            included = (entry for entry in entries
+                        if include_entry(self.item, entry.name, self.config))
+            first = list(itertools.islice(included, threshold + 1))
+            if len(first) <= threshold:
+                return first
+            self.stats.count('directories_streamed')
+            names = (fsencode(entry.name)
+                     for entry in itertools.chain(first, included))
+            return collect(names, threshold,
+                           get_option(self.config, 'spill_dir'))
+
+    def _list_manifest(self, manifest):
+        """Included entries of the destination as recorded in ``manifest``
+
+        A dictionary of their stats, or their names if too many.
 
-        source_contents = [i for i in source_contents if check_include(i, self.config)]
-        dest_contents = [i for i in dest_contents if check_include(i, self.config)]
-        return source_contents, dest_contents
+        """
+        threshold = get_option(self.config, 'stream_threshold',
+                               STREAM_THRESHOLD)
+        included = ((name, dest_stat) for name, dest_stat
+                    in manifest.iter_children(self.item)
+                    if include_entry(self.item, name, self.config))
+        first = list(itertools.islice(included, threshold + 1))
+        if len(first) <= threshold:
+            return dict(first)
+        self.stats.count('directories_streamed')
+        names = (fsencode(name)
+                 for name, _ in itertools.chain(first, included))
+        return collect(names, threshold, get_option(self.config, 'spill_dir'))
 
     def __str__(self):
         return shorten_path(self.item)
 
 
+class CopyBatch(object):
+    """Small files of a directory, copied together in inode order
+
+    With the ``batch_small_files`` option the files of at most
+    ``small_file_size`` bytes are collected while their directory is
+    matched and copied after it, sorted by their inode numbers in
+    source.  File systems tend to place inodes near the data of their
+    files, so on a spinning disk the reads move forward instead of
+    seeking back and forth.  With a ``copy_pool`` a batch is one task
+    for the workers.
+
+    """
+    def __init__(self, max_size=SMALL_FILE_SIZE):
+        self.max_size = max_size
+        self.nodes = []
+
+    def add(self, node):
+        """Take a file into the batch, ``False`` if it is too large"""
+        if node.source_stat.st_size > self.max_size:
+            return False
+        self.nodes.append(node)
+        if len(self.nodes) >= BATCH_FILES:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Copy the files of the batch now or in the ``copy_pool``"""
+        nodes = sorted(self.nodes, key=lambda node: node.source_stat.st_ino)
+        self.nodes = []
+        if not nodes:
+            return
+        nodes[0].stats.count('copy_batches')
+        pool = nodes[0].run.copy_pool
+        if pool is None:
+            _copy_all(nodes)
+        else:
+            pool.submit(_copy_all, nodes)
+
+
+def _copy_all(nodes):
+    for node in nodes:
+        node._copy()
+
+
 def shorten_path(path, soft_limit=40, hard_limit=60):
     if len(path) <= soft_limit:
         return path
@@ -104,9 +526,9 @@ def shorten_path(path, soft_limit=40, hard_limit=60):
         first = parts[0]
         target_len = len(first) + 5
         n = 0
-        while target_len < soft_limit:
+        while target_len < soft_limit and -n < len(parts) - 1:
             n -= 1
-            target_len += len(parts[n])
+            target_len += len(parts[n]) + 1
         if target_len > hard_limit:
             item_len = hard_limit - soft_limit
             if len(parts[n]) > item_len:
@@ -116,77 +538,378 @@ def shorten_path(path, soft_limit=40, hard_limit=60):
         return join(first, '...', *parts[n:])
 
 
+def get_option(config, key, default=None):
+    """Read an option from ``config``, which may also be ``None``"""
+    if config is None:
+        return default
+    return config.get(key, default)
+
+
+def remove_later(node):
+    """Remove an obsolete item from back-up after the copies of the run"""
+    plan = node.run.plan
+    pool = node.run.copy_pool
+    moves = node.run.moves
+    if plan is not None:
+        plan.remove(node.item, _file_size(node.dest_stat), later=True)
+    elif moves is not None and moves.add(node):
+        # Removed at the end of the run unless something is moved from it
+        pass
+    elif pool is None:
+        node.remove()
+    else:
+        pool.defer(node.remove)
+
+
+def _file_size(stat_result):
+    if stat_result is None or S_ISDIR(stat_result.st_mode):
+        return 0
+    return stat_result.st_size
+
+
+def _at(func, path, dir_fd):
+    """Call an :mod:`os` function on ``path``, relative to ``dir_fd``"""
+    if dir_fd is None:
+        return func(path)
+    return func(path, dir_fd=dir_fd)
+
+
+def _stat(path, stats, dir_fd=None):
+    """Stat a path following links, ``None`` if it cannot be accessed"""
+    stats.syscall('stat')
+    try:
+        return _at(stat, path, dir_fd)
+    except OSError:
+        return None
+
+
+def _entry_stat(entry, stats):
+    """Cached stat of a directory entry, ``None`` if it cannot be accessed"""
+    stats.syscall('stat')
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+
+def include_entry(directory, name, config):
+    """Is an entry of ``directory`` part of the back-up"""
+    if directory == '' and name in INTERNAL_NAMES:
+        return False
+    if name.startswith(PARTIAL_PREFIX):
+        return False
+    return check_include(join(directory, name), config)
+
+
 def make_backup(node):
     """Copy an item from source directory to destination
 
     Together with :func:`match_directories` this function makes a
-    recursive loop that walks through the file system hierarchy above
+    loop that walks through the file system hierarchy above
     ``node.source_root`` and mirrors the same hierarchy above
     ``node.dest_root``.  This function copies files and encountering
-    a directory it is passed to ``match_directories``.
+    a directory it is scheduled to be passed to ``match_directories``.
     ``match_directories`` lists directory contents and passes them one
     by one to this functions.
 
+    Called outside of a walk, this function starts one and returns
+    when the whole tree has been walked.  The directories are matched
+    by a scanner from :mod:`bups.scanning`, in ``scan_workers``
+    threads if that option is greater than one.
+
     """
-    _handle_directory(node) or _handle_file(node) or _handle_other(node)
+    if current_scanner() is None:
+        scanner = make_scanner(get_option(node.config, 'scan_workers'))
+        scanner.run(lambda: make_backup(node),
+                    lambda directory: match_directories(directory))
+    else:
+        _handle_directory(node) or _handle_file(node) or _handle_other(node)
 
 
 def _handle_directory(node):
     """Step 1 in :func:`make_backup`"""
-    if isdir(node.source_item):
-        if not exists(node.dest_item) or not isdir(node.dest_item):
+    source_stat = node.source_stat
+    if source_stat is not None and S_ISDIR(source_stat.st_mode):
+        journal = node.run.journal
+        if journal is not None and journal.is_done(node.item):
+            # Backed up by the interrupted run that is resumed
+            node.stats.count('directories_resumed')
+            return True
+        dest_stat = node.dest_stat
+        if dest_stat is None and _moved(node):
+            dest_stat = node.dest_stat
+        if dest_stat is None or not S_ISDIR(dest_stat.st_mode):
             # If we are replacing a file, remove the file first
-            if exists(node.dest_item) and not isdir(node.dest_item):
+            if dest_stat is not None:
                 node.remove()
-            node.create_folder()
-        match_directories(node)
+            if not node.create_folder():
+                if journal is not None and node.item:
+                    journal.fail(dirname(node.item))
+                return True
+        elif _unchanged(node):
+            node.stats.count('directories_unchanged')
+            return True
+        elif _skipped(node):
+            return True
+        if not _pruned(node):
+            if journal is not None:
+                journal.started(node.item)
+            current_scanner().schedule(node)
         return True
     return False
 
 
 def _handle_file(node):
     """Step 2 in :func:`make_backup`"""
-    if isfile(node.source_item):
-        if node.modified_contents:
-            if exists(node.dest_item) and not isfile(node.dest_item):
-                node.remove()
+    source_stat = node.source_stat
+    if source_stat is not None and S_ISREG(source_stat.st_mode):
+        dest_stat = node.dest_stat
+        if dest_stat is None and _moved(node):
+            dest_stat = node.dest_stat
+        if dest_stat is not None and not S_ISREG(dest_stat.st_mode):
+            # Replacing a directory, whatever its modification time
+            node.remove()
+            node.copy()
+        elif node.modified_contents():
             node.copy()
         return True
     return False
 
 
+def _moved(node):
+    """Was a new item moved from an obsolete one, see :mod:`bups.moves`"""
+    moves = node.run.moves
+    return moves is not None and moves.claim(node)
+
+
 def _handle_other(node):
     """Step 3 in :func:`make_backup`"""
-    logger.warning('Skipping item {}'.format(node))
+    logger.warning('Skipping item %s', node)
     return True
 
 
-def match_directories(node):
+class RecordedDirectory(object):
+    """A directory that is not listed, with its recorded subdirectories
+
+    It is scheduled like a directory to match, so that skipping a deep
+    tree does not recurse either.
+
+    """
+    __slots__ = ['node', 'children']
+
+    def __init__(self, node, children):
+        self.node = node
+        self.children = children
+
+    def __str__(self):
+        return str(self.node)
+
+
+def match_directories(node, backup=None, obsolete=None):
     """Make the existing directories, source and destination, to match.
 
-    This function is part of a recursive loop in which another function
-    always calls this when two directories with same basenames exist
-    in source and destination.
+    This function is part of a loop in which another function always
+    schedules this when two directories with same basenames exist in
+    source and destination.
+
+    The nodes of the entries are passed to ``backup`` and those only
+    in destination to ``obsolete``, by default :func:`make_backup` and
+    :func:`remove_later`.
+
+    """
+    backup = backup or make_backup
+    obsolete = obsolete or remove_later
+    if isinstance(node, RecordedDirectory):
+        _walk_recorded(node, backup)
+        return
+    fds = node.run.dir_fds
+    batch = None
+    if get_option(node.config, 'batch_small_files'):
+        batch = CopyBatch(get_option(node.config, 'small_file_size',
+                                     SMALL_FILE_SIZE))
+    previous = getattr(_local, 'batch', None)
+    _local.batch = batch
+    matched = False
+    try:
+        if fds is None:
+            _match(node, backup, obsolete)
+        else:
+            # The entries of the listings are stat'ed relative to these
+            with fds.lease(node.source_item), fds.lease(node.dest_item):
+                _match(node, backup, obsolete)
+        matched = True
+    finally:
+        _local.batch = previous
+        if batch is not None:
+            batch.flush()
+        journal = node.run.journal
+        if journal is not None:
+            journal.release(node.item, not matched)
+
+
+def _walk_recorded(directory, backup):
+    """Pass the subdirectories of a :class:`RecordedDirectory` on"""
+    walked = False
+    try:
+        for child in directory.children:
+            backup(child)
+        walked = True
+    finally:
+        # Done when the subdirectories are, by the counts of the journal
+        journal = directory.node.run.journal
+        if journal is not None:
+            journal.release(directory.node.item, not walked)
+
+
+def _match(node, backup, obsolete):
+    source_contents, dest_stats = node.get_children()
+    if (isinstance(source_contents, SpilledNames) or
+            isinstance(dest_stats, SpilledNames)):
+        _match_streamed(node, source_contents, dest_stats, backup, obsolete)
+        return
+    stats = node.stats
+    with stats.timer('compare'):
+        added, common, removed = diff_children(source_contents, dest_stats)
+        if get_option(node.config, 'batch_small_files'):
+            # Read the source in inode order, see :class:`CopyBatch`
+            added.sort(key=lambda entry: entry.inode())
+            common.sort(key=lambda pair: pair[0].inode())
+
+    # Remove obsolete contents, first so that new contents may be
+    # moved from them, see :mod:`bups.moves`
+    for name, dest_stat in removed:
+        obsolete(node.join_item(name, dest_stat=dest_stat))
+    # Copy new and possibly changed contents
+    for entry in added:
+        backup(node.join_item(entry.name, _entry_stat(entry, stats), None))
+    for entry, dest_stat in common:
+        backup(node.join_item(entry.name, _entry_stat(entry, stats),
+                              dest_stat))
+
+
+def _match_streamed(node, source_contents, dest_stats, backup, obsolete):
+    """Match a directory that is too large to pair in memory
+
+    The sides are merged as sorted streams of names, see
+    :mod:`bups.streaming`.  The stats that were not kept are fetched
+    when needed.
+
+    """
+    if isinstance(source_contents, SpilledNames):
+        source_entries = {}
+        source_names = sorted_names(source_contents)
+    else:
+        source_entries = {fsencode(entry.name): entry
+                          for entry in source_contents}
+        source_names = sorted_names(list(source_entries))
+    if isinstance(dest_stats, SpilledNames):
+        known_stats = {}
+        dest_names = sorted_names(dest_stats)
+    else:
+        known_stats = dest_stats
+        dest_names = sorted_names([fsencode(name) for name in dest_stats])
+
+    stats = node.stats
+    try:
+        for name, in_source, in_dest in merge(source_names, dest_names):
+            dest_stat = known_stats.get(name, _UNKNOWN) if in_dest else None
+            if not in_source:
+                obsolete(node.join_item(name, dest_stat=dest_stat))
+                continue
+            entry = source_entries.get(fsencode(name))
+            source_stat = (_UNKNOWN if entry is None
+                           else _entry_stat(entry, stats))
+            backup(node.join_item(name, source_stat, dest_stat))
+    finally:
+        for side in [source_contents, dest_stats]:
+            if isinstance(side, SpilledNames):
+                side.close()
+
+
+def diff_children(source_contents, dest_stats):
+    """Pair the entries of a directory in source and destination
+
+    ``source_contents`` is a sequence of directory entries and
+    ``dest_stats`` maps names in destination to their stats.  One pass
+    over both gives the source entries missing from destination, the
+    ``(entry, dest_stat)`` pairs present in both, and the
+    ``(name, dest_stat)`` pairs only in destination.
 
     """
-    source_contents, dest_contents = node.get_children()
+    remaining = dict(dest_stats)
+    added = []
+    common = []
+    for entry in source_contents:
+        dest_stat = remaining.pop(entry.name, _UNKNOWN)
+        if dest_stat is _UNKNOWN:
+            added.append(entry)
+        else:
+            common.append((entry, dest_stat))
+    return added, common, list(remaining.items())
+
+
+def get_matcher(config):
+    """The include and ignore patterns of the config compiled once
 
-    # Copy new contents
-    for source_item in source_contents:
-        make_backup(node.join_item(source_item))
-    # Remove obsolete contents
-    for dest_item in dest_contents:
-        if dest_item not in source_contents:
-            node.join_item(dest_item).remove()
+    The matcher is kept for the lists it was compiled from, so a run
+    compiles the lists of its config only once.
+
+    """
+    global _compiled
+    include_list = config['include_list']
+    ignore_list = config['ignore_list']
+    compiled_include, compiled_ignore, matcher = _compiled
+    if (compiled_include is not include_list or
+            compiled_ignore is not ignore_list):
+        matcher = Matcher(include_list, ignore_list)
+        # Replaced at once, so threads see a consistent triple
+        _compiled = (include_list, ignore_list, matcher)
+    return matcher
 
 
 def check_include(path, config):
-    """Should an item be excluded from back-up?"""
-    base = basename(path)
-    for include_pattern in config['include_list']:
-        if fnmatch.fnmatch(base, include_pattern):
-            return True
-    for exclude_pattern in config['ignore_list']:
-        if fnmatch.fnmatch(base, exclude_pattern):
-            return False
+    """Should an item be included in back-up?
+
+    ``path`` is relative to the back-up root, see :mod:`bups.matching`.
+
+    """
+    return get_matcher(config).check(path)
+
+
+def _unchanged(node):
+    """Did the change log see nothing change in a directory"""
+    changes = node.run.changes
+    return changes is not None and not changes.needs_walk(node.item)
+
+
+def _skipped(node):
+    """Schedule the subdirectories if the summary allows not listing
+
+    See :mod:`bups.summary`.
+
+    """
+    summary = node.run.summary
+    if summary is None:
+        return False
+    subdirs = summary.unchanged(node.item, node.source_stat)
+    if subdirs is None:
+        return False
+    children = [node.join_item(name) for name in subdirs]
+    if not all(child.source_stat is not None and
+               S_ISDIR(child.source_stat.st_mode) for child in children):
+        # Changed with the times of the directory restored
+        summary.forget(node.item)
+        return False
+    node.stats.count('directories_skipped')
+    journal = node.run.journal
+    if journal is not None:
+        journal.started(node.item)
+    current_scanner().schedule(RecordedDirectory(node, children))
     return True
+
+
+def _pruned(node):
+    """Are all the contents of a directory excluded from back-up"""
+    if get_option(node.config, 'include_list') is None:
+        return False
+    return get_matcher(node.config).prunes(node.item)
@@ -0,0 +1,50 @@
+"""Strategies deciding whether a file in source differs from its back-up
+
+A strategy is a function of the source and destination stat results
+that returns ``True`` when the file must be copied again.  Cheaper
+strategies trust less metadata: ``mtime`` only looks at modification
+times, ``mtime_size`` also catches truncated or partially written
+copies, and ``mtime_size_ctime`` additionally catches files whose
+inode changed after the back-up, e.g., files that were restored or
+moved into place with an old modification time.  The
+``change_detection`` option names the strategy, ``mtime`` by default.
+
+"""
+
+DEFAULT_STRATEGY = 'mtime'
+
+
+def mtime(source_stat, dest_stat):
+    """Source has been modified after it was backed up"""
+    return source_stat.st_mtime > dest_stat.st_mtime
+
+
+def mtime_size(source_stat, dest_stat):
+    """Source is newer or the sizes differ"""
+    return (source_stat.st_size != dest_stat.st_size or
+            source_stat.st_mtime > dest_stat.st_mtime)
+
+
+def mtime_size_ctime(source_stat, dest_stat):
+    """Source is newer, the sizes differ or the source inode has changed"""
+    return (source_stat.st_size != dest_stat.st_size or
+            max(source_stat.st_mtime, source_stat.st_ctime) >
+            dest_stat.st_mtime)
+
+
+STRATEGIES = {
+    'mtime': mtime,
+    'mtime_size': mtime_size,
+    'mtime_size_ctime': mtime_size_ctime,
+}
+
+
+def get_strategy(name=None):
+    """Look up a strategy by its name, ``None`` gives the default"""
+    if name is None:
+        name = DEFAULT_STRATEGY
+    try:
+        return STRATEGIES[name]
+    except KeyError:
+        raise ValueError('Unknown change detection strategy {!r}, choose '
+                         'one of {}'.format(name, ', '.join(sorted(STRATEGIES))))
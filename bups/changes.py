@@ -0,0 +1,202 @@
+"""Change log of the source that lets a back-up walk only what changed
+
+``bups watch``, see :mod:`bups.watch`, records the directories of the
+source that change into a change log in the destination root.  A run
+with the ``use_changes`` option takes the log and walks only those
+directories and their ancestors, and the subtrees that appeared, see
+:class:`ChangeSet`.  The log is a file of JSON lines:
+
+``{"session": id, "pid": pid, "host": name}``
+    the header, written by the watcher when it makes the log
+``{"dir": item}``
+    entries of the directory ``item`` were changed, made or removed
+``{"tree": item}``
+    the directory ``item`` appeared with everything below it
+``{"overflow": true}``
+    the watcher lost events
+
+Every run walks the whole tree instead when it cannot trust the log:
+when there is no log or its watcher is not running, when the watcher
+has been restarted since the previous run, which is told by the
+session of the header, when events were lost, when the previous run
+did not complete and when the last full walk is older than
+``full_walk_hours``.  The session and the time of the last full walk
+are kept in a state file next to the log, and so are the directories
+of the items that had errors, which the next run walks again.
+
+The watcher appends to the log holding an exclusive lock on it.  A run
+renames the log away and reads it under the same lock, and the
+watcher makes a new one when it notices that the log was moved.
+
+"""
+import json
+import logging
+import os
+import socket
+import time
+from os.path import join, dirname, exists
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+CHANGES_FILENAME = '.bups.changes'
+TAKEN_FILENAME = CHANGES_FILENAME + '.taken'
+STATE_FILENAME = CHANGES_FILENAME + '.state'
+CHANGES_FILES = frozenset([CHANGES_FILENAME, TAKEN_FILENAME, STATE_FILENAME])
+
+FULL_WALK_HOURS = 24
+
+
+def _ancestors(item):
+    while item:
+        item = dirname(item)
+        yield item
+
+
+class ChangeSet(object):
+    """The directories that a run has to walk"""
+    def __init__(self, directories=(), trees=()):
+        self.directories = set(directories)
+        self.trees = set(trees)
+        self.ancestors = set()
+        for item in self.directories | self.trees:
+            self.ancestors.update(_ancestors(item))
+
+    def needs_walk(self, item):
+        """Must the directory ``item`` be listed"""
+        if (item in self.directories or item in self.trees or
+                item in self.ancestors):
+            return True
+        return any(ancestor in self.trees for ancestor in _ancestors(item))
+
+    def __len__(self):
+        return len(self.directories) + len(self.trees)
+
+
+def _read_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_state(path, state):
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def _watcher_alive(header):
+    """Is the watcher that wrote ``header`` still running"""
+    if header.get('host') != socket.gethostname():
+        # Cannot tell, trust the session
+        return True
+    try:
+        os.kill(header['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def lock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+class ChangeLog(object):
+    """The change log in ``dest_root`` as taken by a run"""
+    def __init__(self, dest_root, full_walk_hours=FULL_WALK_HOURS):
+        self.dest_root = dest_root
+        self.full_walk_hours = full_walk_hours
+        self.state_path = join(dest_root, STATE_FILENAME)
+        self.taken_path = join(dest_root, TAKEN_FILENAME)
+        self.state = _read_state(self.state_path)
+        self.session = None
+        self.started = time.time()
+
+    def take(self):
+        """Take the log, ``None`` if the whole tree has to be walked"""
+        try:
+            os.replace(join(self.dest_root, CHANGES_FILENAME),
+                       self.taken_path)
+        except FileNotFoundError:
+            logger.info('No change log, is bups watch running?')
+            return None
+        header, records = self._read()
+        if header is None:
+            return None
+        self.session = header['session']
+        reason = None
+        if not _watcher_alive(header):
+            reason = 'the watcher is not running'
+        elif self.session != self.state.get('session'):
+            reason = 'the watcher has been restarted'
+        elif any(record.get('overflow') for record in records):
+            reason = 'the watcher lost events'
+        elif (time.time() - self.state.get('full_walk', 0) >
+              self.full_walk_hours * 3600):
+            reason = 'it is time for a full walk'
+        if reason is not None:
+            logger.info('Walking the whole tree, %s', reason)
+            return None
+        changes = ChangeSet(
+            [record['dir'] for record in records if 'dir' in record] +
+            self.state.get('retry', []),
+            [record['tree'] for record in records if 'tree' in record])
+        logger.info('Walking %d changed directories', len(changes))
+        return changes
+
+    def _read(self):
+        with open(self.taken_path) as f:
+            # Wait for the watcher to finish writing
+            lock(f)
+            lines = f.readlines()
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+        if not records or 'session' not in records[0]:
+            return None, []
+        return records[0], records[1:]
+
+    def finish(self, stats, completed, full_walk):
+        """Record the run, the next one walks all if not ``completed``
+
+        The directories of the items that had errors, by ``stats``, are
+        walked again on the next run.
+
+        """
+        with stats.lock:
+            errors = stats.counts['errors']
+            error_items = list(stats.error_items)
+        if errors > len(error_items):
+            # Not all of them are known
+            completed = False
+        state = dict(self.state)
+        if completed:
+            state['session'] = self.session
+            if full_walk:
+                state['full_walk'] = self.started
+            # The item itself may be a directory that was not listed
+            state['retry'] = sorted(set(error_items) |
+                                    set(dirname(item)
+                                        for item in error_items))
+        else:
+            state['session'] = None
+            state.pop('retry', None)
+        _write_state(self.state_path, state)
+        if exists(self.taken_path):
+            os.unlink(self.taken_path)
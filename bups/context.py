@@ -0,0 +1,41 @@
+"""The objects that a back-up run sets up from its options
+
+The config of a run holds only its options, as read from the config
+file and given on the command line.  What the run makes of them, the
+statistics and the helpers of the options that are used, is kept in a
+:class:`RunContext` shared by the nodes of the walk.  Each option is
+described in the module of its helper.
+
+"""
+from .stats import Stats
+
+
+class RunContext(object):
+    """The live objects of one run, ``None`` for the options not used
+
+    ``stats`` is the :class:`bups.stats.Stats` of the run,
+    ``manifest`` the :class:`bups.manifest.Manifest` of the
+    destination, ``content_store`` the :class:`bups.dedup.ContentStore`,
+    ``plan`` the :class:`bups.plan.PlanWriter` of a dry run,
+    ``dir_fds`` the :class:`bups.fsio.DirectoryFds`, ``moves`` the
+    :class:`bups.moves.MoveIndex`, ``copy_pool`` the
+    :class:`bups.copy_pool.CopyPool`, ``link_dest`` the previous
+    snapshot, ``journal`` the :class:`bups.journal.Journal`,
+    ``changes`` the :class:`bups.changes.ChangeSet` to walk and
+    ``summary`` the :class:`bups.summary.TreeSummary`.
+
+    """
+    def __init__(self, stats=None, manifest=None, content_store=None,
+                 plan=None, dir_fds=None, moves=None, copy_pool=None,
+                 link_dest=None, journal=None, changes=None, summary=None):
+        self.stats = Stats() if stats is None else stats
+        self.manifest = manifest
+        self.content_store = content_store
+        self.plan = plan
+        self.dir_fds = dir_fds
+        self.moves = moves
+        self.copy_pool = copy_pool
+        self.link_dest = link_dest
+        self.journal = journal
+        self.changes = changes
+        self.summary = summary
@@ -0,0 +1,87 @@
+"""Worker threads that copy files while the tree walk goes on
+
+The tree walk is the producer: it decides what needs to be done and
+submits copies to a bounded queue, blocking when the queue is full.
+Worker threads consume the queue.  Directories are still created by
+the walk itself, so they always exist before any copy into them is
+submitted.  Removals are deferred and run after all copies are done.
+
+The ``copy_workers`` option, when greater than zero, runs the copies
+in that many threads, with at most ``copy_queue_size`` copies waiting,
+by default four per worker.
+
+"""
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Tells a worker thread to stop
+_STOP = object()
+
+
+class CopyPool(object):
+    """A bounded queue of copy tasks consumed by worker threads"""
+    def __init__(self, workers, queue_size=None):
+        if workers < 1:
+            raise ValueError('At least one copy worker is needed')
+        if queue_size is None:
+            queue_size = 4 * workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.deferred = []
+        self.threads = [threading.Thread(target=self._work,
+                                         name='bups-copy-{}'.format(i),
+                                         daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, func, *args):
+        """Queue ``func(*args)``, blocking while the queue is full"""
+        self.queue.put((func, args))
+
+    def defer(self, func, *args):
+        """Run ``func(*args)`` in :meth:`finish` after all copies"""
+        self.deferred.append((func, args))
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is _STOP:
+                    return
+                func, args = task
+                func(*args)
+            except Exception:
+                logger.error('Unexpected error in a copy worker',
+                             exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    def finish(self, cancel=False):
+        """Wait for the queued copies, then run the deferred tasks
+
+        With ``cancel`` the copies that have not started are dropped
+        and the deferred tasks are not run.
+
+        """
+        if cancel:
+            self._drain()
+            del self.deferred[:]
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        for func, args in self.deferred:
+            func(*args)
+        del self.deferred[:]
+
+    def _drain(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self.queue.task_done()
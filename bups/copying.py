@@ -0,0 +1,214 @@
+"""Copying file contents with the cheapest method the system supports
+
+The backends, from cheapest to most portable, are
+
+``reflink``
+    clone the extents of the source with the ``FICLONE`` ioctl, which
+    shares the data on copy-on-write file systems like btrfs and xfs
+``copy_file_range``
+    copy inside the kernel, possibly offloaded to the file system or
+    the storage
+``sendfile``
+    copy inside the kernel without buffers in user space
+``chunked``
+    read and write in large chunks, works everywhere
+
+The ``copy_backend`` option chooses one.  With the default ``auto``
+each of them is tried in turn until one works.  Any other backend is
+used as such, and fails if it is not supported.  With ``fadvise`` the
+kernel is told how the source is read, see :func:`copy_file`.
+
+:func:`delta_copy` updates an existing copy in place instead, writing
+only the blocks that differ from the source.  It is used for the files
+of at least ``delta_threshold`` bytes, in blocks of
+``delta_block_size`` bytes.
+
+"""
+import errno
+import os
+from stat import S_IMODE
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 1024 * 1024
+
+DELTA_BLOCK_SIZE = 128 * 1024
+
+# Errors telling that a backend does not work for these files
+_UNSUPPORTED = frozenset([errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY,
+                          errno.EINVAL, errno.EXDEV, errno.ENOSYS,
+                          errno.EBADF])
+
+
+class UnsupportedBackend(OSError):
+    """The backend cannot copy between the given files"""
+    pass
+
+
+def _reflink(src_fd, dst_fd, size):
+    if fcntl is None:
+        raise UnsupportedBackend('No fcntl on this platform')
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    return size
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    if not hasattr(os, 'copy_file_range'):
+        raise UnsupportedBackend('No copy_file_range on this platform')
+    copied = 0
+    while True:
+        n = os.copy_file_range(src_fd, dst_fd, max(size - copied, CHUNK_SIZE))
+        if n == 0:
+            return copied
+        copied += n
+
+
+def _sendfile(src_fd, dst_fd, size):
+    if not hasattr(os, 'sendfile'):
+        raise UnsupportedBackend('No sendfile on this platform')
+    copied = 0
+    while True:
+        n = os.sendfile(dst_fd, src_fd, None, max(size - copied, CHUNK_SIZE))
+        if n == 0:
+            return copied
+        copied += n
+
+
+def _chunked(src_fd, dst_fd, size):
+    copied = 0
+    while True:
+        chunk = os.read(src_fd, CHUNK_SIZE)
+        if not chunk:
+            return copied
+        view = memoryview(chunk)
+        while view:
+            n = os.write(dst_fd, view)
+            view = view[n:]
+        copied += len(chunk)
+
+
+BACKENDS = {
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'chunked': _chunked,
+}
+
+# Order in which the ``auto`` backend tries the others
+AUTO_ORDER = ['reflink', 'copy_file_range', 'sendfile', 'chunked']
+
+BACKEND_NAMES = ['auto'] + AUTO_ORDER
+
+
+def _unsupported(exc):
+    return (isinstance(exc, UnsupportedBackend) or
+            exc.errno in _UNSUPPORTED)
+
+
+def copy_fd(src_fd, dst_fd, size, backend='auto'):
+    """Copy the contents of ``src_fd`` to the empty file ``dst_fd``
+
+    Both files must be at offset zero.  Returns the name of the backend
+    that did the copy.
+
+    """
+    if backend != 'auto':
+        BACKENDS[backend](src_fd, dst_fd, size)
+        return backend
+    for name in AUTO_ORDER:
+        try:
+            BACKENDS[name](src_fd, dst_fd, size)
+            return name
+        except OSError as exc:
+            if name == AUTO_ORDER[-1] or not _unsupported(exc):
+                raise
+        # Start over if the backend got something done before failing
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dst_fd, 0, os.SEEK_SET)
+        os.ftruncate(dst_fd, 0)
+
+
+def copy_file(source, dest, backend='auto', src_dir_fd=None,
+              dst_dir_fd=None, advise=False):
+    """Copy data and permission bits like :func:`shutil.copy`
+
+    ``dest`` must be a file name, not a directory.  Relative paths are
+    relative to the open directories ``src_dir_fd`` and ``dst_dir_fd``
+    if given.  With ``advise`` the kernel is told that the source is
+    read sequentially and not needed in the page cache afterwards,
+    where :func:`os.posix_fadvise` is available.  Returns the name of
+    the backend that copied the data.
+
+    """
+    if backend not in BACKEND_NAMES:
+        raise ValueError('Unknown copy backend {!r}'.format(backend))
+    src_fd = os.open(source, os.O_RDONLY, dir_fd=src_dir_fd)
+    try:
+        source_stat = os.fstat(src_fd)
+        dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         S_IMODE(source_stat.st_mode), dir_fd=dst_dir_fd)
+        try:
+            if advise:
+                _advise(src_fd, 'POSIX_FADV_SEQUENTIAL')
+            used = copy_fd(src_fd, dst_fd, source_stat.st_size, backend)
+            os.fchmod(dst_fd, S_IMODE(source_stat.st_mode))
+        finally:
+            os.close(dst_fd)
+        if advise:
+            # Leave the page cache to what the user is working on
+            _advise(src_fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(src_fd)
+    return used
+
+
+def _advise(fd, advice):
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def delta_copy(source, dest, block_size=DELTA_BLOCK_SIZE):
+    """Make the existing file ``dest`` equal to ``source`` in place
+
+    The files are compared block by block and only the blocks that
+    differ are written.  Both files are local, so the blocks are
+    compared directly rather than through checksums.  Returns the
+    number of bytes read from both files and written to ``dest``.
+
+    Raises :class:`UnsupportedBackend` if ``dest`` has other hard
+    links, which an update in place would change too.
+
+    """
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dest, os.O_RDWR)
+        try:
+            if os.fstat(dst_fd).st_nlink > 1:
+                raise UnsupportedBackend('{} has other links'.format(dest))
+            bytes_read = bytes_written = offset = 0
+            while True:
+                block = os.pread(src_fd, block_size, offset)
+                if not block:
+                    break
+                old_block = os.pread(dst_fd, len(block), offset)
+                bytes_read += len(block) + len(old_block)
+                if block != old_block:
+                    os.pwrite(dst_fd, block, offset)
+                    bytes_written += len(block)
+                offset += len(block)
+            os.ftruncate(dst_fd, offset)
+            os.fchmod(dst_fd, S_IMODE(os.fstat(src_fd).st_mode))
+            # Mark the copy current even if no block differed
+            os.utime(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return bytes_read, bytes_written
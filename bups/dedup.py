@@ -0,0 +1,170 @@
+"""Content addressed store that deduplicates files in a back-up
+
+With the ``dedup`` option every copied file is also hard linked into
+a store under the destination root, named by the SHA-256 of its
+contents and its permission bits.  A file whose contents are already
+in the store is linked from there instead of being copied.  The hashes
+in the store are kept in an SQLite index, so a lookup costs one query.
+With ``dedup_prune`` the contents that no file uses any more are
+removed from the store after the run.
+
+Linked files share their inode, so they are never written in place:
+a changed file is unlinked first and then copied or linked anew.  For
+the same reason they share their modification time, which is set to
+the time of the latest link, like a copy would have it.
+
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from os.path import join, exists
+from stat import S_IMODE
+
+
+logger = logging.getLogger(__name__)
+
+STORE_DIRNAME = '.bups.store'
+INDEX_FILENAME = 'index'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# New objects are committed to the index in batches of this size
+COMMIT_INTERVAL = 1000
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    """SHA-256 of the contents of a file as a hex string"""
+    digest = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class ContentStore(object):
+    """Hard link farm of file contents under the destination root"""
+    def __init__(self, dest_root):
+        self.root = join(dest_root, STORE_DIRNAME)
+        if not exists(self.root):
+            os.mkdir(self.root)
+        self.lock = threading.Lock()
+        self._pending = 0
+        self.db = sqlite3.connect(join(self.root, INDEX_FILENAME),
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects '
+                        '(key TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+        self.db.commit()
+
+    def _path(self, key):
+        return join(self.root, key[:2], key)
+
+    def _lookup(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM objects WHERE key = ?',
+                                  (key,)).fetchone()
+        return row is not None
+
+    def _add(self, key, path, size):
+        store_path = self._path(key)
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        try:
+            os.link(path, store_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            logger.warning('Cannot add {} to the store'.format(path),
+                           exc_info=True)
+            return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?)',
+                            (key, size))
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self.db.commit()
+                self._pending = 0
+
+    def _forget(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM objects WHERE key = ?', (key,))
+
+    def link_or_copy(self, source, dest, copy):
+        """Link ``dest`` from the store or copy it with ``copy(source, dest)``
+
+        Returns ``'link'`` if the contents were in the store, otherwise
+        what ``copy`` returns.
+
+        """
+        before = os.stat(source)
+        key = '{}-{:o}'.format(hash_file(source), S_IMODE(before.st_mode))
+        store_path = self._path(key)
+        # Never write through an inode that is shared with the store
+        _unlink(dest)
+        if self._lookup(key):
+            try:
+                os.utime(store_path)
+                os.link(store_path, dest)
+                return 'link'
+            except FileNotFoundError:
+                logger.warning('{} is missing from the store'.format(key))
+                self._forget(key)
+            except OSError:
+                # E.g., too many links, the file is copied instead
+                pass
+        used = copy(source, dest)
+        after = os.stat(source)
+        # The hash is only valid if the source did not change meanwhile
+        if (before.st_mtime_ns, before.st_size) == (after.st_mtime_ns,
+                                                     after.st_size):
+            self._add(key, dest, after.st_size)
+        return used
+
+    def discard(self, digest, mode, inode):
+        """Remove contents that were found corrupt in the file ``inode``
+
+        The contents are only removed if the store links to that file.
+
+        """
+        key = '{}-{:o}'.format(digest, S_IMODE(mode))
+        try:
+            if os.stat(self._path(key)).st_ino != inode:
+                return
+        except FileNotFoundError:
+            return
+        _unlink(self._path(key))
+        self._forget(key)
+
+    def prune(self):
+        """Remove contents that no file in the back-up links to anymore"""
+        with self.lock:
+            keys = [row[0] for row in
+                    self.db.execute('SELECT key FROM objects')]
+        removed = 0
+        for key in keys:
+            path = self._path(key)
+            try:
+                if os.stat(path).st_nlink > 1:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._forget(key)
+            removed += 1
+        with self.lock:
+            self.db.commit()
+        logger.info('Removed {} unused files from the store'.format(removed))
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
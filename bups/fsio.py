@@ -0,0 +1,138 @@
+"""File operations relative to open directories
+
+With the ``use_dir_fds`` option the walk keeps the directories it is
+working in open, and stats, opens, makes and removes their entries by
+name relative to the open directory, like ``fstatat`` and ``openat``
+do.  The kernel then resolves one name instead of every component of
+an absolute path, which adds up in deep trees and on network file
+systems.
+
+:class:`DirectoryFds` is a cache of the open directories, keyed by
+their absolute paths.  A descriptor is leased for the duration of the
+operations on it and only descriptors that nobody uses are closed, the
+least recently used first, when there are more than ``max_open``,
+the ``max_dir_fds`` option.
+
+"""
+import collections
+import os
+import threading
+from contextlib import contextmanager
+
+
+MAX_OPEN = 256
+
+_DIRECTORY_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+
+
+def supported():
+    """Does the platform have the file operations relative to a directory"""
+    return (all(func in os.supports_dir_fd
+                for func in [os.stat, os.open, os.mkdir, os.unlink]) and
+            os.scandir in os.supports_fd)
+
+
+class _Slot(object):
+    __slots__ = ['fd', 'users', 'forgotten']
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.users = 0
+        self.forgotten = False
+
+
+class DirectoryFds(object):
+    """Bounded cache of open directory file descriptors"""
+    def __init__(self, max_open=MAX_OPEN):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        # Absolute paths to slots, least recently used first
+        self.slots = collections.OrderedDict()
+
+    @contextmanager
+    def lease(self, path):
+        """Keep the directory ``path`` open in the ``with`` block
+
+        Gives the descriptor, or ``None`` if the directory cannot be
+        opened, in which case the caller should use ``path`` as such.
+
+        """
+        slot = self._acquire(path)
+        try:
+            yield None if slot is None else slot.fd
+        finally:
+            if slot is not None:
+                self._release(slot)
+
+    def _acquire(self, path):
+        with self.lock:
+            slot = self.slots.get(path)
+            if slot is not None:
+                self.slots.move_to_end(path)
+                slot.users += 1
+                return slot
+        try:
+            fd = os.open(path, _DIRECTORY_FLAGS)
+        except OSError:
+            return None
+        with self.lock:
+            slot = self.slots.get(path)
+            if slot is None:
+                slot = _Slot(fd)
+                self.slots[path] = slot
+            else:
+                # Another thread opened it meanwhile
+                os.close(fd)
+                self.slots.move_to_end(path)
+            slot.users += 1
+            self._evict()
+            return slot
+
+    def _release(self, slot):
+        with self.lock:
+            slot.users -= 1
+            if slot.forgotten:
+                if slot.users == 0:
+                    os.close(slot.fd)
+            else:
+                self._evict()
+
+    def _evict(self):
+        excess = len(self.slots) - self.max_open
+        if excess <= 0:
+            return
+        for path in list(self.slots):
+            slot = self.slots[path]
+            if slot.users == 0:
+                del self.slots[path]
+                os.close(slot.fd)
+                excess -= 1
+                if excess == 0:
+                    return
+
+    def forget(self, path):
+        """Close the directory ``path`` and those below it once unused
+
+        Called when the directories have been removed, so that a new
+        directory made in their place is opened anew.
+
+        """
+        prefix = os.path.join(path, '')
+        with self.lock:
+            for cached in list(self.slots):
+                if cached == path or cached.startswith(prefix):
+                    slot = self.slots.pop(cached)
+                    slot.forgotten = True
+                    if slot.users == 0:
+                        os.close(slot.fd)
+
+    def close(self):
+        with self.lock:
+            for slot in self.slots.values():
+                slot.forgotten = True
+                if slot.users == 0:
+                    os.close(slot.fd)
+            self.slots.clear()
+
+    def __len__(self):
+        return len(self.slots)
@@ -0,0 +1,236 @@
+"""Journal of a back-up run that lets an interrupted run be resumed
+
+With the ``journal`` option a run keeps a journal in the destination
+root.  It is a file of JSON lines, appended as the run goes on:
+
+``{"done": item}``
+    the directory ``item`` and everything below it are backed up
+``{"partial": item}``
+    a file is being copied into the partial file ``item``
+``{"in_place": item}``
+    the file ``item`` is being updated in place
+
+Files are copied into a partial file next to their destination, which
+is renamed over the destination when the copy is complete, so a file
+is never left half written under its own name.  A completed run
+removes its journal.
+
+A run that finds a journal resumes the interrupted run.  It removes
+the partial files, marks the files that were being updated in place as
+out of date and skips the directories that were done.  Changes made
+in the source of those directories since are backed up on the next
+run, which is a full one again, and so are the removals of obsolete
+items in them.  A run without the ``journal`` option cleans up the
+same way but removes the journal, so that it is not resumed after the
+destination has been changed by other runs.
+
+A directory is done when it has been matched and its files copied
+without errors and all its subdirectories are done.  The journal is
+flushed after every record and synced to disk every ``SYNC_INTERVAL``
+seconds.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from os.path import join, dirname, basename, exists
+
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILENAME = '.bups.journal'
+
+# Files being copied are named so and never listed as part of a back-up
+PARTIAL_PREFIX = '.bups-partial-'
+
+SYNC_INTERVAL = 5.0
+
+# The longest file name on most file systems
+_NAME_MAX = 255
+
+
+def partial_name(path):
+    """The partial file that ``path`` is copied into"""
+    name = PARTIAL_PREFIX + basename(path)
+    if len(os.fsencode(name)) > _NAME_MAX:
+        name = PARTIAL_PREFIX + hashlib.sha1(
+            os.fsencode(basename(path))).hexdigest()
+    return join(dirname(path), name)
+
+
+def _parent(item):
+    return None if item == '' else dirname(item)
+
+
+def _clean_up(dest_root, stats):
+    """Undo the unfinished copies of the journal of ``dest_root``
+
+    Returns the directories that were done.
+
+    """
+    done = set()
+    partial = []
+    in_place = []
+    with open(join(dest_root, JOURNAL_FILENAME)) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line of a run that was killed
+                continue
+            if 'done' in record:
+                done.add(record['done'])
+            elif 'partial' in record:
+                partial.append(record['partial'])
+            elif 'in_place' in record:
+                in_place.append(record['in_place'])
+    for item in partial:
+        try:
+            os.unlink(join(dest_root, item))
+            stats.count('partial_files_removed')
+        except FileNotFoundError:
+            pass
+    for item in in_place:
+        try:
+            # Older than any source, so that it is copied again
+            os.utime(join(dest_root, item), (0, 0))
+        except FileNotFoundError:
+            pass
+    return done
+
+
+def discard_journal(dest_root, stats):
+    """Remove the journal of an interrupted run without resuming it
+
+    A run without the ``journal`` option does this, so that a journal
+    is never resumed after runs that changed the destination since.
+
+    """
+    path = join(dest_root, JOURNAL_FILENAME)
+    if not exists(path):
+        return
+    logger.info('Discarding the journal of an interrupted back-up')
+    _clean_up(dest_root, stats)
+    os.unlink(path)
+
+
+class Journal(object):
+    """Record the progress of a run into the journal of ``dest_root``"""
+    def __init__(self, dest_root, stats):
+        self.dest_root = dest_root
+        self.stats = stats
+        self.path = join(dest_root, JOURNAL_FILENAME)
+        self.lock = threading.Lock()
+        self.done = set()
+        # Directories that are not done, by the number of unfinished
+        # matches, copies and subdirectories in them
+        self.pending = {}
+        self.failed = set()
+        if exists(self.path):
+            self._resume()
+        self.file = open(self.path, 'a')
+        self.synced = time.monotonic()
+
+    def _resume(self):
+        """Clean up after the interrupted run and compact its journal"""
+        self.done = _clean_up(self.dest_root, self.stats)
+        logger.info('Resuming an interrupted back-up, %d directories '
+                    'are done', len(self.done))
+        fd, temp = tempfile.mkstemp(dir=self.dest_root,
+                                    prefix=PARTIAL_PREFIX)
+        with os.fdopen(fd, 'w') as f:
+            for item in sorted(self.done):
+                f.write(json.dumps({'done': item}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+
+    def _write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            now = time.monotonic()
+            if now - self.synced >= SYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.synced = now
+
+    def is_done(self, item):
+        """Was the directory ``item`` done in the interrupted run"""
+        return item in self.done
+
+    def started(self, item):
+        """The directory ``item`` is to be matched"""
+        with self.lock:
+            self.pending[item] = 1
+            parent = _parent(item)
+            if parent is not None:
+                self.pending[parent] = self.pending.get(parent, 0) + 1
+
+    def hold(self, directory):
+        """A file of ``directory`` is being copied"""
+        with self.lock:
+            self.pending[directory] = self.pending.get(directory, 0) + 1
+
+    def release(self, directory, failed=False):
+        """A match or a copy in ``directory`` is over"""
+        done = []
+        with self.lock:
+            if failed:
+                self.failed.add(directory)
+            while directory is not None:
+                count = self.pending.get(directory, 0) - 1
+                if count > 0:
+                    self.pending[directory] = count
+                    break
+                self.pending.pop(directory, None)
+                parent = _parent(directory)
+                if directory in self.failed:
+                    # Not done, and neither are the directories above
+                    self.failed.discard(directory)
+                    if parent is not None:
+                        self.failed.add(parent)
+                else:
+                    done.append(directory)
+                directory = parent
+        for item in done:
+            self._write({'done': item})
+
+    def fail(self, directory):
+        """Something in ``directory`` could not be backed up"""
+        with self.lock:
+            self.failed.add(directory)
+
+    def copy(self, item, copy, dest, dir_fd=None):
+        """Copy ``item`` with ``copy(partial)`` and rename it to ``dest``
+
+        ``dest`` is relative to ``dir_fd`` if that is given.  Returns
+        what ``copy`` returns.
+
+        """
+        self._write({'partial': partial_name(item)})
+        partial = partial_name(dest)
+        try:
+            used = copy(partial)
+            os.replace(partial, dest, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        except BaseException:
+            try:
+                os.unlink(partial, dir_fd=dir_fd)
+            except OSError:
+                pass
+            raise
+        return used
+
+    def in_place(self, item):
+        """The file ``item`` is about to be updated in place"""
+        self._write({'in_place': item})
+
+    def close(self, complete=False):
+        """Close the journal, removing it if the run is ``complete``"""
+        with self.lock:
+            self.file.close()
+        if complete:
+            os.unlink(self.path)
@@ -1,11 +1,25 @@
 import argparse
+import asyncio
+import functools
+import json
 import logging
+import queue
+import signal
+import sys
 import textwrap
+import threading
 import time
+from logging.handlers import QueueHandler, QueueListener
+from .change_detection import STRATEGIES, DEFAULT_STRATEGY
+from .plan import APPLY_ORDERS, InvalidPlanException
+from .copying import BACKEND_NAMES
 
 
 logger = logging.getLogger(__name__)
 
+# Seconds between progress lines in high-volume mode
+HIGH_VOLUME_PROGRESS = 10
+
 
 def parse_opts():
     parser = argparse.ArgumentParser(
@@ -20,11 +34,130 @@ def parse_opts():
     parser.add_argument('dest_root', metavar='destination',
                         type=str,
                         help='Directory where the back-up will be located')
+    parser.add_argument('--change-detection', metavar='STRATEGY',
+                        choices=sorted(STRATEGIES),
+                        help=('How changed files are detected, one of '
+                              '{}. Default is {}.'
+                              ''.format(', '.join(sorted(STRATEGIES)),
+                                        DEFAULT_STRATEGY)))
+    parser.add_argument('--manifest', action='store_true', default=None,
+                        help=('Compare against a manifest kept in the '
+                              'destination instead of reading the '
+                              'destination directories'))
+    parser.add_argument('--verify-manifest', action='store_true',
+                        default=None,
+                        help=('Rebuild the manifest from the destination '
+                              'before the back-up, implies --manifest'))
+    parser.add_argument('--copy-workers', metavar='N', type=int,
+                        help=('Copy files in N threads while the directories '
+                              'are being walked'))
+    parser.add_argument('--scan-workers', metavar='N', type=int,
+                        help='List directories in N threads')
+    parser.add_argument('--dry-run', action='store_true', default=None,
+                        help=('Only report what would be copied and removed, '
+                              'without changing the destination'))
+    parser.add_argument('--plan-out', metavar='FILE',
+                        help=('Write the operations of a dry run into FILE '
+                              'to be applied later, implies --dry-run'))
+    parser.add_argument('--apply', metavar='FILE', dest='apply_plan',
+                        help=('Execute the operations planned in FILE '
+                              'instead of comparing the directories'))
+    parser.add_argument('--apply-order', choices=APPLY_ORDERS,
+                        help=('Order of copies when applying a plan: as '
+                              'planned (walk, the default), by path, or by '
+                              'the inode of the destination directory'))
+    parser.add_argument('--copy-backend', choices=BACKEND_NAMES,
+                        help=('How file contents are copied. The default, '
+                              'auto, uses the first one of reflink, '
+                              'copy_file_range, sendfile and chunked that '
+                              'works.'))
+    parser.add_argument('--dedup', action='store_true', default=None,
+                        help=('Hard link files with identical contents from '
+                              'a store in the destination instead of copying '
+                              'them'))
+    parser.add_argument('--snapshot', action='store_true', default=None,
+                        help=('Make a new snapshot of the source under the '
+                              'destination, hard linking unchanged files '
+                              'from the previous one'))
+    parser.add_argument('--keep-last', metavar='N', type=int,
+                        help='Keep the N latest snapshots')
+    parser.add_argument('--keep-daily', metavar='N', type=int,
+                        help='Keep the latest snapshot of the N latest days')
+    parser.add_argument('--keep-weekly', metavar='N', type=int,
+                        help='Keep the latest snapshot of the N latest weeks')
+    parser.add_argument('--batch-small-files', action='store_true',
+                        default=None,
+                        help=('Copy small files in batches per folder, in '
+                              'the order of their inodes'))
+    parser.add_argument('--fadvise', action='store_true', default=None,
+                        help=('Tell the kernel that files are read once, '
+                              'sequentially'))
+    parser.add_argument('--journal', action='store_true', default=None,
+                        help=('Keep a journal in the destination to resume '
+                              'an interrupted back-up'))
+    parser.add_argument('--changes', action='store_true', default=None,
+                        dest='use_changes',
+                        help=('Walk only the folders that bups watch saw '
+                              'change'))
+    parser.add_argument('--summary', action='store_true', default=None,
+                        dest='use_summary',
+                        help=('Do not list the folders whose times have not '
+                              'changed since the previous back-up. Files '
+                              'written in place are missed until the next '
+                              'full walk.'))
+    parser.add_argument('--full-walk-hours', metavar='HOURS', type=int,
+                        help=('With --changes or --summary, walk the whole '
+                              'tree if the last full walk is older than '
+                              'HOURS hours. Default is 24.'))
+    parser.add_argument('--detect-moves', action='store_true', default=None,
+                        help=('Rename files and folders moved in source '
+                              'instead of copying them again'))
+    parser.add_argument('--verify', action='store_true', default=None,
+                        help=('Compare the hashes of the files in source '
+                              'and destination after the back-up'))
+    parser.add_argument('--repair', action='store_true', default=None,
+                        dest='verify_repair',
+                        help=('Copy the files that fail verification '
+                              'again, implies --verify'))
+    parser.add_argument('--stats', metavar='FILE', dest='stats_file',
+                        help=('Write the statistics of the run into FILE '
+                              'as JSON'))
+    parser.add_argument('--progress', metavar='SECONDS', type=int,
+                        dest='progress_interval',
+                        help='Log the progress every SECONDS seconds')
+    parser.add_argument('--dir-fds', action='store_true', default=None,
+                        help=('Access entries relative to open directories '
+                              'instead of by absolute paths'))
+    parser.add_argument('--concurrency', metavar='N', type=int,
+                        help=('Walk the tree in an event loop with up to N '
+                              'file system calls in flight, for network '
+                              'file systems'))
+    parser.add_argument('--high-volume', action='store_true',
+                        help=('Log a progress summary periodically instead '
+                              'of every file, writing the log in a '
+                              'background thread'))
+    parser.add_argument('--file-log', metavar='FILE',
+                        help=('Write every file operation into FILE, one '
+                              'JSON object per line with the path relative '
+                              'to the back-up root'))
     opts = parser.parse_args()
 
     return opts
 
 
+def parse_watch_opts(args):
+    parser = argparse.ArgumentParser(
+        prog='bups watch',
+        description=('Watch the source for changes and record them in the '
+                     'destination, so that a back-up with --changes walks '
+                     'only the folders that changed. Linux only.'))
+    parser.add_argument('source_root', metavar='source', type=str,
+                        help='Directory that is backed-up')
+    parser.add_argument('dest_root', metavar='destination', type=str,
+                        help='Directory where the back-up is located')
+    return parser.parse_args(args)
+
+
 COLORS = ['k', 'r', 'g', 'y', 'b', 'm', 'c', 'w']
 COLOR_DICT = dict(zip(COLORS, range(30, 30 + len(COLORS))))
 
@@ -46,6 +179,9 @@ class BupsFormatter(logging.Formatter):
                                             subsequent_indent=' '*indent)
 
     def format(self, record):
+        # Merge the arguments once, other handlers get the same record
+        record.msg = record.getMessage()
+        record.args = None
 
         if self.font_effects:
             if record.levelno >= 30:
@@ -71,42 +207,173 @@ class BupsFormatter(logging.Formatter):
             return output
 
 
-def configure_logging():
+class FileEventFormatter(logging.Formatter):
+    """One JSON object per line with the time, operation and item
+
+    The item is the path relative to the back-up root.
+
+    """
+    def format(self, record):
+        return json.dumps(dict(time=round(record.created, 6),
+                               op=getattr(record, 'op', None),
+                               item=getattr(record, 'item',
+                                            record.getMessage())))
+
+
+class _LocalQueueHandler(QueueHandler):
+    """Pass records as such to a listener in the same process
+
+    The records are formatted in the thread of the listener instead of
+    the one that logs them.
+
+    """
+    def prepare(self, record):
+        return record
+
+
+def _add_handlers(logger_, handlers, background):
+    if not background:
+        for handler in handlers:
+            logger_.addHandler(handler)
+        return None
+    records = queue.Queue()
+    logger_.addHandler(_LocalQueueHandler(records))
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def configure_logging(high_volume=False, file_log=None):
+    """Log into the terminal, ``backup.log`` and optionally ``file_log``
+
+    Every file operation is logged by the ``bups.files`` logger, into
+    ``file_log`` as JSON lines.  In ``high_volume`` mode they are not
+    shown otherwise and all handlers write in background threads.
+    Returns the listeners of the threads, to be stopped at exit.
+
+    """
     fh = logging.FileHandler('backup.log')
     ch = logging.StreamHandler()
 
-    minimal_formatter = BupsFormatter(fmt='%(levelname).1s: %(msg)s', indent=3)
-    simple_formatter = BupsFormatter(fmt='%(asctime)s %(levelname).1s: %(msg)s',
-                                     datefmt='%H:%M:%S', indent=12,
-                                     font_effects=False)
+    minimal_formatter = BupsFormatter(fmt='%(levelname).1s: %(message)s',
+                                      indent=3)
+    simple_formatter = BupsFormatter(
+        fmt='%(asctime)s %(levelname).1s: %(message)s',
+        datefmt='%H:%M:%S', indent=12, font_effects=False)
 
     ch.setFormatter(minimal_formatter)
     fh.setFormatter(simple_formatter)
-    logging.getLogger().addHandler(fh)
-    logging.getLogger().addHandler(ch)
     logging.getLogger().setLevel(logging.INFO)
+    listeners = [_add_handlers(logging.getLogger(), [fh, ch], high_volume)]
+
+    file_logger = logging.getLogger('bups.files')
+    if high_volume:
+        file_logger.propagate = False
+        if file_log is None:
+            # Not even a record is made for the files
+            file_logger.setLevel(logging.WARNING)
+    if file_log is not None:
+        events = logging.FileHandler(file_log, 'w')
+        events.setFormatter(FileEventFormatter())
+        listeners.append(_add_handlers(file_logger, [events], high_volume))
+
+    return [listener for listener in listeners if listener is not None]
+
+
+def watch_main(args):
+    opts = parse_watch_opts(args)
+    listeners = configure_logging()
+
+    from .preparations import (InvalidFoldersException,
+                               InvalidConfigException, prepare_watch)
+    from .backup_loop import include_entry
+    from .watch import Watcher, supported
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        if not supported():
+            logger.error('Watching is not supported on this platform')
+            return
+        source_root, dest_root, config = prepare_watch(opts.source_root,
+                                                       opts.dest_root)
+        watcher = Watcher(source_root, dest_root,
+                          functools.partial(include_entry, config=config))
+        watcher.run(stop.is_set)
+    except InvalidFoldersException as exc:
+        logger.error('Unable to watch. ' + str(exc))
+    except InvalidConfigException as exc:
+        logger.error('Unable to read the configuration. ', exc_info=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info('Stopped watching')
+        for listener in listeners:
+            listener.stop()
 
 
 def main():
+    if sys.argv[1:2] == ['watch']:
+        return watch_main(sys.argv[2:])
     opts = parse_opts()
 
-    configure_logging()
+    listeners = configure_logging(opts.high_volume, opts.file_log)
+    progress_interval = opts.progress_interval
+    if opts.high_volume and progress_interval is None:
+        progress_interval = HIGH_VOLUME_PROGRESS
 
     from .preparations import (InvalidFoldersException,
                                InvalidConfigException,
-                               start_backup)
+                               start_backup, start_backup_async)
 
     try:
         logger.info('Starting back-up at {}'.format(time.strftime('%c')),
                     extra={'msg_only': 1, 'color': 'y'})
-        start_backup(opts.source_root, opts.dest_root)
+        options = dict(change_detection=opts.change_detection,
+                       use_manifest=opts.manifest,
+                       verify_manifest=opts.verify_manifest,
+                       copy_workers=opts.copy_workers,
+                       scan_workers=opts.scan_workers,
+                       dry_run=opts.dry_run,
+                       plan_out=opts.plan_out,
+                       apply_plan=opts.apply_plan,
+                       apply_order=opts.apply_order,
+                       copy_backend=opts.copy_backend,
+                       dedup=opts.dedup,
+                       snapshots=opts.snapshot,
+                       keep_last=opts.keep_last,
+                       keep_daily=opts.keep_daily,
+                       keep_weekly=opts.keep_weekly,
+                       batch_small_files=opts.batch_small_files,
+                       fadvise=opts.fadvise,
+                       journal=opts.journal,
+                       detect_moves=opts.detect_moves,
+                       use_changes=opts.use_changes,
+                       use_summary=opts.use_summary,
+                       full_walk_hours=opts.full_walk_hours,
+                       verify=opts.verify,
+                       verify_repair=opts.verify_repair,
+                       stats_file=opts.stats_file,
+                       use_dir_fds=opts.dir_fds,
+                       concurrency=opts.concurrency,
+                       progress_interval=progress_interval)
+        if opts.concurrency is not None:
+            asyncio.run(start_backup_async(opts.source_root, opts.dest_root,
+                                           **options))
+        else:
+            start_backup(opts.source_root, opts.dest_root, **options)
         logger.info('Back-up complete, congratulations! :)', extra={'msg_only': 1, 'color': 'y'})
     except InvalidFoldersException as exc:
         logger.error('Unable to make a back-up. ' + str(exc))
     except InvalidConfigException as exc:
         logger.error('Unable to read the configuration. ',exc_info=True)
+    except InvalidPlanException as exc:
+        logger.error('Unable to apply the plan. ' + str(exc))
     except KeyboardInterrupt:
         logger.info('Aborting execution, incomplete back-up')
     except Exception as exc:
         logger.error('Unknown error occurred. ', exc_info=True)
         logger.error('Incomplete back-up')
+    finally:
+        for listener in listeners:
+            listener.stop()
@@ -0,0 +1,210 @@
+"""Persistent index of the contents of a back-up destination
+
+The manifest is a small SQLite database in the destination root.  It
+holds one row per file or directory with its relative path, type,
+size, modification time and optionally a content hash.  With the
+``use_manifest`` option incremental runs compare the source against
+the manifest instead of listing and stat'ing the destination, which is
+slow on network and USB disks.  With ``verify_manifest`` the manifest
+is first rebuilt from disk.
+
+The manifest is updated as copies and removals succeed.  A run marks
+it dirty when it starts and clean when it finishes, so a manifest left
+behind by an interrupted run is rebuilt from disk on the next run.
+
+"""
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from os import scandir
+from os.path import join, split
+from stat import S_IFDIR
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = '.bups.manifest'
+# The database and the rollback journal of SQLite
+MANIFEST_FILES = frozenset([MANIFEST_FILENAME, MANIFEST_FILENAME + '-journal'])
+
+# Rows are committed in batches of this size
+COMMIT_INTERVAL = 1000
+
+
+class ManifestStat(namedtuple('ManifestStat',
+                              ['st_mode', 'st_size', 'st_mtime', 'hash'])):
+    """The parts of a stat result the manifest remembers"""
+    __slots__ = ()
+
+
+ROOT_STAT = ManifestStat(S_IFDIR, 0, 0.0, None)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    item TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+CREATE INDEX IF NOT EXISTS entries_parent_name ON entries (parent, name);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class Manifest(object):
+    """Index of the files and directories in a back-up destination"""
+    def __init__(self, dest_root, skip=()):
+        """Open or create the manifest of ``dest_root``
+
+        ``skip`` is a collection of names in the destination root that
+        are not part of the back-up and never get to the manifest.  The
+        files of the manifest itself are always skipped.
+
+        """
+        self.dest_root = dest_root
+        self.skip = MANIFEST_FILES.union(skip)
+        self.lock = threading.Lock()
+        self._pending = 0
+        self.db = sqlite3.connect(join(dest_root, MANIFEST_FILENAME),
+                                  check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        self.was_clean = self._get_meta('clean') == '1'
+        self._set_meta('clean', '0')
+        self.db.commit()
+
+    def _get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, value))
+
+    def lookup(self, item):
+        """Stat of ``item`` as recorded, ``None`` if it is not there"""
+        if item == '':
+            return ROOT_STAT
+        with self.lock:
+            row = self.db.execute('SELECT mode, size, mtime, hash FROM '
+                                  'entries WHERE item = ?', (item,)).fetchone()
+        return None if row is None else ManifestStat(*row)
+
+    def children(self, item):
+        """Map names in directory ``item`` to their recorded stats"""
+        with self.lock:
+            rows = self.db.execute('SELECT name, mode, size, mtime, hash '
+                                   'FROM entries WHERE parent = ?',
+                                   (item,)).fetchall()
+        return {row[0]: ManifestStat(*row[1:]) for row in rows}
+
+    def iter_children(self, item, page_size=COMMIT_INTERVAL):
+        """Iterate over ``(name, stat)`` in directory ``item`` by name
+
+        The rows are read ``page_size`` at a time, so a huge directory
+        is not held in memory.
+
+        """
+        last = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute('SELECT name, mode, size, mtime, hash '
+                                       'FROM entries WHERE parent = ? AND '
+                                       'name > ? ORDER BY name LIMIT ?',
+                                       (item, last, page_size)).fetchall()
+            for row in rows:
+                yield row[0], ManifestStat(*row[1:])
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    def record(self, item, stat_result, hash=None):
+        """Store the stat of ``item`` after it was copied or created"""
+        parent, name = split(item)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES '
+                            '(?, ?, ?, ?, ?, ?, ?)',
+                            (item, parent, name, stat_result.st_mode,
+                             stat_result.st_size, stat_result.st_mtime, hash))
+            self._maybe_commit()
+
+    def discard(self, item):
+        """Forget ``item`` and everything below it"""
+        # '0' follows '/' in the collation, so the range holds all
+        # paths below the item
+        with self.lock:
+            self.db.execute('DELETE FROM entries WHERE item = ? OR '
+                            '(item > ? AND item < ?)',
+                            (item, item + '/', item + '0'))
+            self._maybe_commit()
+
+    def _maybe_commit(self):
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.db.commit()
+            self._pending = 0
+
+    def rebuild(self):
+        """Replace the contents of the manifest by walking the destination"""
+        logger.info('Rebuilding the manifest of {}'.format(self.dest_root))
+        with self.lock:
+            self.db.execute('DELETE FROM entries')
+            stack = ['']
+            while stack:
+                parent = stack.pop()
+                try:
+                    with scandir(join(self.dest_root, parent)) as entries:
+                        entries = list(entries)
+                except OSError:
+                    logger.error('Cannot list {} for the manifest'
+                                 ''.format(parent), exc_info=True)
+                    continue
+                for entry in entries:
+                    if parent == '' and entry.name in self.skip:
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    item = join(parent, entry.name)
+                    self.db.execute('INSERT INTO entries VALUES '
+                                    '(?, ?, ?, ?, ?, ?, NULL)',
+                                    (item, parent, entry.name, st.st_mode,
+                                     st.st_size, st.st_mtime))
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(item)
+            self.db.commit()
+            self._pending = 0
+
+    def close(self, clean=True):
+        """Commit and close, ``clean`` tells whether the run completed"""
+        with self.lock:
+            if clean:
+                self._set_meta('clean', '1')
+            self.db.commit()
+            self.db.close()
+
+
+def open_manifest(dest_root, skip=(), rebuild=False):
+    """Open the manifest of ``dest_root`` and bring it up to date
+
+    The manifest is rebuilt from disk when ``rebuild`` is true, when it
+    is new, or when the previous run did not finish.
+
+    """
+    manifest = Manifest(dest_root, skip)
+    if not manifest.was_clean and not rebuild:
+        logger.warning('The manifest in destination is missing or out of '
+                       'date, rebuilding it')
+        rebuild = True
+    if rebuild:
+        manifest.rebuild()
+    return manifest
@@ -0,0 +1,113 @@
+"""Compiled include and ignore patterns of the config
+
+Patterns without a ``/`` are matched against the base name of an
+entry, as they always have been.  Literal names go to a hash set and
+the remaining globs are combined into one regular expression.
+
+Patterns with a ``/`` are anchored to the back-up root and matched
+against the relative path of an entry.  In them ``*`` and ``?`` do not
+match ``/`` but ``**`` does, so ``build/**`` matches everything inside
+the top-level ``build`` directory.  Anchored patterns take precedence
+over base name patterns, and a directory whose whole contents are
+ignored by an anchored pattern is not listed at all.
+
+"""
+import fnmatch
+import re
+from os.path import basename
+
+
+_GLOB_CHARS = frozenset('*?[')
+
+
+def _translate(pattern):
+    """Regular expression of an anchored pattern"""
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+        i += 1
+        if c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                parts.append('\\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                if stuff.startswith('!'):
+                    stuff = '^' + stuff[1:]
+                parts.append('[' + stuff + ']')
+                i = j + 1
+        else:
+            parts.append(re.escape(c))
+    return '(?s:' + ''.join(parts) + r')\Z'
+
+
+def _compile(patterns, translate):
+    if not patterns:
+        return None
+    return re.compile('|'.join(translate(p) for p in patterns))
+
+
+class _PatternSet(object):
+    """Patterns of one list split by how they are matched"""
+    def __init__(self, patterns):
+        anchored = [p.lstrip('/') for p in patterns if '/' in p]
+        names = [p for p in patterns if '/' not in p]
+        self.literals = frozenset(p for p in names
+                                  if not _GLOB_CHARS.intersection(p))
+        self.globs = _compile([p for p in names if p not in self.literals],
+                              fnmatch.translate)
+        self.anchored = anchored
+        self.paths = _compile(anchored, _translate)
+
+    def match_name(self, name):
+        return (name in self.literals or
+                (self.globs is not None and
+                 self.globs.match(name) is not None))
+
+    def match_path(self, path):
+        return self.paths is not None and self.paths.match(path) is not None
+
+
+class Matcher(object):
+    """Decide which entries are included in the back-up"""
+    def __init__(self, include_list, ignore_list):
+        self.include = _PatternSet(include_list)
+        self.ignore = _PatternSet(ignore_list)
+        # Directories matching these have all their contents ignored
+        if self.include.anchored:
+            self.pruned = None
+        else:
+            self.pruned = _compile([p[:-3] for p in self.ignore.anchored
+                                    if p.endswith('/**')], _translate)
+
+    def check(self, path):
+        """Is the entry at ``path``, relative to the root, included"""
+        if self.include.match_path(path):
+            return True
+        if self.ignore.match_path(path):
+            return False
+        name = basename(path)
+        if self.include.match_name(name):
+            return True
+        if self.ignore.match_name(name):
+            return False
+        return True
+
+    def prunes(self, directory):
+        """Are all the contents of ``directory`` ignored"""
+        return (self.pruned is not None and
+                self.pruned.match(directory) is not None)
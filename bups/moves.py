@@ -0,0 +1,164 @@
+"""Detecting items moved or renamed in the source
+
+Without move detection a renamed directory looks like a new one: all
+of it is copied under the new name and the old one is removed.  With
+``detect_moves`` the obsolete items of the destination are kept in a
+:class:`MoveIndex` instead of being removed right away, and a new item
+of the source is first looked for among them.  If one is found, it is
+renamed in destination and the walk goes on as if the item had been
+there, so only the differences are copied.  The items that nothing was
+moved from are removed at the end of the run.
+
+Files of at least ``MIN_SIZE`` bytes are candidates for a new file of
+the same size, if their copy is not older than the source by the
+change detection strategy, see :mod:`bups.change_detection`.  Copies
+do not keep the modification time of the source, so the times cannot
+be required to be equal, and a move is confirmed by comparing the
+hashes of the files.  Directories are candidates for a new directory
+that shares at least half of the names of its entries.
+
+An item is found only if it was made obsolete before the new item is
+walked.  That is always the case for a rename in the same directory.
+A move across directories is found if the directory it was moved from
+is walked first, and never from a directory that is removed as a
+whole.
+
+"""
+import logging
+import os
+import threading
+from collections import defaultdict
+from itertools import islice
+from stat import S_ISDIR, S_ISREG
+from .change_detection import get_strategy
+from .dedup import hash_file
+
+
+logger = logging.getLogger(__name__)
+
+# Smaller files are copied rather than hashed and renamed
+MIN_SIZE = 64 * 1024
+
+# Names compared per directory, and the share of them in common
+MAX_NAMES = 1000
+MIN_SHARED = 0.5
+
+
+def _names(path):
+    try:
+        with os.scandir(path) as entries:
+            return frozenset(entry.name
+                             for entry in islice(entries, MAX_NAMES))
+    except OSError:
+        return frozenset()
+
+
+def _similar(names, other_names):
+    if not names or not other_names:
+        return False
+    return len(names & other_names) >= MIN_SHARED * len(names | other_names)
+
+
+class MoveIndex(object):
+    """Obsolete items of the destination that may have been moved"""
+    def __init__(self, change_detection=None):
+        self.strategy = get_strategy(change_detection)
+        self.lock = threading.Lock()
+        # Candidate files by size and directories with their names
+        self.files = defaultdict(list)
+        self.directories = []
+        self.deferred = {}
+
+    def add(self, node):
+        """Keep an obsolete node for later, ``False`` if not a candidate"""
+        dest_stat = node.dest_stat
+        if dest_stat is None:
+            return False
+        if S_ISDIR(dest_stat.st_mode):
+            names = _names(node.dest_item)
+            with self.lock:
+                self.directories.append((node, names))
+                self.deferred[id(node)] = node
+            return True
+        if S_ISREG(dest_stat.st_mode) and dest_stat.st_size >= MIN_SIZE:
+            with self.lock:
+                self.files[dest_stat.st_size].append(node)
+                self.deferred[id(node)] = node
+            return True
+        return False
+
+    def claim(self, node):
+        """Move an obsolete item to the new item ``node`` if it matches
+
+        Returns ``True`` if the item was renamed in destination.
+
+        """
+        source_stat = node.source_stat
+        if source_stat is None:
+            return False
+        if S_ISDIR(source_stat.st_mode):
+            candidate = self._take_directory(node)
+        elif S_ISREG(source_stat.st_mode) and source_stat.st_size >= MIN_SIZE:
+            candidate = self._take_file(node)
+        else:
+            return False
+        if candidate is None:
+            return False
+        if not node.move_from(candidate):
+            return False
+        with self.lock:
+            del self.deferred[id(candidate)]
+        return True
+
+    def _take_directory(self, node):
+        with self.lock:
+            if not self.directories:
+                return None
+        names = _names(node.source_item)
+        with self.lock:
+            for i, (candidate, candidate_names) in enumerate(
+                    self.directories):
+                if _similar(names, candidate_names):
+                    del self.directories[i]
+                    return candidate
+        return None
+
+    def _take_file(self, node):
+        source_stat = node.source_stat
+        with self.lock:
+            candidates = [candidate for candidate
+                          in self.files.get(source_stat.st_size, [])
+                          if not self.strategy(source_stat,
+                                               candidate.dest_stat)]
+        if not candidates:
+            return None
+        try:
+            digest = hash_file(node.source_item)
+        except OSError:
+            return None
+        node.stats.count('move_candidates', len(candidates))
+        for candidate in candidates:
+            with self.lock:
+                same_size = self.files[source_stat.st_size]
+                if candidate not in same_size:
+                    # Another thread took it meanwhile
+                    continue
+                same_size.remove(candidate)
+            try:
+                if hash_file(candidate.dest_item) == digest:
+                    return candidate
+            except OSError:
+                pass
+            with self.lock:
+                same_size.append(candidate)
+        return None
+
+    def finish(self):
+        """Remove the obsolete items that were not moved"""
+        with self.lock:
+            nodes = list(self.deferred.values())
+            self.deferred.clear()
+            self.files.clear()
+            del self.directories[:]
+        for node in nodes:
+            node.remove()
@@ -0,0 +1,158 @@
+"""Back-up plans: the operations of a run, decided before doing them
+
+With the ``dry_run`` or ``plan_out`` option the tree walk does not
+touch the destination.  Every directory it would make, file it would
+copy and item it would remove is written as one JSON line into the
+plan file ``plan_out``, followed by the totals.  The plan can be
+inspected, and later executed with the ``apply_plan`` option, see
+:func:`apply_plan`, reordered by ``apply_order`` for better locality
+on the destination disk.
+
+"""
+import json
+import logging
+import threading
+from os import stat
+from os.path import dirname, basename, join
+from .backup_loop import remove_later
+
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+APPLY_ORDERS = ['walk', 'path', 'inode']
+
+
+class InvalidPlanException(ValueError):
+    """Raised when a plan file cannot be applied"""
+    pass
+
+
+class PlanWriter(object):
+    """Collect the operations of a run and stream them into a file"""
+    def __init__(self, source_root, dest_root, stream=None):
+        """``stream`` is a text file, with ``None`` only totals are kept"""
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.totals = dict(mkdir=0, copy=0, copy_bytes=0,
+                           remove=0, remove_bytes=0)
+        self._write(dict(bups_plan=PLAN_VERSION, source_root=source_root,
+                         dest_root=dest_root))
+
+    def _write(self, record):
+        if self.stream is not None:
+            self.stream.write(json.dumps(record) + '\n')
+
+    def mkdir(self, item):
+        with self.lock:
+            self.totals['mkdir'] += 1
+            self._write(dict(op='mkdir', item=item))
+
+    def copy(self, item, size):
+        with self.lock:
+            self.totals['copy'] += 1
+            self.totals['copy_bytes'] += size
+            self._write(dict(op='copy', item=item, size=size))
+
+    def remove(self, item, size, later=False):
+        """Plan a removal, ``later`` ones are done after all copies
+
+        Removals that are not ``later`` make way for a directory or a
+        file that replaces the item, and are done in order.
+
+        """
+        with self.lock:
+            self.totals['remove'] += 1
+            self.totals['remove_bytes'] += size
+            record = dict(op='remove', item=item, size=size)
+            if later:
+                record['later'] = True
+            self._write(record)
+
+    def close(self):
+        """Write the totals and log a summary"""
+        with self.lock:
+            self._write(dict(totals=self.totals))
+        logger.info('Plan: make {mkdir} directories, copy {copy} files '
+                    '({copy_bytes} bytes), remove {remove} items'
+                    ''.format(**self.totals), extra={'color': 'g'})
+
+
+def read_plan(stream):
+    """Return the header and an iterator over the operations of a plan"""
+    try:
+        header = json.loads(stream.readline())
+        if header.get('bups_plan') != PLAN_VERSION:
+            raise InvalidPlanException('Unsupported plan version')
+    except (ValueError, AttributeError):
+        raise InvalidPlanException('Not a plan file')
+
+    def operations():
+        for line in stream:
+            record = json.loads(line)
+            if 'op' in record:
+                yield record
+
+    return header, operations()
+
+
+def _inode_key(dest_root):
+    """Sort copies by the inode of the destination directory, then name"""
+    inodes = {}
+
+    def key(item):
+        parent = dirname(item)
+        if parent not in inodes:
+            try:
+                inodes[parent] = stat(join(dest_root, parent)).st_ino
+            except OSError:
+                inodes[parent] = 0
+        return inodes[parent], basename(item)
+
+    return key
+
+
+def apply_plan(stream, root_node, order='walk'):
+    """Execute the operations of a plan read from ``stream``
+
+    Directories are made and replaced items removed in the order they
+    were planned, files are copied in the given ``order``, and finally
+    obsolete items are removed.  ``root_node`` is the node of the
+    back-up root, whose roots must be the ones the plan was made for.
+
+    """
+    header, operations = read_plan(stream)
+    if (header.get('source_root') != root_node.source_root or
+            header.get('dest_root') != root_node.dest_root):
+        raise InvalidPlanException('The plan was made for {} -> {}'
+                                   ''.format(header.get('source_root'),
+                                             header.get('dest_root')))
+    if order not in APPLY_ORDERS:
+        raise InvalidPlanException('Unknown order {!r}'.format(order))
+
+    copies = []
+    removals = []
+    for operation in operations:
+        node = root_node.join_item(operation['item'])
+        if operation['op'] == 'mkdir':
+            node.create_folder()
+        elif operation['op'] == 'copy':
+            if order == 'walk':
+                node.copy()
+            else:
+                copies.append(operation['item'])
+        elif operation['op'] == 'remove':
+            if operation.get('later'):
+                removals.append(node)
+            else:
+                node.remove()
+
+    if order == 'path':
+        copies.sort()
+    elif order == 'inode':
+        copies.sort(key=_inode_key(root_node.dest_root))
+    for item in copies:
+        root_node.join_item(item).copy()
+    for node in removals:
+        remove_later(node)
@@ -1,10 +1,30 @@
+import asyncio
+import functools
 import yaml
 import logging
+import shutil
 import sys
 from datetime import datetime
 from os import mkdir, remove, listdir
 from os.path import exists, join, basename, isdir, abspath, islink, realpath
-from .backup_loop import make_backup, BackupNode
+from .backup_loop import (make_backup, BackupNode, INTERNAL_NAMES,
+                          include_entry)
+from .manifest import open_manifest
+from .copy_pool import CopyPool
+from .plan import PlanWriter, apply_plan, APPLY_ORDERS
+from .copying import BACKEND_NAMES
+from .dedup import ContentStore
+from .change_detection import get_strategy
+from .snapshots import start_snapshot, finish_snapshot, prune_snapshots
+from .stats import Stats, ProgressReporter, SLOWEST_FILES
+from .fsio import DirectoryFds, MAX_OPEN, supported as dir_fds_supported
+from .async_engine import backup_async
+from .verify import verify_backup
+from .moves import MoveIndex
+from .journal import Journal, discard_journal
+from .changes import ChangeLog, FULL_WALK_HOURS
+from .summary import TreeSummary
+from .context import RunContext
 
 
 logger = logging.getLogger(__name__)
@@ -26,7 +46,45 @@ class InvalidFoldersException(ValueError):
     pass
 
 
-def start_backup(source_root, dest_root):
+def start_backup(source_root, dest_root, **options):
+    """Back-up ``source_root`` into ``dest_root``
+
+    Keyword arguments override the options of the config file, unless
+    they are ``None``.  Each option is described in the module that
+    implements it, see :mod:`bups.context`.  Returns the
+    :class:`bups.stats.Stats` of the run.
+
+    """
+    source_root, dest_root, config = _prepare(source_root, dest_root,
+                                              options)
+    return _run_backup(source_root, dest_root, config)
+
+
+async def start_backup_async(source_root, dest_root, **options):
+    """Back-up like :func:`start_backup` in an asyncio event loop
+
+    The tree is walked with up to ``concurrency`` file system calls in
+    flight, see :mod:`bups.async_engine`.  The preparations run in a
+    thread of the default executor of the loop.
+
+    """
+    loop = asyncio.get_running_loop()
+    source_root, dest_root, config = await loop.run_in_executor(
+        None, _prepare, source_root, dest_root, options)
+    # The asyncio walk is used even without the concurrency option
+    _validate_async(config)
+
+    def walk(root):
+        asyncio.run_coroutine_threadsafe(
+            backup_async(root, config.get('concurrency')), loop).result()
+
+    return await loop.run_in_executor(
+        None, functools.partial(_run_backup, source_root, dest_root, config,
+                                walk))
+
+
+def _prepare(source_root, dest_root, options):
+    """Check the roots and read the config, merged with ``options``"""
     source_root, dest_root = _make_absolute(source_root, dest_root)
     _validate_root_folders(source_root, dest_root)
     dest_root = _prepare_dest(source_root, dest_root)
@@ -48,8 +106,152 @@ def start_backup(source_root, dest_root):
             msg = 'The config file in destination refers to another source.'
             raise InvalidFoldersException(msg)
 
+    config.update((key, value) for key, value in options.items()
+                  if value is not None)
+    validate_config(config)
+
+    return source_root, dest_root, config
+
+
+def prepare_watch(source_root, dest_root):
+    """Check the roots for ``bups watch`` and read the config
+
+    The source must have been backed up into the destination before.
+    Returns the roots and the config.
+
+    """
+    source_root, dest_root = _make_absolute(source_root, dest_root)
+    _validate_root_folders(source_root, dest_root)
+    dest_root = _prepare_dest(source_root, dest_root)
+    config = read_config(source_root)
+    config_dest = read_config(dest_root)
+    if config is None or config_dest is None:
+        raise InvalidFoldersException('Make a back-up before watching the '
+                                      'source.')
+    if config['id_string'] != config_dest['id_string']:
+        msg = 'The config file in destination refers to another source.'
+        raise InvalidFoldersException(msg)
+    return source_root, dest_root, config
+
+
+def _run_backup(source_root, dest_root, config, walk=make_backup):
+    """Set up what the options of ``config`` ask for and walk the tree
+
+    The objects made from the options are kept in a
+    :class:`bups.context.RunContext`, apart from the options.  The tree
+    of the root node is backed up by ``walk(root)``.
+
+    """
+    dry_run = bool(config.get('dry_run') or config.get('plan_out'))
+    run = RunContext(Stats(config.get('stats_slowest', SLOWEST_FILES)))
+    stats = run.stats
+
+    if config.get('use_manifest') or config.get('verify_manifest'):
+        run.manifest = open_manifest(dest_root, INTERNAL_NAMES,
+                                     rebuild=config.get('verify_manifest'))
+
+    if config.get('dedup') and not dry_run:
+        run.content_store = ContentStore(dest_root)
+
+    plan_file = None
+    if dry_run:
+        if config.get('plan_out'):
+            plan_file = open(config['plan_out'], 'w')
+        run.plan = PlanWriter(source_root, dest_root, plan_file)
+
+    if config.get('use_dir_fds'):
+        if dir_fds_supported():
+            run.dir_fds = DirectoryFds(config.get('max_dir_fds', MAX_OPEN))
+        else:
+            logger.warning('Directory file descriptors are not supported '
+                           'on this platform, using paths')
+
+    if config.get('detect_moves') and not dry_run:
+        run.moves = MoveIndex(config.get('change_detection'))
+
+    if config.get('copy_workers') and not dry_run:
+        run.copy_pool = CopyPool(config['copy_workers'],
+                                 config.get('copy_queue_size'))
+
+    snapshot = None
+    if config.get('snapshots'):
+        snapshot, run.link_dest = start_snapshot(dest_root)
+        root = BackupNode(source_root, snapshot, '', config, run=run)
+    else:
+        root = BackupNode(source_root, dest_root, '', config, run=run)
+    if config.get('journal') and not dry_run:
+        run.journal = Journal(dest_root, stats)
+    elif not dry_run:
+        discard_journal(dest_root, stats)
+    change_log = None
+    if config.get('use_changes') and not dry_run:
+        change_log = ChangeLog(dest_root, config.get('full_walk_hours',
+                                                     FULL_WALK_HOURS))
+    if config.get('use_summary') and not dry_run:
+        run.summary = TreeSummary(dest_root, config,
+                                  config.get('full_walk_hours',
+                                             FULL_WALK_HOURS))
+    progress = None
+    if config.get('progress_interval'):
+        progress = ProgressReporter(stats, config['progress_interval'])
     logger.info('Starting to make a back-up')
-    make_backup(BackupNode(source_root, dest_root, '', config))
+    completed = False
+    try:
+        if change_log is not None:
+            run.changes = change_log.take()
+        if config.get('apply_plan'):
+            with open(config['apply_plan']) as f:
+                apply_plan(f, root, config.get('apply_order', 'walk'))
+        else:
+            walk(root)
+        if run.copy_pool is not None:
+            run.copy_pool.finish()
+        if run.moves is not None:
+            run.moves.finish()
+        if config.get('verify') or config.get('verify_repair'):
+            verify_backup(source_root, dest_root, root.dest_root, config,
+                          run, functools.partial(include_entry,
+                                                 config=config))
+        if run.plan is not None:
+            run.plan.close()
+        if snapshot is not None:
+            _finish_snapshot(source_root, dest_root, snapshot, config)
+        if run.content_store is not None and config.get('dedup_prune'):
+            run.content_store.prune()
+        completed = True
+        stats.log_summary()
+        return stats
+    finally:
+        if run.copy_pool is not None and not completed:
+            run.copy_pool.finish(cancel=True)
+        if progress is not None:
+            progress.stop()
+        if config.get('stats_file'):
+            stats.write_report(config['stats_file'])
+        if plan_file is not None:
+            plan_file.close()
+        if run.content_store is not None:
+            run.content_store.close()
+        if run.dir_fds is not None:
+            run.dir_fds.close()
+        if run.journal is not None:
+            run.journal.close(complete=completed)
+        if change_log is not None:
+            change_log.finish(stats, completed,
+                              full_walk=run.changes is None)
+        if run.summary is not None:
+            run.summary.close(stats, completed)
+        if run.manifest is not None:
+            run.manifest.close(clean=completed)
+
+
+def _finish_snapshot(source_root, dest_root, snapshot, config):
+    finish_snapshot(snapshot)
+    # The snapshots are not in the destination root, but the config is
+    shutil.copy(join(source_root, CONFIG_FILENAME),
+                join(dest_root, CONFIG_FILENAME))
+    prune_snapshots(dest_root, config.get('keep_last'),
+                    config.get('keep_daily'), config.get('keep_weekly'))
 
 
 def _make_absolute(source_root, dest_root):
@@ -182,6 +384,66 @@ def validate_config(config):
         'ignore_list' not in config or
         'id_string' not in config):
         raise InvalidConfigException('Invalid config file')
+    try:
+        get_strategy(config.get('change_detection'))
+    except ValueError as exc:
+        raise InvalidConfigException(str(exc))
+    if config.get('apply_plan') and (config.get('dry_run') or
+                                     config.get('plan_out')):
+        raise InvalidConfigException('A plan cannot be applied in a dry run')
+    if config.get('apply_order', 'walk') not in APPLY_ORDERS:
+        raise InvalidConfigException('Unknown order for applying a plan')
+    if config.get('copy_backend', 'auto') not in BACKEND_NAMES:
+        raise InvalidConfigException('Unknown copy backend')
+    for key in ['delta_threshold', 'delta_block_size']:
+        value = config.get(key)
+        if value is not None and (not isinstance(value, int) or value <= 0):
+            raise InvalidConfigException('{} must be a positive number of '
+                                         'bytes'.format(key))
+    if config.get('snapshots'):
+        if any(config.get(key) for key in ['use_manifest', 'verify_manifest',
+                                           'dry_run', 'plan_out',
+                                           'apply_plan']):
+            raise InvalidConfigException('Snapshots cannot be made with a '
+                                         'manifest or a plan')
+    if config.get('detect_moves') and (config.get('use_manifest') or
+                                       config.get('verify_manifest')):
+        raise InvalidConfigException('Moves cannot be detected with a '
+                                     'manifest')
+    if ((config.get('verify') or config.get('verify_repair')) and
+            (config.get('dry_run') or config.get('plan_out'))):
+        raise InvalidConfigException('A dry run cannot be verified')
+    if config.get('concurrency'):
+        _validate_async(config)
+    if config.get('journal') and any(
+            config.get(key) for key in ['snapshots', 'dry_run', 'plan_out',
+                                        'apply_plan']):
+        raise InvalidConfigException('A journal cannot be kept for '
+                                     'snapshots or plans')
+    if (config.get('use_changes') or config.get('use_summary')) and any(
+            config.get(key) for key in ['snapshots', 'dry_run', 'plan_out',
+                                        'apply_plan']):
+        raise InvalidConfigException('A change log or a summary cannot be '
+                                     'used for snapshots or plans')
+    for key in ['keep_last', 'keep_daily', 'keep_weekly',
+                'progress_interval', 'max_dir_fds', 'concurrency',
+                'verify_workers', 'hash_cache_days', 'small_file_size',
+                'full_walk_hours']:
+        value = config.get(key)
+        if value is not None and (not isinstance(value, int) or value <= 0):
+            raise InvalidConfigException('{} must be a positive number'
+                                         ''.format(key))
+
+
+def _validate_async(config):
+    """Check that the config can be backed up in an asyncio walk"""
+    # The entries are copied in other threads than they are listed
+    if config.get('batch_small_files'):
+        raise InvalidConfigException('Small files cannot be batched in an '
+                                     'asyncio walk')
+    if config.get('journal'):
+        raise InvalidConfigException('A journal cannot be kept for an '
+                                     'asyncio walk')
 
 
 # This is roughly copied from http://code.activestate.com/recipes/577058-query-yesno/
@@ -0,0 +1,148 @@
+"""Schedulers for the directories that the tree walk has to match
+
+Instead of recursing into a directory, the walk hands it to the
+scanner of the current thread, which matches it later.  This keeps the
+depth of the Python stack constant however deep the tree is.
+
+:class:`SequentialScanner` matches one directory at a time.
+:class:`ParallelScanner` lists independent subtrees in
+``scan_workers`` threads, when that option is greater than one, with
+work stealing: every worker pushes the directories it finds to
+its own deque and takes the newest one from there, and an idle worker
+steals the oldest, usually largest, subtree from another worker.
+An unexpected error in matching a directory stops the walk, in the
+parallel scanner too, and is raised from ``run``.
+
+"""
+import collections
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def current_scanner():
+    """The scanner running in this thread, ``None`` outside of a walk"""
+    return getattr(_local, 'scanner', None)
+
+
+def set_current_scanner(scanner):
+    """Make ``scanner`` the one of this thread, e.g., in a thread pool"""
+    _local.scanner = scanner
+
+
+def make_scanner(workers=None):
+    if workers is not None and workers > 1:
+        return ParallelScanner(workers)
+    return SequentialScanner()
+
+
+class SequentialScanner(object):
+    """Match the scheduled directories one by one in this thread"""
+    def __init__(self):
+        self.stack = []
+
+    def schedule(self, node):
+        self.stack.append(node)
+
+    def run(self, start, visit):
+        """Call ``start()`` and then ``visit(node)`` for scheduled nodes"""
+        _local.scanner = self
+        try:
+            start()
+            while self.stack:
+                visit(self.stack.pop())
+        finally:
+            _local.scanner = None
+
+
+class ParallelScanner(object):
+    """Match the scheduled directories in several threads"""
+    def __init__(self, workers):
+        self.workers = workers
+        self.deques = [collections.deque() for _ in range(workers)]
+        self.condition = threading.Condition()
+        # Scheduled directories that have not been matched yet
+        self.pending = 0
+        self.cancelled = False
+        # The first unexpected error of a worker, raised from run()
+        self.error = None
+
+    def schedule(self, node):
+        with self.condition:
+            self.deques[_local.worker].append(node)
+            self.pending += 1
+            self.condition.notify()
+
+    def _next(self, worker):
+        """Next directory for ``worker``, ``None`` when the walk is over"""
+        with self.condition:
+            while not self.cancelled:
+                if self.deques[worker]:
+                    return self.deques[worker].pop()
+                for other in self.deques:
+                    if other:
+                        return other.popleft()
+                if self.pending == 0:
+                    return None
+                self.condition.wait()
+            return None
+
+    def _done(self):
+        with self.condition:
+            self.pending -= 1
+            if self.pending == 0:
+                self.condition.notify_all()
+
+    def _work(self, worker, visit):
+        _local.scanner = self
+        _local.worker = worker
+        try:
+            while True:
+                node = self._next(worker)
+                if node is None:
+                    return
+                try:
+                    visit(node)
+                except Exception as exc:
+                    logger.error('Unexpected error in matching {}'
+                                 ''.format(node), exc_info=True)
+                    with self.condition:
+                        if self.error is None:
+                            self.error = exc
+                        self.cancelled = True
+                        self.condition.notify_all()
+                finally:
+                    self._done()
+        finally:
+            _local.scanner = None
+
+    def run(self, start, visit):
+        """Call ``start()`` and then ``visit(node)`` for scheduled nodes
+
+        The calling thread works as one of the workers.
+
+        """
+        threads = [threading.Thread(target=self._work, args=(i, visit),
+                                    name='bups-scan-{}'.format(i),
+                                    daemon=True)
+                   for i in range(1, self.workers)]
+        _local.scanner = self
+        _local.worker = 0
+        try:
+            start()
+            for thread in threads:
+                thread.start()
+            self._work(0, visit)
+        finally:
+            with self.condition:
+                self.cancelled = self.pending > 0
+                self.condition.notify_all()
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+        if self.error is not None:
+            raise self.error
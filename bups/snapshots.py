@@ -0,0 +1,125 @@
+"""Versioned back-ups as a series of hard linked snapshot trees
+
+With the ``snapshots`` option every run makes a new tree under
+``.bups.snapshots`` in the destination root, named by the time of the
+run.  Files that have not changed since the previous snapshot are hard
+linked from it, so a snapshot only costs the changed files and the
+directories.  A snapshot is built under a ``.partial`` name and renamed
+when the run completes, and ``latest`` links to the newest one.
+
+Old snapshots are removed according to the ``keep_last``,
+``keep_daily`` and ``keep_weekly`` options: the newest snapshots, the
+newest snapshot of each of the latest days and the newest snapshot of
+each of the latest weeks are kept.  Without any of them all snapshots
+are kept.
+
+"""
+import logging
+import os
+import shutil
+from datetime import datetime
+from os.path import join, exists, islink
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOTS_DIRNAME = '.bups.snapshots'
+LATEST = 'latest'
+PARTIAL_SUFFIX = '.partial'
+NAME_FORMAT = '%Y-%m-%dT%H%M%S'
+
+
+def snapshot_time(name):
+    """Time of a snapshot from its name, ``None`` if not a snapshot"""
+    try:
+        return datetime.strptime(name[:17], NAME_FORMAT)
+    except ValueError:
+        return None
+
+
+def list_snapshots(snapshots_root):
+    """Names of the complete snapshots, oldest first"""
+    if not exists(snapshots_root):
+        return []
+    names = [name for name in os.listdir(snapshots_root)
+             if not name.endswith(PARTIAL_SUFFIX) and
+             snapshot_time(name) is not None]
+    return sorted(names)
+
+
+def start_snapshot(dest_root, now=None):
+    """Make the directory of a new snapshot
+
+    Returns the path of the new, still partial, snapshot and the path
+    of the previous complete snapshot or ``None``.  Partial snapshots
+    left by interrupted runs are removed.
+
+    """
+    snapshots_root = join(dest_root, SNAPSHOTS_DIRNAME)
+    if not exists(snapshots_root):
+        os.mkdir(snapshots_root)
+    for name in os.listdir(snapshots_root):
+        if name.endswith(PARTIAL_SUFFIX):
+            logger.info('Removing incomplete snapshot {}'.format(name))
+            shutil.rmtree(join(snapshots_root, name))
+
+    names = list_snapshots(snapshots_root)
+    previous = join(snapshots_root, names[-1]) if names else None
+
+    name = (now or datetime.now()).strftime(NAME_FORMAT)
+    n = 0
+    while name in names:
+        n += 1
+        name = '{}-{}'.format(name[:17], n)
+    partial = join(snapshots_root, name + PARTIAL_SUFFIX)
+    os.mkdir(partial)
+    return partial, previous
+
+
+def finish_snapshot(partial):
+    """Give a complete snapshot its final name and point ``latest`` to it"""
+    final = partial[:-len(PARTIAL_SUFFIX)]
+    os.rename(partial, final)
+    snapshots_root, name = os.path.split(final)
+    latest = join(snapshots_root, LATEST)
+    temporary = latest + PARTIAL_SUFFIX
+    if islink(temporary):
+        os.remove(temporary)
+    os.symlink(name, temporary)
+    os.replace(temporary, latest)
+    logger.info('Snapshot {} complete'.format(name))
+    return final
+
+
+def select_retained(names, keep_last=None, keep_daily=None,
+                    keep_weekly=None):
+    """The snapshot names that the retention policy keeps"""
+    if keep_last is None and keep_daily is None and keep_weekly is None:
+        return set(names)
+    newest_first = sorted(names, reverse=True)
+    retained = set(newest_first[:max(keep_last or 0, 1)])
+    for count, period in [(keep_daily, lambda t: t.date()),
+                          (keep_weekly, lambda t: t.isocalendar()[:2])]:
+        if not count:
+            continue
+        periods = set()
+        for name in newest_first:
+            key = period(snapshot_time(name))
+            if key not in periods:
+                if len(periods) == count:
+                    break
+                periods.add(key)
+                retained.add(name)
+    return retained
+
+
+def prune_snapshots(dest_root, keep_last=None, keep_daily=None,
+                    keep_weekly=None):
+    """Remove the snapshots that the retention policy does not keep"""
+    snapshots_root = join(dest_root, SNAPSHOTS_DIRNAME)
+    names = list_snapshots(snapshots_root)
+    retained = select_retained(names, keep_last, keep_daily, keep_weekly)
+    for name in names:
+        if name not in retained:
+            logger.info('Removing old snapshot {}'.format(name))
+            shutil.rmtree(join(snapshots_root, name))
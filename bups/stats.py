@@ -0,0 +1,226 @@
+"""Statistics of a back-up run
+
+A :class:`Stats` collector is kept in the
+:class:`bups.context.RunContext` of a run as ``stats``.  It counts the
+entries scanned, the files and bytes copied, the items removed and the
+file system calls made by the walk, and sums the time spent in each
+phase:
+
+``walk``
+    listing directories on both sides
+``compare``
+    deciding which entries differ
+``copy``
+    copying, linking and updating files
+``remove``
+    removing obsolete items
+``verify``
+    hashing files to verify the back-up
+
+The phase times are summed over all threads, so with worker threads
+they can exceed the wall clock time.  The latencies of listing single
+directories are kept in a histogram and the ``stats_slowest`` slowest
+copies in a short list, and the peak resident memory of the process
+is reported where the platform tells it.  :meth:`Stats.report` gives
+all of it as a dictionary, which is written as JSON with the
+``stats_file`` option, and :class:`ProgressReporter` logs a progress
+line every ``progress_interval`` seconds.
+
+"""
+import heapq
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+PHASES = ['walk', 'compare', 'copy', 'remove', 'verify']
+
+# Upper bounds of the buckets of the scan latency histogram in seconds
+LATENCY_BUCKETS = [0.001, 0.01, 0.1, 1.0, 10.0]
+
+SLOWEST_FILES = 10
+
+# At most this many failed or mismatched items are listed in the report
+MAX_ERROR_ITEMS = 100
+
+
+def _bucket_label(i):
+    if i == len(LATENCY_BUCKETS):
+        return '>={:g}s'.format(LATENCY_BUCKETS[-1])
+    return '<{:g}s'.format(LATENCY_BUCKETS[i])
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or ``None``"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Stats(object):
+    """Thread safe counters and timers of one run"""
+    def __init__(self, slowest=SLOWEST_FILES):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = Counter()
+        self.syscalls = Counter()
+        self.copy_backends = Counter()
+        self.delta_bytes = Counter()
+        self.phase_times = Counter()
+        self.scan_latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.error_items = []
+        self.mismatched_items = []
+        self._slowest = []
+        self._slowest_size = slowest
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def syscall(self, name, n=1):
+        with self.lock:
+            self.syscalls[name] += n
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phase_times[phase] += seconds
+
+    @contextmanager
+    def timer(self, phase):
+        """Add the time spent in the ``with`` block to ``phase``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def scanned(self, seconds, entries):
+        """Record listing one directory with ``entries`` entries"""
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds >= LATENCY_BUCKETS[i]:
+            i += 1
+        with self.lock:
+            self.phase_times['walk'] += seconds
+            self.counts['directories_scanned'] += 1
+            self.counts['entries_scanned'] += entries
+            self.scan_latency[i] += 1
+
+    def copied(self, item, size, backend, seconds):
+        with self.lock:
+            self.phase_times['copy'] += seconds
+            self.counts['files_copied'] += 1
+            self.counts['bytes_copied'] += size
+            self.copy_backends[backend] += 1
+            record = (seconds, item)
+            if len(self._slowest) < self._slowest_size:
+                heapq.heappush(self._slowest, record)
+            elif self._slowest and record > self._slowest[0]:
+                heapq.heapreplace(self._slowest, record)
+
+    def delta(self, bytes_read, bytes_written):
+        with self.lock:
+            self.delta_bytes['read'] += bytes_read
+            self.delta_bytes['written'] += bytes_written
+
+    def error(self, item):
+        with self.lock:
+            self.counts['errors'] += 1
+            if len(self.error_items) < MAX_ERROR_ITEMS:
+                self.error_items.append(item)
+
+    def mismatch(self, item):
+        """Record a file whose back-up differs from the source"""
+        with self.lock:
+            self.counts['mismatches'] += 1
+            if len(self.mismatched_items) < MAX_ERROR_ITEMS:
+                self.mismatched_items.append(item)
+
+    @property
+    def slowest(self):
+        """The slowest copies as ``(seconds, item)``, slowest first"""
+        with self.lock:
+            return sorted(self._slowest, reverse=True)
+
+    def report(self):
+        """All statistics as a dictionary that can be dumped as JSON"""
+        elapsed = time.time() - self.started
+        slowest = self.slowest
+        with self.lock:
+            counts = dict(self.counts)
+            files = counts.get('entries_scanned', 0)
+            return dict(
+                elapsed=elapsed,
+                peak_rss_bytes=peak_rss(),
+                counts=counts,
+                syscalls=dict(self.syscalls),
+                syscalls_per_entry=(sum(self.syscalls.values()) / files
+                                    if files else 0),
+                phase_times={phase: self.phase_times[phase]
+                             for phase in PHASES},
+                copy_backends=dict(self.copy_backends),
+                delta_bytes=dict(self.delta_bytes),
+                scan_latency={_bucket_label(i): n for i, n
+                              in enumerate(self.scan_latency)},
+                slowest_files=[dict(item=item, seconds=seconds)
+                               for seconds, item in slowest],
+                error_items=list(self.error_items),
+                mismatched_items=list(self.mismatched_items))
+
+    def progress_line(self):
+        with self.lock:
+            counts = Counter(self.counts)
+        return ('{:.0f} s: scanned {} entries in {} directories, copied {} '
+                'files ({} bytes), removed {}, errors {}'
+                ''.format(time.time() - self.started,
+                          counts['entries_scanned'],
+                          counts['directories_scanned'],
+                          counts['files_copied'], counts['bytes_copied'],
+                          counts['removed'], counts['errors']))
+
+    def log_summary(self):
+        """Log the totals of the run"""
+        logger.info(self.progress_line(), extra={'color': 'g'})
+        if self.copy_backends:
+            logger.info('Files copied with ' + ', '.join(
+                '{} {}'.format(backend, count)
+                for backend, count in sorted(self.copy_backends.items())))
+        if self.delta_bytes:
+            logger.info('Delta updates read {read} and wrote {written} bytes'
+                        ''.format(**self.delta_bytes))
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write('\n')
+
+
+class ProgressReporter(object):
+    """Log the progress line of ``stats`` every ``interval`` seconds"""
+    def __init__(self, stats, interval):
+        self.stats = stats
+        self.interval = interval
+        self._stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       name='bups-progress', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            logger.info(self.stats.progress_line())
+
+    def stop(self):
+        self._stopped.set()
+        self.thread.join()
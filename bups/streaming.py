@@ -0,0 +1,115 @@
+"""Listing and pairing huge directories in bounded memory
+
+Directories up to ``stream_threshold`` entries are listed into memory
+and paired by name in a dictionary.  Beyond that only their names are
+kept, sorted in chunks of ``stream_threshold`` names that are written
+into temporary files, like in an external merge sort.  Both sides are
+then read back as one sorted stream each and merged, so a directory of
+any width costs one chunk of memory.  The temporary files are made in
+``spill_dir``, by default in the temporary directory of the system.
+
+Names are sorted as bytes, as they are on disk, and written separated
+by null bytes, which no file name can contain.
+
+"""
+import heapq
+import itertools
+import os
+import tempfile
+
+
+STREAM_THRESHOLD = 100000
+
+_SEPARATOR = b'\0'
+_READ_SIZE = 64 * 1024
+
+
+def _read_names(f):
+    """Iterate over the names of a chunk file"""
+    rest = b''
+    for block in iter(lambda: f.read(_READ_SIZE), b''):
+        names = (rest + block).split(_SEPARATOR)
+        rest = names.pop()
+        yield from names
+
+
+class SpilledNames(object):
+    """Names of a directory sorted into temporary files"""
+    def __init__(self, spill_dir=None):
+        self.spill_dir = spill_dir
+        self.files = []
+        self.count = 0
+
+    def add_chunk(self, names):
+        """Sort and write a chunk of names as bytes"""
+        f = tempfile.TemporaryFile(dir=self.spill_dir)
+        names = sorted(names)
+        for name in names:
+            f.write(name)
+            f.write(_SEPARATOR)
+        f.seek(0)
+        self.files.append(f)
+        self.count += len(names)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return heapq.merge(*[_read_names(f) for f in self.files])
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        del self.files[:]
+
+
+def collect(names, threshold=STREAM_THRESHOLD, spill_dir=None):
+    """Names as a list, or :class:`SpilledNames` if more than ``threshold``
+
+    ``names`` is an iterable of names as bytes.
+
+    """
+    names = iter(names)
+    first = list(itertools.islice(names, threshold + 1))
+    if len(first) <= threshold:
+        return first
+    spilled = SpilledNames(spill_dir)
+    spilled.add_chunk(first[:threshold])
+    rest = first[threshold:]
+    del first
+    while True:
+        rest.extend(itertools.islice(names, threshold - len(rest)))
+        if not rest:
+            return spilled
+        spilled.add_chunk(rest)
+        rest = []
+
+
+def sorted_names(names):
+    """A sorted iterator over a list of names or :class:`SpilledNames`"""
+    if isinstance(names, SpilledNames):
+        return iter(names)
+    return iter(sorted(names))
+
+
+def merge(source_names, dest_names):
+    """Pair two sorted streams of names
+
+    Yields ``(name, in_source, in_dest)`` in order, the names decoded.
+
+    """
+    source_names = iter(source_names)
+    dest_names = iter(dest_names)
+    source = next(source_names, None)
+    dest = next(dest_names, None)
+    while source is not None or dest is not None:
+        if dest is None or (source is not None and source < dest):
+            yield os.fsdecode(source), True, False
+            source = next(source_names, None)
+        elif source is None or dest < source:
+            yield os.fsdecode(dest), False, True
+            dest = next(dest_names, None)
+        else:
+            yield os.fsdecode(source), True, True
+            source = next(source_names, None)
+            dest = next(dest_names, None)
@@ -0,0 +1,191 @@
+"""Summary of the source tree that lets a back-up skip listing directories
+
+The modification time of a directory changes when entries are made,
+removed or renamed in it.  With the ``use_summary`` option a run keeps
+a row per directory of the source in an SQLite database in the
+destination root: the modification and change times of the directory
+and the names of its subdirectories.  On the next run a directory
+whose times are as recorded is not listed, on either side, and the
+walk goes on to its subdirectories by their recorded names, which are
+checked to still be directories.  A directory that is listed gets a
+new row.
+
+This misses every change that leaves the times of the directory as
+they were:
+
+* files whose contents are written in place, by a program that opens
+  and writes them instead of writing a new file and renaming it over
+  the old one, as databases, logs and many editors do
+* changes of the attributes of files, like permissions
+* files of the source restored with their old times by a tool that
+  then also sets the times of the directory
+
+The last one also changes the change time of the directory, which the
+tool cannot set, so it is caught unless the clock was turned back.
+To catch the others the whole tree is walked when the last full walk
+is older than ``full_walk_hours``, 24 by default, and the rows are
+made anew then.  The summary is also not trusted after a run that did
+not complete or had errors, and after the include or ignore lists of
+the config were changed.
+
+Only the source is checked, so items changed in the destination of a
+directory that is skipped are not noticed until the next full walk.
+
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from os.path import join, dirname
+from .changes import FULL_WALK_HOURS
+
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_FILENAME = '.bups.summary'
+# The database and the rollback journal of SQLite
+SUMMARY_FILES = frozenset([SUMMARY_FILENAME, SUMMARY_FILENAME + '-journal'])
+
+# Rows are committed in batches of this size
+COMMIT_INTERVAL = 1000
+
+# Directories modified this close to the start of a run are not
+# recorded, as the resolution of the times may not tell a later change
+RACY_SECONDS = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    item TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _filters(config):
+    """What decides which entries are part of the back-up"""
+    return json.dumps([config.get('include_list'), config.get('ignore_list')],
+                      sort_keys=True)
+
+
+class TreeSummary(object):
+    """The summary of the source kept in ``dest_root``"""
+    def __init__(self, dest_root, config, full_walk_hours=FULL_WALK_HOURS):
+        self.lock = threading.Lock()
+        self._pending = 0
+        self.started = time.time()
+        self.db = sqlite3.connect(join(dest_root, SUMMARY_FILENAME),
+                                  check_same_thread=False)
+        columns = [row[1] for row
+                   in self.db.execute('PRAGMA table_info(directories)')]
+        if 'signature' in columns:
+            # Rows of an earlier layout, made anew on this full walk
+            self.db.execute('DROP TABLE directories')
+            self.db.execute("DELETE FROM meta WHERE key = 'clean'")
+        self.db.executescript(_SCHEMA)
+        self.filters = _filters(config)
+        reason = None
+        full_walk = float(self._get_meta('full_walk') or 0)
+        if self._get_meta('clean') != '1':
+            reason = 'the previous run did not complete'
+        elif self._get_meta('filters') != self.filters:
+            reason = 'the included entries have changed'
+        elif self.started - full_walk > full_walk_hours * 3600:
+            reason = 'it is time for a full walk'
+        self.full_walk = reason is not None
+        if self.full_walk:
+            logger.info('Walking the whole tree, %s', reason)
+            self.db.execute('DELETE FROM directories')
+        self._set_meta('clean', '0')
+        self.db.commit()
+
+    def _get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, value))
+
+    def unchanged(self, item, stat_result):
+        """Subdirectories of ``item`` if it need not be listed, or ``None``"""
+        if self.full_walk or stat_result is None:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT mtime_ns, ctime_ns, subdirs FROM '
+                                  'directories WHERE item = ?',
+                                  (item,)).fetchone()
+        if row is None:
+            return None
+        mtime_ns, ctime_ns, subdirs = row
+        if (stat_result.st_mtime_ns != mtime_ns or
+                stat_result.st_ctime_ns != ctime_ns):
+            return None
+        return json.loads(subdirs)
+
+    def record(self, item, stat_result, entries):
+        """Store the directory ``item`` as listed with ``entries``
+
+        ``stat_result`` must have been taken before the listing, so
+        that changes made during it are noticed on the next run.
+
+        """
+        if stat_result.st_mtime_ns >= (self.started - RACY_SECONDS) * 1e9:
+            return
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+            except OSError:
+                return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO directories VALUES '
+                            '(?, ?, ?, ?)',
+                            (item, stat_result.st_mtime_ns,
+                             stat_result.st_ctime_ns, json.dumps(subdirs)))
+            self._maybe_commit()
+
+    def forget(self, item):
+        """List the directory ``item`` on the next run"""
+        with self.lock:
+            self.db.execute('DELETE FROM directories WHERE item = ?', (item,))
+            self._maybe_commit()
+
+    def _maybe_commit(self):
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.db.commit()
+            self._pending = 0
+
+    def close(self, stats, completed=True):
+        """Commit and close, trusting the rows if the run ``completed``
+
+        The directories of the items that had errors, by ``stats``, are
+        listed again on the next run.
+
+        """
+        with stats.lock:
+            errors = stats.counts['errors']
+            error_items = list(stats.error_items)
+        if errors > len(error_items):
+            # Not all of them are known
+            completed = False
+        for item in error_items:
+            self.forget(item)
+            self.forget(dirname(item))
+        with self.lock:
+            if completed:
+                self._set_meta('clean', '1')
+                self._set_meta('filters', self.filters)
+                if self.full_walk:
+                    self._set_meta('full_walk', str(self.started))
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import tempfile
+from os.path import join
+from mock import patch
+from nose.tools import ok_, eq_, assert_raises
+from .. import async_engine
+from .. import backup_loop as bloop
+from .. import preparations as prep
+from .test_backup_loop import populate_dirs, _make_tree, _walk_tree
+
+
+def _backup(source_root, dest_root, concurrency):
+    root = bloop.BackupNode(source_root, dest_root, 'target', {})
+    with patch.object(bloop, 'check_include', return_value=True):
+        if concurrency is None:
+            bloop.make_backup(root)
+        else:
+            asyncio.run(async_engine.backup_async(root, concurrency))
+    return root.stats.report()['counts']
+
+
+def test_async_walk_matches_sequential():
+    """The asyncio walk gives the same back-up as the sequential one"""
+    results = []
+    for concurrency in [None, 8]:
+        with tempfile.TemporaryDirectory() as source_root, \
+                tempfile.TemporaryDirectory() as dest_root:
+            populate_dirs(source_root, dest_root)
+            _make_tree(join(source_root, 'target', 'dir1'), 3, 3)
+            _make_tree(join(dest_root, 'target', 'dir4'), 2, 2)
+            results.append(_backup(source_root, dest_root, concurrency))
+            eq_(_walk_tree(join(source_root, 'target')),
+                _walk_tree(join(dest_root, 'target')))
+    eq_(results[0], results[1])
+
+
+def test_wide_directory_in_batches():
+    """A directory wider than a batch is backed up completely"""
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        os.makedirs(join(source_root, 'target'))
+        for i in range(3 * async_engine.BATCH_SIZE):
+            open(join(source_root, 'target', str(i)), 'w').close()
+        counts = _backup(source_root, dest_root, 2)
+        eq_(counts['files_copied'], 3 * async_engine.BATCH_SIZE)
+        eq_(sorted(os.listdir(join(dest_root, 'target'))),
+            sorted(os.listdir(join(source_root, 'target'))))
+
+
+def test_calls_in_flight_with_latency():
+    """With slow file system calls the asyncio walk overlaps them"""
+    peaks = []
+    for concurrency in [None, 4]:
+        with tempfile.TemporaryDirectory() as source_root, \
+                tempfile.TemporaryDirectory() as dest_root:
+            os.mkdir(join(source_root, 'target'))
+            _make_tree(join(source_root, 'target'), 2, 6)
+            with async_engine.injected_latency(0.005) as in_flight:
+                _backup(source_root, dest_root, concurrency)
+            peaks.append(in_flight.peak)
+            eq_(in_flight.current, 0)
+            eq_(_walk_tree(join(source_root, 'target')),
+                _walk_tree(join(dest_root, 'target')))
+    eq_(peaks[0], 1)
+    ok_(1 < peaks[1] <= 4, peaks)
+
+
+def test_latency_is_removed():
+    stat = bloop.stat
+    with async_engine.injected_latency(0.001):
+        ok_(bloop.stat is not stat)
+    ok_(bloop.stat is stat)
+
+
+def test_concurrency_is_validated():
+    assert_raises(ValueError, async_engine.AsyncWalk, 0)
+    with assert_raises(prep.InvalidConfigException):
+        prep.validate_config(dict(include_list=[], ignore_list=[],
+                                  id_string='', concurrency=0))
+    with assert_raises(prep.InvalidConfigException):
+        prep.validate_config(dict(include_list=[], ignore_list=[],
+                                  id_string='', concurrency=4,
+                                  batch_small_files=True))
+
+
+def test_start_backup_async():
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        _make_tree(source_root, 2, 3)
+        stats = asyncio.run(prep.start_backup_async(source_root, dest_root,
+                                                    concurrency=4))
+        # The files of the tree and the config file
+        eq_(stats.counts['files_copied'], 12 + 1)
+        target = join(dest_root, os.path.basename(source_root))
+        for path, dirs, files in os.walk(source_root):
+            relative = os.path.relpath(path, source_root)
+            for name in files:
+                ok_(os.path.isfile(join(target, relative, name)))
+
+
+def test_journal_is_rejected():
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        _make_tree(source_root, 1, 1)
+        for options in [dict(journal=True), dict(batch_small_files=True)]:
+            with assert_raises(prep.InvalidConfigException):
+                asyncio.run(prep.start_backup_async(source_root, dest_root,
+                                                    **options))
+
+
+def test_error_stops_walk():
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        _make_tree(source_root, 2, 3)
+        root = bloop.BackupNode(source_root, dest_root, '', {})
+        with patch.object(async_engine, 'match_directories',
+                          side_effect=OSError('Failed')), \
+                patch.object(bloop, 'check_include', return_value=True):
+            with assert_raises(OSError):
+                asyncio.run(async_engine.backup_async(root, 4))
@@ -1,11 +1,17 @@
 import tempfile
 import os
+import sys
 import unittest
 from os.path import join, exists, isdir, isfile
 from mock import patch
 from nose.tools import ok_, eq_
+from nose.plugins.skip import SkipTest
 from nose_parameterized import parameterized, param
 from .. import backup_loop as bloop
+from ..manifest import open_manifest, MANIFEST_FILENAME
+from ..copy_pool import CopyPool
+from ..context import RunContext
+from .. import fsio
 
 
 def populate_dirs(source_root, dest_root):
@@ -49,8 +55,8 @@ def populate_dirs(source_root, dest_root):
     assert os.stat(join(dest_target, 'dir4')).st_mtime < mtime
 
     # Modification time of file3 so that the target is newer
-    mtime = os.stat(join(dest_target, 'file3')).st_mtime
-    os.utime(join(dest_target, 'file3'), (mtime+1e-5, mtime+1e-5))
+    mtime = os.stat(join(source_target, 'file3')).st_mtime
+    os.utime(join(dest_target, 'file3'), (mtime+1, mtime+1))
     assert os.stat(join(dest_target, 'file3')).st_mtime > mtime
 
     source_items = [join('target', i) for i in os.listdir(source_target)]
@@ -92,6 +98,324 @@ def test_match_directories(populate_fun):
                 ok_(join(dest_root, item) in archived)
 
 
+class _CountingEntry(object):
+    """Directory entry wrapper that counts calls to ``stat``"""
+    def __init__(self, entry, counts):
+        self.entry = entry
+        self.name = entry.name
+        self.counts = counts
+
+    def stat(self):
+        self.counts[self.entry.path] = self.counts.get(self.entry.path, 0) + 1
+        return self.entry.stat()
+
+
+def test_one_stat_per_entry():
+    """The decision path stats every entry at most once on each side"""
+    entry_stats = {}
+    path_stats = []
+    listed = []
+    real_scandir = bloop.scandir
+    real_stat = bloop.stat
+
+    class counting_scandir(object):
+        def __init__(self, path):
+            listed.append(path)
+            self.entries = real_scandir(path)
+
+        def __enter__(self):
+            return (_CountingEntry(e, entry_stats) for e in self.entries)
+
+        def __exit__(self, *args):
+            self.entries.close()
+
+    def counting_stat(path):
+        path_stats.append(path)
+        return real_stat(path)
+
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        source_items, dest_items = populate_dirs(source_root, dest_root)
+        with patch.object(bloop, 'scandir', counting_scandir), \
+                patch.object(bloop, 'stat', counting_stat), \
+                patch.object(bloop, 'check_include', return_value=True):
+            node = bloop.BackupNode(source_root, dest_root, 'target', None)
+            bloop.make_backup(node)
+
+    # Only the starting node is stat'ed by path, once per side
+    eq_(sorted(path_stats), sorted([join(source_root, 'target'),
+                                    join(dest_root, 'target')]))
+    ok_(all(count == 1 for count in entry_stats.values()), entry_stats)
+    # Every listed entry is stat'ed once: ``target`` on both sides, its
+    # subdirectories are empty or new in destination
+    eq_(len(entry_stats), len(source_items) + len(dest_items))
+    # Directories that did not exist in destination are not listed there
+    ok_(join(dest_root, 'target', 'dir2') not in listed)
+
+
+@parameterized([
+    param('mtime'),
+    param('mtime_size'),
+    param('mtime_size_ctime'),
+])
+def test_unchanged_tree_is_not_copied(strategy):
+    """A second run over an unchanged tree copies zero bytes"""
+    config = {'change_detection': strategy}
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        populate_dirs(source_root, dest_root)
+        with open(join(source_root, 'target', 'file1'), 'w') as f:
+            f.write('contents')
+        with patch.object(bloop, 'check_include', return_value=True):
+            node = bloop.BackupNode(source_root, dest_root, 'target', config)
+            bloop.make_backup(node)
+            node = bloop.BackupNode(source_root, dest_root, 'target', config)
+            bloop.make_backup(node)
+        eq_(node.stats.counts['files_copied'], 0)
+        eq_(node.stats.counts['bytes_copied'], 0)
+
+
+def test_manifest_replaces_destination_reads():
+    """With a manifest the destination is not listed or stat'ed"""
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        populate_dirs(source_root, dest_root)
+        manifest = open_manifest(dest_root, bloop.INTERNAL_NAMES)
+        with patch.object(bloop, 'check_include', return_value=True):
+            bloop.make_backup(bloop.BackupNode(
+                source_root, dest_root, '', {},
+                run=RunContext(manifest=manifest)))
+        real_scandir = bloop.scandir
+        real_stat = bloop.stat
+
+        def source_scandir(path):
+            ok_(path.startswith(source_root), path)
+            return real_scandir(path)
+
+        def source_stat(path):
+            ok_(path.startswith(source_root), path)
+            return real_stat(path)
+
+        run = RunContext(manifest=manifest)
+        with patch.object(bloop, 'check_include', return_value=True), \
+                patch.object(bloop, 'scandir', source_scandir), \
+                patch.object(bloop, 'stat', source_stat):
+            bloop.make_backup(bloop.BackupNode(source_root, dest_root, '',
+                                               {}, run=run))
+        manifest.close()
+        eq_(run.stats.counts['files_copied'], 0)
+        eq_(run.stats.syscalls['scandir'],
+            run.stats.counts['directories_scanned'])
+        eq_(sorted(os.listdir(dest_root)),
+            sorted(os.listdir(source_root) + [MANIFEST_FILENAME]))
+
+
+def test_copy_pool_mirrors_like_sequential_walk():
+    """Copying in worker threads gives the same back-up and records"""
+    results = []
+    for workers in [0, 4]:
+        with tempfile.TemporaryDirectory() as source_root, \
+                tempfile.TemporaryDirectory() as dest_root:
+            populate_dirs(source_root, dest_root)
+            for i in range(50):
+                with open(join(source_root, 'target', 'dir1', str(i)),
+                          'w') as f:
+                    f.write(str(i))
+            run = RunContext()
+            if workers:
+                run.copy_pool = CopyPool(workers, queue_size=2)
+            with patch.object(bloop, 'check_include', return_value=True):
+                bloop.make_backup(bloop.BackupNode(source_root, dest_root,
+                                                   'target', {}, run=run))
+            if workers:
+                run.copy_pool.finish()
+            tree = sorted((os.path.relpath(path, dest_root), sorted(files))
+                          for path, _, files in os.walk(dest_root))
+            counts = run.stats.counts
+            results.append((tree, counts['files_copied'],
+                            counts['bytes_copied'], counts['errors']))
+    eq_(results[0], results[1])
+    eq_(results[1][3], 0)
+
+
+def _make_tree(root, depth, fan_out):
+    """Directories ``fan_out`` wide and ``depth`` deep with a file in each"""
+    directories = [root]
+    for _ in range(depth):
+        children = []
+        for directory in directories:
+            for i in range(fan_out):
+                child = join(directory, 'd{}'.format(i))
+                os.mkdir(child)
+                with open(join(child, 'f'), 'w') as f:
+                    f.write(child)
+                children.append(child)
+        directories = children
+
+
+def _walk_tree(root):
+    return sorted((os.path.relpath(path, root), sorted(dirs), sorted(files))
+                  for path, dirs, files in os.walk(root))
+
+
+def test_parallel_scan_matches_sequential():
+    """Scanning in threads gives the same back-up as one thread"""
+    results = []
+    for workers in [None, 4]:
+        with tempfile.TemporaryDirectory() as source_root, \
+                tempfile.TemporaryDirectory() as dest_root:
+            source_items, dest_items = populate_dirs(source_root, dest_root)
+            _make_tree(join(source_root, 'target', 'dir1'), 4, 3)
+            _make_tree(join(dest_root, 'target', 'dir4'), 2, 2)
+            root = bloop.BackupNode(source_root, dest_root, 'target',
+                                    {'scan_workers': workers})
+            with patch.object(bloop, 'check_include', return_value=True):
+                bloop.make_backup(root)
+            eq_(_walk_tree(join(source_root, 'target')),
+                _walk_tree(join(dest_root, 'target')))
+            results.append(root.stats.report()['counts'])
+    eq_(results[0], results[1])
+
+
+def test_streamed_walk_matches_in_memory_walk():
+    """Directories listed by name in sorted chunks give the same back-up"""
+    results = []
+    for threshold in [None, 2]:
+        with tempfile.TemporaryDirectory() as source_root, \
+                tempfile.TemporaryDirectory() as dest_root:
+            populate_dirs(source_root, dest_root)
+            _make_tree(join(source_root, 'target', 'dir1'), 2, 3)
+            _make_tree(join(dest_root, 'target', 'dir4'), 2, 3)
+            config = {'stream_threshold': threshold} if threshold else {}
+            root = bloop.BackupNode(source_root, dest_root, 'target', config)
+            with patch.object(bloop, 'check_include', return_value=True):
+                bloop.make_backup(root)
+            eq_(_walk_tree(join(source_root, 'target')),
+                _walk_tree(join(dest_root, 'target')))
+            counts = root.stats.counts
+            results.append((counts['files_copied'], counts['removed']))
+            ok_(counts['directories_streamed'] > 0 if threshold else
+                'directories_streamed' not in counts)
+    eq_(results[0], results[1])
+
+
+def test_streamed_walk_with_manifest():
+    """Directories read from the manifest are streamed too"""
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        populate_dirs(source_root, dest_root)
+        _make_tree(join(dest_root, 'target', 'dir4'), 2, 3)
+        manifest = open_manifest(dest_root, bloop.INTERNAL_NAMES)
+        run = RunContext(manifest=manifest)
+        with patch.object(bloop, 'check_include', return_value=True):
+            bloop.make_backup(bloop.BackupNode(source_root, dest_root,
+                                               'target',
+                                               {'stream_threshold': 2},
+                                               run=run))
+        manifest.close()
+        eq_(_walk_tree(join(source_root, 'target')),
+            _walk_tree(join(dest_root, 'target')))
+        ok_(run.stats.counts['directories_streamed'] > 0)
+
+
+def test_dir_fds_walk_matches_path_walk():
+    """Accessing entries relative to open directories gives the same back-up"""
+    if not fsio.supported():
+        raise SkipTest('No file operations relative to directories')
+    results = []
+    for fds in [None, fsio.DirectoryFds(max_open=3)]:
+        with tempfile.TemporaryDirectory() as source_root, \
+                tempfile.TemporaryDirectory() as dest_root:
+            populate_dirs(source_root, dest_root)
+            _make_tree(join(source_root, 'target', 'dir1'), 3, 3)
+            run = RunContext(dir_fds=fds)
+            relative = []
+            real_mkdir = bloop.mkdir
+
+            def recording_mkdir(path, **kwargs):
+                relative.append('dir_fd' in kwargs)
+                return real_mkdir(path, **kwargs)
+
+            with patch.object(bloop, 'check_include', return_value=True), \
+                    patch.object(bloop, 'mkdir', recording_mkdir):
+                bloop.make_backup(bloop.BackupNode(source_root, dest_root,
+                                                   'target', {}, run=run))
+            eq_(_walk_tree(join(source_root, 'target')),
+                _walk_tree(join(dest_root, 'target')))
+            ok_(relative)
+            eq_(set(relative), {fds is not None})
+            results.append(run.stats.report()['counts'])
+            if fds is not None:
+                ok_(len(fds) <= 3)
+                fds.close()
+    eq_(results[0], results[1])
+
+
+def test_deep_tree():
+    """The walk is not limited by the recursion depth of Python"""
+    limit = sys.getrecursionlimit()
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        _make_tree(source_root, 300, 1)
+        sys.setrecursionlimit(200)
+        try:
+            with patch.object(bloop, 'check_include', return_value=True):
+                    bloop.make_backup(bloop.BackupNode(source_root, dest_root,
+                                                   '', None))
+        finally:
+            sys.setrecursionlimit(limit)
+        eq_(_walk_tree(source_root), _walk_tree(dest_root))
+
+
+def test_delta_mode_for_large_files():
+    """Large files already in back-up are updated in place"""
+    config = dict(delta_threshold=100, delta_block_size=64)
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        for root in [source_root, dest_root]:
+            with open(join(root, 'large'), 'wb') as f:
+                f.write(b'x' * 1000)
+            with open(join(root, 'small'), 'wb') as f:
+                f.write(b'x' * 10)
+        with open(join(source_root, 'large'), 'r+b') as f:
+            f.seek(500)
+            f.write(b'y')
+        with open(join(source_root, 'small'), 'wb') as f:
+            f.write(b'y' * 10)
+        os.utime(join(dest_root, 'large'), (0, 0))
+        os.utime(join(dest_root, 'small'), (0, 0))
+        root = bloop.BackupNode(source_root, dest_root, '', config)
+        with patch.object(bloop, 'check_include', return_value=True):
+            bloop.make_backup(root)
+        stats = root.stats
+        eq_(stats.delta_bytes['written'], 64)
+        eq_(stats.delta_bytes['read'], 2000)
+        eq_(stats.copy_backends['delta'], 1)
+        eq_(sum(stats.copy_backends.values()), 2)
+        # Only the full copy of the small file is counted as copied data
+        eq_(stats.counts['bytes_copied'], 10)
+        for name in ['large', 'small']:
+            with open(join(source_root, name), 'rb') as f, \
+                    open(join(dest_root, name), 'rb') as g:
+                eq_(f.read(), g.read())
+
+
+class _Entry(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def test_diff_children():
+    source_contents = [_Entry(name) for name in ['a', 'b', 'c', 'd']]
+    dest_stats = {'b': 'stat b', 'd': None, 'e': 'stat e', 'f': 'stat f'}
+    added, common, removed = bloop.diff_children(source_contents, dest_stats)
+    eq_([entry.name for entry in added], ['a', 'c'])
+    eq_([(entry.name, dest_stat) for entry, dest_stat in common],
+        [('b', 'stat b'), ('d', None)])
+    eq_(sorted(removed), [('e', 'stat e'), ('f', 'stat f')])
+    eq_(len(dest_stats), 4)
+
+
 class MakeBackupTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -189,3 +513,45 @@ class MakeBackupTestCase(unittest.TestCase):
     def wrapDown(self):
         self.source_tempdir.cleanup()
         self.dest_tempdir.cleanup()
+
+
+def test_small_files_are_batched_in_inode_order():
+    """Small files are copied after their directory, sorted by inode"""
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        source = join(source_root, 'target')
+        os.mkdir(source)
+        for name, size in [('b', 10), ('large', 1000), ('a', 10), ('c', 10)]:
+            with open(join(source, name), 'w') as f:
+                f.write('x' * size)
+        config = {'batch_small_files': True, 'small_file_size': 100}
+        copied = []
+        real_copy = bloop.BackupNode._copy
+
+        def recording_copy(node):
+            copied.append(node.item)
+            real_copy(node)
+
+        root = bloop.BackupNode(source_root, dest_root, 'target', config)
+        with patch.object(bloop, 'check_include', return_value=True), \
+                patch.object(bloop.BackupNode, '_copy', recording_copy):
+            bloop.make_backup(root)
+        eq_(_walk_tree(source), _walk_tree(join(dest_root, 'target')))
+        small = [join('target', name) for name in 'abc']
+        eq_(copied, [join('target', 'large')] +
+            sorted(small, key=lambda item: os.stat(join(source_root,
+                                                         item)).st_ino))
+        eq_(root.stats.counts['copy_batches'], 1)
+
+
+def test_failed_removal_records_item():
+    """A failed removal is recorded by the item, like other errors"""
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        os.mkdir(join(dest_root, 'dir'))
+        open(join(dest_root, 'dir', 'old'), 'w').close()
+        node = bloop.BackupNode(source_root, dest_root, join('dir', 'old'),
+                                {})
+        with patch.object(bloop, 'remove', side_effect=OSError('Failed')):
+            node.remove()
+        eq_(node.stats.error_items, [join('dir', 'old')])
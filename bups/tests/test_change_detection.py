@@ -0,0 +1,38 @@
+from collections import namedtuple
+from nose.tools import ok_, eq_, assert_raises
+from .. import change_detection as cd
+
+
+Stat = namedtuple('Stat', ['st_size', 'st_mtime', 'st_ctime'])
+
+
+def test_strategies():
+
+    def check(name, source_stat, dest_stat, expected):
+        eq_(cd.get_strategy(name)(source_stat, dest_stat), expected)
+
+    backed_up = Stat(st_size=10, st_mtime=100.0, st_ctime=100.0)
+
+    unchanged = Stat(st_size=10, st_mtime=90.0, st_ctime=90.0)
+    for name in cd.STRATEGIES:
+        yield check, name, unchanged, backed_up, False
+
+    newer = Stat(st_size=10, st_mtime=110.0, st_ctime=110.0)
+    for name in cd.STRATEGIES:
+        yield check, name, newer, backed_up, True
+
+    resized = Stat(st_size=5, st_mtime=90.0, st_ctime=90.0)
+    yield check, 'mtime', resized, backed_up, False
+    yield check, 'mtime_size', resized, backed_up, True
+    yield check, 'mtime_size_ctime', resized, backed_up, True
+
+    restored = Stat(st_size=10, st_mtime=90.0, st_ctime=110.0)
+    yield check, 'mtime', restored, backed_up, False
+    yield check, 'mtime_size', restored, backed_up, False
+    yield check, 'mtime_size_ctime', restored, backed_up, True
+
+
+def test_default_and_unknown_strategy():
+    ok_(cd.get_strategy() is cd.STRATEGIES[cd.DEFAULT_STRATEGY])
+    with assert_raises(ValueError):
+        cd.get_strategy('checksum')
@@ -0,0 +1,154 @@
+import json
+import os
+import socket
+import tempfile
+import time
+import unittest
+from os.path import join, exists
+from mock import patch
+from nose.tools import ok_, eq_
+from .. import backup_loop as bloop
+from .. import changes as bchanges
+from ..context import RunContext
+from ..stats import Stats
+
+
+def test_needs_walk():
+    changes = bchanges.ChangeSet([join('a', 'b')], [join('c', 'd')])
+    for item in ['', 'a', join('a', 'b'), 'c', join('c', 'd'),
+                 join('c', 'd', 'e', 'f')]:
+        ok_(changes.needs_walk(item), item)
+    for item in [join('a', 'b', 'c'), join('a', 'x'), 'b', join('c', 'e')]:
+        ok_(not changes.needs_walk(item), item)
+    eq_(len(changes), 2)
+
+
+class ChangeLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _write_log(self, *records, session='s1', pid=None):
+        header = {'session': session, 'pid': pid or os.getpid(),
+                  'host': socket.gethostname()}
+        with open(join(self.root, bchanges.CHANGES_FILENAME), 'w') as f:
+            for record in (header,) + records:
+                f.write(json.dumps(record) + '\n')
+
+    def _run(self, completed=True, stats=None):
+        log = bchanges.ChangeLog(self.root)
+        changes = log.take()
+        log.finish(stats or Stats(), completed, full_walk=changes is None)
+        ok_(not exists(log.taken_path))
+        return changes
+
+    def test_no_log(self):
+        eq_(self._run(), None)
+
+    def test_same_session(self):
+        self._write_log()
+        eq_(self._run(), None)
+        self._write_log({'dir': 'a'}, {'tree': 'b'})
+        changes = self._run()
+        eq_(changes.directories, {'a'})
+        eq_(changes.trees, {'b'})
+        ok_(not exists(join(self.root, bchanges.CHANGES_FILENAME)))
+
+    def test_restarted_watcher(self):
+        self._write_log()
+        self._run()
+        self._write_log({'dir': 'a'}, session='s2')
+        eq_(self._run(), None)
+        self._write_log({'dir': 'a'}, session='s2')
+        ok_(self._run() is not None)
+
+    def test_overflow(self):
+        self._write_log()
+        self._run()
+        self._write_log({'dir': 'a'}, {'overflow': True})
+        eq_(self._run(), None)
+
+    def test_dead_watcher(self):
+        self._write_log()
+        self._run()
+        with patch('os.kill', side_effect=ProcessLookupError):
+            self._write_log({'dir': 'a'})
+            eq_(self._run(), None)
+
+    def test_failed_run(self):
+        self._write_log()
+        self._run()
+        self._write_log({'dir': 'a'})
+        ok_(self._run(completed=False) is not None)
+        self._write_log({'dir': 'a'})
+        eq_(self._run(), None)
+
+    def test_errors_are_walked_again(self):
+        self._write_log()
+        self._run()
+        self._write_log({'dir': 'a'})
+        stats = Stats()
+        stats.error(join('b', 'c'))
+        ok_(self._run(stats=stats) is not None)
+        self._write_log()
+        changes = self._run()
+        ok_(changes.needs_walk('b'))
+        ok_(changes.needs_walk(join('b', 'c')))
+        ok_(not changes.needs_walk('a'))
+        self._write_log()
+        ok_(not self._run().needs_walk('b'))
+
+    def test_full_walk_interval(self):
+        self._write_log()
+        self._run()
+        self._write_log({'dir': 'a'})
+        with patch.object(time, 'time',
+                          return_value=time.time() + 25 * 3600):
+            eq_(self._run(), None)
+
+
+class IncrementalWalkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.TemporaryDirectory()
+        self.dest = tempfile.TemporaryDirectory()
+        for item in ['a', 'b', join('b', 'c')]:
+            os.mkdir(join(self.source.name, item))
+            with open(join(self.source.name, item, 'file'), 'w') as f:
+                f.write(item)
+        self._backup(None)
+
+    def tearDown(self):
+        self.source.cleanup()
+        self.dest.cleanup()
+
+    def _backup(self, changes):
+        run = RunContext(changes=changes)
+        with patch.object(bloop, 'check_include', return_value=True):
+            bloop.make_backup(bloop.BackupNode(self.source.name,
+                                               self.dest.name, '', {},
+                                               run=run))
+        return run.stats.counts
+
+    def test_only_changed_directories_are_walked(self):
+        for item in ['a', join('b', 'c')]:
+            with open(join(self.source.name, item, 'new'), 'w') as f:
+                f.write('new')
+        changes = bchanges.ChangeSet([join('b', 'c')])
+        counts = self._backup(changes)
+        eq_(counts['files_copied'], 1)
+        eq_(counts['directories_unchanged'], 1)
+        ok_(exists(join(self.dest.name, 'b', 'c', 'new')))
+        ok_(not exists(join(self.dest.name, 'a', 'new')))
+
+    def test_new_directories_are_walked(self):
+        os.mkdir(join(self.source.name, 'd'))
+        with open(join(self.source.name, 'd', 'file'), 'w') as f:
+            f.write('d')
+        counts = self._backup(bchanges.ChangeSet(['']))
+        eq_(counts['files_copied'], 1)
+        ok_(exists(join(self.dest.name, 'd', 'file')))
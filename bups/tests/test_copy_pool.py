@@ -0,0 +1,63 @@
+import threading
+import time
+from nose.tools import ok_, eq_, assert_raises
+from ..copy_pool import CopyPool
+
+
+def test_deferred_after_copies():
+    """Deferred tasks run after every submitted task has finished"""
+    events = []
+    lock = threading.Lock()
+
+    def task(i):
+        time.sleep(0.001 * (i % 3))
+        with lock:
+            events.append(('copy', i))
+
+    pool = CopyPool(4, queue_size=2)
+    pool.defer(events.append, ('remove', 0))
+    for i in range(20):
+        pool.submit(task, i)
+    pool.finish()
+    eq_(len(events), 21)
+    eq_(events[-1], ('remove', 0))
+    eq_(sorted(events[:-1]), [('copy', i) for i in range(20)])
+
+
+def test_failing_task_does_not_stop_workers():
+    done = []
+
+    def fail():
+        raise RuntimeError('fail')
+
+    pool = CopyPool(1)
+    pool.submit(fail)
+    pool.submit(done.append, 1)
+    pool.finish()
+    eq_(done, [1])
+
+
+def test_cancel():
+    """Cancelling drops waiting copies and deferred tasks"""
+    started = threading.Event()
+    release = threading.Event()
+    done = []
+
+    def block():
+        started.set()
+        release.wait()
+
+    pool = CopyPool(1, queue_size=10)
+    pool.submit(block)
+    started.wait()
+    for i in range(5):
+        pool.submit(done.append, i)
+    pool.defer(done.append, 'removed')
+    threading.Timer(0.05, release.set).start()
+    pool.finish(cancel=True)
+    eq_(done, [])
+
+
+def test_no_workers():
+    with assert_raises(ValueError):
+        CopyPool(0)
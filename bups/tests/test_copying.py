@@ -0,0 +1,138 @@
+import errno
+import os
+import tempfile
+from os.path import join
+from mock import patch
+from nose.plugins.skip import SkipTest
+from nose.tools import ok_, eq_, assert_raises
+from .. import copying
+
+
+def _write_random(path, size, mode=0o640):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    os.chmod(path, mode)
+
+
+# Usually tmpfs on Linux, the default temporary directory is often not
+TMPFS = '/dev/shm'
+
+
+def test_backends():
+    """Every backend copies data and mode, if the file system allows"""
+
+    def check(backend, size, directory):
+        with tempfile.TemporaryDirectory(dir=directory) as root:
+            source = join(root, 'source')
+            dest = join(root, 'dest')
+            _write_random(source, size)
+            # An existing destination is overwritten
+            _write_random(dest, 2 * size + 10, 0o600)
+            try:
+                used = copying.copy_file(source, dest, backend)
+            except OSError as exc:
+                if backend == 'auto' or not copying._unsupported(exc):
+                    raise
+                raise SkipTest('{} not supported here'.format(backend))
+            ok_(used in copying.AUTO_ORDER)
+            if backend != 'auto':
+                eq_(used, backend)
+            with open(source, 'rb') as f, open(dest, 'rb') as g:
+                ok_(f.read() == g.read())
+            eq_(os.stat(dest).st_mode, os.stat(source).st_mode)
+
+    directories = [None]
+    if os.path.isdir(TMPFS) and os.access(TMPFS, os.W_OK):
+        directories.append(TMPFS)
+    for directory in directories:
+        for backend in copying.BACKEND_NAMES:
+            for size in [0, 1, 3 * copying.CHUNK_SIZE + 17]:
+                yield check, backend, size, directory
+
+
+def test_auto_falls_back():
+    """An unsupported backend gives way to the next one"""
+    def unsupported(*args):
+        raise OSError(errno.EOPNOTSUPP, 'not supported')
+
+    with tempfile.TemporaryDirectory() as root:
+        source = join(root, 'source')
+        dest = join(root, 'dest')
+        _write_random(source, 1000)
+        backends = dict(copying.BACKENDS, reflink=unsupported,
+                        copy_file_range=unsupported)
+        with patch.object(copying, 'BACKENDS', backends):
+            eq_(copying.copy_file(source, dest), 'sendfile')
+        with open(source, 'rb') as f, open(dest, 'rb') as g:
+            ok_(f.read() == g.read())
+
+
+def test_advise():
+    """The hints to the kernel do not change the copy"""
+    if not hasattr(os, 'posix_fadvise'):
+        raise SkipTest('No posix_fadvise on this platform')
+    with tempfile.TemporaryDirectory() as root:
+        source = join(root, 'source')
+        dest = join(root, 'dest')
+        _write_random(source, 100000)
+        with patch.object(os, 'posix_fadvise',
+                          wraps=os.posix_fadvise) as fadvise:
+            copying.copy_file(source, dest, advise=True)
+        eq_([call[0][3] for call in fadvise.call_args_list],
+            [os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_DONTNEED])
+        with open(source, 'rb') as f, open(dest, 'rb') as g:
+            ok_(f.read() == g.read())
+
+
+def test_real_errors_are_raised():
+    def failing(*args):
+        raise OSError(errno.EIO, 'input/output error')
+
+    with tempfile.TemporaryDirectory() as root:
+        source = join(root, 'source')
+        _write_random(source, 10)
+        with patch.dict(copying.BACKENDS, reflink=failing):
+            with assert_raises(OSError):
+                copying.copy_file(source, join(root, 'dest'))
+        with assert_raises(ValueError):
+            copying.copy_file(source, join(root, 'dest'), 'rsync')
+
+
+def test_delta_copy():
+    """Only the changed blocks are written"""
+
+    def check(name, source_data, dest_data, written):
+        with tempfile.TemporaryDirectory() as root:
+            source = join(root, 'source')
+            dest = join(root, 'dest')
+            with open(source, 'wb') as f:
+                f.write(source_data)
+            with open(dest, 'wb') as f:
+                f.write(dest_data)
+            os.utime(dest, (0, 0))
+            bytes_read, bytes_written = copying.delta_copy(source, dest,
+                                                           block_size=4)
+            eq_(bytes_written, written)
+            eq_(bytes_read, len(source_data) +
+                min(len(source_data), len(dest_data)))
+            with open(dest, 'rb') as f:
+                eq_(f.read(), source_data)
+            ok_(os.stat(dest).st_mtime > 0)
+
+    yield check, 'Same', b'aaaabbbbcc', b'aaaabbbbcc', 0
+    yield check, 'One block', b'aaaaXbbbcc', b'aaaabbbbcc', 4
+    yield check, 'Grown', b'aaaabbbbccdd', b'aaaabbbb', 4
+    yield check, 'Shrunk', b'aaaabb', b'aaaabbbbcc', 0
+    yield check, 'Empty', b'', b'aaaa', 0
+
+
+def test_delta_copy_hard_link():
+    """A file with other links is not modified in place"""
+    with tempfile.TemporaryDirectory() as root:
+        source = join(root, 'source')
+        dest = join(root, 'dest')
+        _write_random(source, 10)
+        _write_random(dest, 10)
+        os.link(dest, join(root, 'link'))
+        with assert_raises(copying.UnsupportedBackend):
+            copying.delta_copy(source, dest)
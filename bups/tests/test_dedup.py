@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from os.path import join, exists
+from nose.tools import ok_, eq_
+from ..copying import copy_file
+from .. import dedup
+
+
+class ContentStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source_tempdir = tempfile.TemporaryDirectory()
+        self.source_root = self.source_tempdir.name
+        self.dest_tempdir = tempfile.TemporaryDirectory()
+        self.dest_root = self.dest_tempdir.name
+        for name, contents in [('a', 'same'), ('b', 'same'), ('c', 'other')]:
+            with open(join(self.source_root, name), 'w') as f:
+                f.write(contents)
+        self.store = dedup.ContentStore(self.dest_root)
+
+    def tearDown(self):
+        self.source_tempdir.cleanup()
+        self.dest_tempdir.cleanup()
+
+    def backup(self, name, store=None):
+        store = store or self.store
+        return store.link_or_copy(join(self.source_root, name),
+                                  join(self.dest_root, name), copy_file)
+
+    def test_identical_files_are_linked(self):
+        ok_(self.backup('a') != 'link')
+        eq_(self.backup('b'), 'link')
+        ok_(self.backup('c') != 'link')
+        a, b, c = [os.stat(join(self.dest_root, name)) for name in 'abc']
+        eq_(a.st_ino, b.st_ino)
+        ok_(a.st_ino != c.st_ino)
+        # Two back-up files and the store
+        eq_(a.st_nlink, 3)
+
+    def test_index_is_persisted(self):
+        self.backup('a')
+        self.store.close()
+        store = dedup.ContentStore(self.dest_root)
+        eq_(self.backup('b', store), 'link')
+        store.close()
+
+    def test_changed_file_does_not_write_through(self):
+        self.backup('a')
+        self.backup('b')
+        with open(join(self.source_root, 'b'), 'w') as f:
+            f.write('changed')
+        ok_(self.backup('b') != 'link')
+        with open(join(self.dest_root, 'a')) as f:
+            eq_(f.read(), 'same')
+        with open(join(self.dest_root, 'b')) as f:
+            eq_(f.read(), 'changed')
+
+    def test_permissions_are_not_shared(self):
+        os.chmod(join(self.source_root, 'b'), 0o600)
+        self.backup('a')
+        ok_(self.backup('b') != 'link')
+
+    def test_prune(self):
+        self.backup('a')
+        self.backup('c')
+        os.remove(join(self.dest_root, 'c'))
+        self.store.prune()
+        objects = [name for _, _, files in os.walk(self.store.root)
+                   for name in files if name != dedup.INDEX_FILENAME]
+        eq_(len(objects), 1)
+        eq_(self.backup('b'), 'link')
+        ok_(self.backup('c') != 'link')
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from os.path import join
+from nose.tools import ok_, eq_
+from .. import fsio
+
+
+class DirectoryFdsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+        self.directories = [join(self.root, str(i)) for i in range(4)]
+        for directory in self.directories:
+            os.mkdir(directory)
+        self.fds = fsio.DirectoryFds(max_open=2)
+
+    def tearDown(self):
+        self.fds.close()
+        self.tempdir.cleanup()
+
+    def test_lease_is_cached(self):
+        with self.fds.lease(self.directories[0]) as fd:
+            open(join(self.directories[0], 'f'), 'w').close()
+            ok_(os.stat('f', dir_fd=fd))
+            with self.fds.lease(self.directories[0]) as same:
+                eq_(fd, same)
+        eq_(len(self.fds), 1)
+
+    def test_unused_are_closed(self):
+        for directory in self.directories:
+            with self.fds.lease(directory):
+                pass
+        eq_(list(self.fds.slots), self.directories[2:])
+
+    def test_leased_are_kept_open(self):
+        with self.fds.lease(self.directories[0]) as fd:
+            for directory in self.directories[1:]:
+                with self.fds.lease(directory):
+                    pass
+            ok_(self.directories[0] in self.fds.slots)
+            ok_(os.fstat(fd))
+
+    def test_missing_directory(self):
+        with self.fds.lease(join(self.root, 'missing')) as fd:
+            eq_(fd, None)
+
+    def test_forget(self):
+        inner = join(self.directories[0], 'inner')
+        os.mkdir(inner)
+        with self.fds.lease(self.directories[0]) as fd:
+            with self.fds.lease(inner):
+                pass
+            self.fds.forget(self.directories[0])
+            eq_(len(self.fds), 0)
+            # Still open for the lease
+            ok_(os.fstat(fd))
+        with self.assertRaises(OSError):
+            os.fstat(fd)
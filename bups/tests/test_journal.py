@@ -0,0 +1,175 @@
+import json
+import os
+import tempfile
+import unittest
+from os.path import join, exists
+from mock import patch
+from nose.tools import ok_, eq_, assert_raises
+from .. import backup_loop as bloop
+from .. import journal as bjournal
+from .. import preparations as prep
+from ..context import RunContext
+from ..stats import Stats
+from .test_backup_loop import _make_tree, _walk_tree
+
+
+def _records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_partial_name():
+    eq_(bjournal.partial_name(join('a', 'b')),
+        join('a', bjournal.PARTIAL_PREFIX + 'b'))
+    long_name = bjournal.partial_name('x' * 250)
+    ok_(long_name.startswith(bjournal.PARTIAL_PREFIX))
+    ok_(len(long_name) < 255)
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+        self.journal = bjournal.Journal(self.root, Stats())
+
+    def tearDown(self):
+        self.journal.close()
+        self.tempdir.cleanup()
+
+    def _done(self):
+        return [record['done'] for record in _records(self.journal.path)
+                if 'done' in record]
+
+    def test_done_after_subdirectories_and_copies(self):
+        self.journal.started('')
+        self.journal.started('a')
+        self.journal.hold('a')
+        self.journal.release('')
+        self.journal.release('a')
+        eq_(self._done(), [])
+        self.journal.release('a')
+        eq_(self._done(), ['a', ''])
+
+    def test_failure_is_not_done(self):
+        self.journal.started('')
+        self.journal.started('a')
+        self.journal.started('b')
+        self.journal.release('a', failed=True)
+        self.journal.release('b')
+        self.journal.release('')
+        eq_(self._done(), ['b'])
+
+    def test_resume_cleans_up(self):
+        partial = bjournal.partial_name('file')
+        open(join(self.root, partial), 'w').close()
+        open(join(self.root, 'updated'), 'w').close()
+        self.journal.started('')
+        self.journal.started('a')
+        self.journal.release('a')
+        # Left behind by a run that was killed while copying
+        self.journal._write({'partial': partial})
+        self.journal.in_place('updated')
+        self.journal.close()
+        with open(self.journal.path, 'a') as f:
+            f.write('{"done": "trunc')
+        stats = Stats()
+        self.journal = bjournal.Journal(self.root, stats)
+        ok_(self.journal.is_done('a'))
+        ok_(not exists(join(self.root, partial)))
+        eq_(os.stat(join(self.root, 'updated')).st_mtime, 0)
+        eq_(_records(self.journal.path), [{'done': 'a'}])
+
+    def test_failed_copy_leaves_no_partial_file(self):
+        def failing(partial):
+            open(partial, 'w').close()
+            raise OSError('disk full')
+
+        with assert_raises(OSError):
+            self.journal.copy('file', failing, join(self.root, 'file'))
+        eq_([name for name in os.listdir(self.root)
+             if name.startswith(bjournal.PARTIAL_PREFIX)], [])
+
+    def test_discard_cleans_up(self):
+        partial = bjournal.partial_name('file')
+        open(join(self.root, partial), 'w').close()
+        self.journal._write({'partial': partial})
+        self.journal.close()
+        stats = Stats()
+        bjournal.discard_journal(self.root, stats)
+        ok_(not exists(self.journal.path))
+        ok_(not exists(join(self.root, partial)))
+        eq_(stats.counts['partial_files_removed'], 1)
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def test_resume_interrupted_backup():
+    """A resumed run copies only what the interrupted run did not"""
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        source = join(source_root, 'target')
+        os.mkdir(source)
+        _make_tree(source, 2, 3)
+        total = 12
+        copies = []
+        real_copy_file = bloop.copy_file
+
+        def interrupting_copy_file(*args, **kwargs):
+            if len(copies) == 8:
+                raise Interrupted()
+            copies.append(args[0])
+            return real_copy_file(*args, **kwargs)
+
+        def backup():
+            run = RunContext()
+            run.journal = bjournal.Journal(dest_root, run.stats)
+            completed = False
+            try:
+                bloop.make_backup(bloop.BackupNode(source_root, dest_root,
+                                                   'target', {}, run=run))
+                completed = True
+            finally:
+                run.journal.close(complete=completed)
+            return run.stats.counts
+
+        with patch.object(bloop, 'check_include', return_value=True):
+            with patch.object(bloop, 'copy_file', interrupting_copy_file):
+                assert_raises(Interrupted, backup)
+            ok_(exists(join(dest_root, bjournal.JOURNAL_FILENAME)))
+            counts = backup()
+        ok_(counts['directories_resumed'] > 0)
+        ok_(counts['files_copied'] < total)
+        eq_(_walk_tree(source), _walk_tree(join(dest_root, 'target')))
+        ok_(not exists(join(dest_root, bjournal.JOURNAL_FILENAME)))
+
+
+def test_stale_journal_is_not_resumed():
+    """A run without a journal discards the one left behind"""
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        prep.create_default_config(source_root)
+        with open(join(source_root, 'file'), 'w') as f:
+            f.write('old')
+        prep.start_backup(source_root, dest_root)
+        target = join(dest_root, os.path.basename(source_root))
+        # Left behind by an interrupted run that was done with the root
+        with open(join(target, bjournal.JOURNAL_FILENAME), 'w') as f:
+            f.write(json.dumps({'done': ''}) + '\n')
+        prep.start_backup(source_root, dest_root)
+        ok_(not exists(join(target, bjournal.JOURNAL_FILENAME)))
+        with open(join(source_root, 'file'), 'w') as f:
+            f.write('changed')
+        prep.start_backup(source_root, dest_root, journal=True)
+        with open(join(target, 'file')) as f:
+            eq_(f.read(), 'changed')
+
+
+def test_incompatible_options():
+    for key in ['snapshots', 'dry_run', 'concurrency']:
+        with assert_raises(prep.InvalidConfigException):
+            prep.validate_config({'include_list': [], 'ignore_list': [],
+                                  'id_string': '', 'journal': True,
+                                  key: True})
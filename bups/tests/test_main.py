@@ -0,0 +1,52 @@
+import io
+import json
+import logging
+import os
+import tempfile
+from os.path import join
+from mock import patch
+from nose.tools import ok_, eq_
+from .. import main
+
+
+def test_formatter_merges_arguments():
+    formatter = main.BupsFormatter(fmt='%(levelname).1s: %(message)s',
+                                   font_effects=False)
+    record = logging.LogRecord('bups', logging.INFO, __file__, 1,
+                               'Copy %s', ('a/b',), None)
+    eq_(formatter.format(record), 'I: Copy a/b')
+    # The record is formatted again by another handler
+    eq_(formatter.format(record), 'I: Copy a/b')
+
+
+def test_high_volume_logging():
+    root = logging.getLogger()
+    file_logger = logging.getLogger('bups.files')
+    saved = root.handlers[:], root.level
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            with patch('sys.stderr', io.StringIO()):
+                listeners = main.configure_logging(high_volume=True,
+                                                   file_log='files.log')
+            file_logger.info('Copy %s', 'a', extra={'op': 'copy',
+                                                    'item': 'x/a'})
+            logging.getLogger('bups').info('Summary')
+            for listener in listeners:
+                listener.stop()
+            with open('files.log') as f:
+                event = json.loads(f.readline())
+            eq_((event['op'], event['item']), ('copy', 'x/a'))
+            with open('backup.log') as f:
+                contents = f.read()
+            ok_('Summary' in contents)
+            ok_('Copy' not in contents)
+        finally:
+            os.chdir(cwd)
+            for handler in root.handlers + file_logger.handlers:
+                handler.close()
+            root.handlers[:], root.level = saved
+            file_logger.handlers[:] = []
+            file_logger.propagate = True
+            file_logger.setLevel(logging.NOTSET)
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+from os.path import join
+from stat import S_ISDIR, S_ISREG
+from nose.tools import ok_, eq_
+from .. import manifest as man
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dest_root = self.tempdir.name
+        os.makedirs(join(self.dest_root, 'dir', 'subdir'))
+        with open(join(self.dest_root, 'dir', 'file'), 'w') as f:
+            f.write('contents')
+        open(join(self.dest_root, 'dir', 'subdir', 'file'), 'w').close()
+        open(join(self.dest_root, 'dir0'), 'w').close()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_rebuild(self):
+        """A new manifest is filled from the destination"""
+        manifest = man.open_manifest(self.dest_root)
+        eq_(sorted(manifest.children('')), ['dir', 'dir0'])
+        eq_(sorted(manifest.children('dir')), ['file', 'subdir'])
+        ok_(S_ISDIR(manifest.lookup('dir').st_mode))
+        ok_(S_ISREG(manifest.lookup(join('dir', 'file')).st_mode))
+        eq_(manifest.lookup(join('dir', 'file')).st_size, 8)
+        ok_(manifest.lookup('missing') is None)
+        manifest.close()
+
+    def test_iter_children(self):
+        """Children are read in pages, sorted by name"""
+        manifest = man.open_manifest(self.dest_root)
+        eq_([name for name, _ in manifest.iter_children('', page_size=1)],
+            ['dir', 'dir0'])
+        eq_([name for name, _ in manifest.iter_children('dir', page_size=2)],
+            ['file', 'subdir'])
+        eq_(list(manifest.iter_children('missing')), [])
+        manifest.close()
+
+    def test_record_and_discard(self):
+        """Discarding a directory forgets its contents but not neighbours"""
+        manifest = man.open_manifest(self.dest_root)
+        manifest.discard('dir')
+        ok_(manifest.lookup('dir') is None)
+        ok_(manifest.lookup(join('dir', 'subdir', 'file')) is None)
+        ok_(manifest.lookup('dir0') is not None)
+        manifest.record('new', os.stat(join(self.dest_root, 'dir0')))
+        ok_(S_ISREG(manifest.lookup('new').st_mode))
+        manifest.close()
+
+    def test_interrupted_run_rebuilds(self):
+        """Only a manifest closed after a complete run is trusted"""
+        manifest = man.open_manifest(self.dest_root)
+        manifest.discard('dir')
+        manifest.close()
+        manifest = man.open_manifest(self.dest_root)
+        ok_(manifest.lookup('dir') is None)
+        manifest.close(clean=False)
+        manifest = man.open_manifest(self.dest_root)
+        ok_(manifest.lookup('dir') is not None)
+        manifest.close()
@@ -0,0 +1,90 @@
+import fnmatch
+import os
+import tempfile
+from os.path import join, basename
+from mock import patch
+from nose.tools import ok_, eq_
+from .. import backup_loop as bloop
+from ..matching import Matcher
+from ..preparations import DEFAULT_INCLUDES, DEFAULT_EXCLUDES
+
+
+def _check_include_fnmatch(path, include_list, ignore_list):
+    """The per-pattern loop that the matcher replaces"""
+    base = basename(path)
+    for include_pattern in include_list:
+        if fnmatch.fnmatch(base, include_pattern):
+            return True
+    for exclude_pattern in ignore_list:
+        if fnmatch.fnmatch(base, exclude_pattern):
+            return False
+    return True
+
+
+def test_same_as_fnmatch_for_names():
+
+    def check(path):
+        eq_(matcher.check(path),
+            _check_include_fnmatch(path, DEFAULT_INCLUDES, ignore_list))
+
+    ignore_list = DEFAULT_EXCLUDES + ['*.[oa]', 'x?z']
+    matcher = Matcher(DEFAULT_INCLUDES, ignore_list)
+    for path in ['file', '.hidden', '.bashrc', join('dir', '.zshrc'),
+                 join('dir', 'mod.pyc'), '__pycache__', '.bups.config',
+                 'lib.a', 'lib.so', 'xyz', 'xyyz', 'tricky file@åäö.']:
+        yield check, path
+
+
+def test_anchored_patterns():
+
+    def check(path, expected):
+        eq_(matcher.check(path), expected)
+
+    matcher = Matcher(['build/keep.txt'],
+                      ['build/**', '/cache/*.tmp', 'src/*/gen'])
+    yield check, 'build', True
+    yield check, join('build', 'out.o'), False
+    yield check, join('build', 'keep.txt'), True
+    yield check, join('build', 'a', 'keep.txt'), False
+    yield check, join('src', 'build', 'out.o'), True
+    yield check, join('cache', 'a.tmp'), False
+    yield check, join('cache', 'sub', 'a.tmp'), True
+    yield check, join('src', 'a', 'gen'), False
+    yield check, join('src', 'a', 'b', 'gen'), True
+
+
+def test_pruning():
+    matcher = Matcher(['.bashrc'], ['build/**', '*/node_modules/**', '.*'])
+    ok_(matcher.prunes('build'))
+    ok_(matcher.prunes(join('web', 'node_modules')))
+    ok_(not matcher.prunes(join('web', 'build')))
+    ok_(not matcher.prunes('web'))
+    # An anchored include may need something inside
+    matcher = Matcher(['build/keep.txt'], ['build/**'])
+    ok_(not matcher.prunes('build'))
+
+
+def test_pruned_directory_is_not_listed():
+    config = dict(include_list=[], ignore_list=['target/build/**'])
+    listed = []
+    real_scandir = bloop.scandir
+
+    def scandir(path):
+        listed.append(path)
+        return real_scandir(path)
+
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        os.makedirs(join(source_root, 'target', 'build', 'sub'))
+        open(join(source_root, 'target', 'build', 'file'), 'w').close()
+        old_file = join(dest_root, 'target', 'build', 'old')
+        os.makedirs(os.path.dirname(old_file))
+        open(old_file, 'w').close()
+        with patch.object(bloop, 'scandir', scandir):
+            bloop.make_backup(bloop.BackupNode(source_root, dest_root, '',
+                                               config))
+        ok_(join(source_root, 'target', 'build') not in listed)
+        eq_(os.listdir(join(dest_root, 'target', 'build')), ['old'])
+    # Compiled once, and not kept in the options
+    ok_(bloop.get_matcher(config) is bloop.get_matcher(config))
+    eq_(sorted(config), ['ignore_list', 'include_list'])
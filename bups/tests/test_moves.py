@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from os.path import join, exists
+from mock import patch
+from nose.tools import ok_, eq_
+from .. import backup_loop as bloop
+from .. import moves
+from ..context import RunContext
+
+
+def _write(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(contents)
+
+
+class MoveDetectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.TemporaryDirectory()
+        self.dest = tempfile.TemporaryDirectory()
+        self.source_root = self.source.name
+        self.dest_root = self.dest.name
+        self.large = b'x' * moves.MIN_SIZE
+        _write(join(self.source_root, 'old', 'large'), self.large)
+        _write(join(self.source_root, 'old', 'small'), b'small')
+        _write(join(self.source_root, 'file'), b'y' * moves.MIN_SIZE)
+        self._backup(detect_moves=False)
+
+    def tearDown(self):
+        self.source.cleanup()
+        self.dest.cleanup()
+
+    def _backup(self, detect_moves=True):
+        run = RunContext()
+        if detect_moves:
+            run.moves = moves.MoveIndex()
+        with patch.object(bloop, 'check_include', return_value=True):
+            bloop.make_backup(bloop.BackupNode(self.source_root,
+                                               self.dest_root, '', {},
+                                               run=run))
+        if detect_moves:
+            run.moves.finish()
+        return run.stats.counts
+
+    def _inode(self, *item):
+        return os.stat(join(self.dest_root, *item)).st_ino
+
+    def test_renamed_directory(self):
+        inode = self._inode('old', 'large')
+        os.rename(join(self.source_root, 'old'),
+                  join(self.source_root, 'new'))
+        counts = self._backup()
+        eq_(counts['moved'], 1)
+        eq_(counts['files_copied'], 0)
+        ok_(not exists(join(self.dest_root, 'old')))
+        eq_(self._inode('new', 'large'), inode)
+        eq_(sorted(os.listdir(join(self.dest_root, 'new'))),
+            ['large', 'small'])
+
+    def test_renamed_file(self):
+        inode = self._inode('file')
+        os.rename(join(self.source_root, 'file'),
+                  join(self.source_root, 'renamed'))
+        counts = self._backup()
+        eq_(counts['moved'], 1)
+        eq_(counts['files_copied'], 0)
+        ok_(not exists(join(self.dest_root, 'file')))
+        eq_(self._inode('renamed'), inode)
+
+    def test_same_size_other_contents(self):
+        os.remove(join(self.source_root, 'file'))
+        _write(join(self.source_root, 'other'), b'z' * moves.MIN_SIZE)
+        counts = self._backup()
+        eq_(counts['moved'], 0)
+        eq_(counts['files_copied'], 1)
+        ok_(not exists(join(self.dest_root, 'file')))
+        with open(join(self.dest_root, 'other'), 'rb') as f:
+            eq_(f.read(), b'z' * moves.MIN_SIZE)
+
+    def test_removals_are_deferred(self):
+        os.remove(join(self.source_root, 'file'))
+        index = moves.MoveIndex()
+        node = bloop.BackupNode(self.source_root, self.dest_root, 'file',
+                                {}, run=RunContext(moves=index))
+        bloop.remove_later(node)
+        ok_(exists(join(self.dest_root, 'file')))
+        index.finish()
+        ok_(not exists(join(self.dest_root, 'file')))
+
+    def test_similar_names(self):
+        ok_(moves._similar(frozenset('abc'), frozenset('abcd')))
+        ok_(not moves._similar(frozenset('ab'), frozenset('cde')))
+        ok_(not moves._similar(frozenset(), frozenset()))
@@ -0,0 +1,69 @@
+import io
+import json
+import os
+import tempfile
+from os.path import join
+from mock import patch
+from nose.tools import ok_, eq_, assert_raises
+from nose_parameterized import parameterized, param
+from .. import backup_loop as bloop
+from .. import plan
+from ..context import RunContext
+from .test_backup_loop import populate_dirs
+
+
+def _snapshot(root):
+    return sorted((os.path.relpath(path, root), sorted(dirs), sorted(files))
+                  for path, dirs, files in os.walk(root))
+
+
+@parameterized([
+    param('walk'),
+    param('path'),
+    param('inode'),
+])
+def test_plan_and_apply(order):
+    """Planning leaves the destination alone, applying mirrors source"""
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root, \
+            patch.object(bloop, 'check_include', return_value=True):
+        populate_dirs(source_root, dest_root)
+        with open(join(source_root, 'target', 'dir1', 'data'), 'w') as f:
+            f.write('12345')
+        before = _snapshot(dest_root)
+
+        stream = io.StringIO()
+        writer = plan.PlanWriter(source_root, dest_root, stream)
+        bloop.make_backup(bloop.BackupNode(source_root, dest_root, '', {},
+                                           run=RunContext(plan=writer)))
+        writer.close()
+        eq_(_snapshot(dest_root), before)
+
+        records = [json.loads(line) for line in
+                   stream.getvalue().splitlines()]
+        totals = records[-1]['totals']
+        operations = records[1:-1]
+        eq_(totals['copy'], sum(1 for o in operations if o['op'] == 'copy'))
+        eq_(totals['copy_bytes'], 5)
+        ok_(dict(op='mkdir', item=join('target', 'dir2')) in operations)
+        ok_(dict(op='remove', item=join('target', 'file4'), size=0,
+                 later=True) in operations)
+
+        stream.seek(0)
+        root = bloop.BackupNode(source_root, dest_root, '', {})
+        plan.apply_plan(stream, root, order)
+        eq_(_snapshot(dest_root), _snapshot(source_root))
+
+
+def test_plan_for_other_roots():
+    stream = io.StringIO()
+    plan.PlanWriter('/source', '/dest', stream).close()
+    stream.seek(0)
+    root = bloop.BackupNode('/source', '/other', '', {})
+    with assert_raises(plan.InvalidPlanException):
+        plan.apply_plan(stream, root)
+
+
+def test_not_a_plan():
+    with assert_raises(plan.InvalidPlanException):
+        plan.read_plan(io.StringIO('foo\n'))
@@ -0,0 +1,63 @@
+import threading
+from nose.tools import eq_, assert_raises
+from nose_parameterized import parameterized, param
+from .. import scanning
+
+
+@parameterized([
+    param(0),
+    param(1),
+    param(4),
+])
+def test_every_scheduled_node_is_visited(workers):
+    """A synthetic tree of depth 6 and fan-out 3 is walked completely"""
+    visited = []
+    lock = threading.Lock()
+    scanner = scanning.make_scanner(workers)
+
+    def visit(node):
+        eq_(scanning.current_scanner(), scanner)
+        with lock:
+            visited.append(node)
+        if len(node) < 6:
+            for i in range(3):
+                scanning.current_scanner().schedule(node + str(i))
+
+    scanner.run(lambda: scanning.current_scanner().schedule(''), visit)
+    eq_(len(visited), sum(3 ** i for i in range(7)))
+    eq_(len(set(visited)), len(visited))
+    eq_(scanning.current_scanner(), None)
+
+
+def test_interrupted_walk():
+    """An exception in the starting thread stops all the workers"""
+    scanner = scanning.ParallelScanner(3)
+
+    def visit(node):
+        if threading.current_thread() is threading.main_thread():
+            raise KeyboardInterrupt
+        scanning.current_scanner().schedule(node)
+
+    def start():
+        for i in range(10):
+            scanning.current_scanner().schedule(i)
+
+    with assert_raises(KeyboardInterrupt):
+        scanner.run(start, visit)
+    eq_(scanner.cancelled, True)
+
+
+def test_error_in_worker():
+    """An error in any worker stops the walk and is raised from run"""
+    scanner = scanning.ParallelScanner(3)
+
+    def visit(node):
+        if node == 5:
+            raise OSError('Failed')
+
+    def start():
+        for i in range(10):
+            scanning.current_scanner().schedule(i)
+
+    with assert_raises(OSError):
+        scanner.run(start, visit)
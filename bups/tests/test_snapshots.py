@@ -0,0 +1,98 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from os.path import join, exists, basename
+from nose.tools import ok_, eq_, assert_raises
+from .. import snapshots
+from .. import preparations as prep
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source_tempdir = tempfile.TemporaryDirectory()
+        self.source_root = join(self.source_tempdir.name, 'source')
+        os.mkdir(self.source_root)
+        self.dest_tempdir = tempfile.TemporaryDirectory()
+        self.dest_root = join(self.dest_tempdir.name, 'source')
+        os.mkdir(join(self.source_root, 'dir'))
+        for name in ['a', join('dir', 'b')]:
+            with open(join(self.source_root, name), 'w') as f:
+                f.write(name)
+        past = time.time() - 10
+        for name in ['a', join('dir', 'b')]:
+            os.utime(join(self.source_root, name), (past, past))
+        prep.create_default_config(self.source_root)
+
+    def tearDown(self):
+        self.source_tempdir.cleanup()
+        self.dest_tempdir.cleanup()
+
+    def backup(self, **options):
+        prep.start_backup(self.source_root, self.dest_tempdir.name,
+                          snapshots=True, **options)
+        root = join(self.dest_root, snapshots.SNAPSHOTS_DIRNAME)
+        return [join(root, name) for name in snapshots.list_snapshots(root)]
+
+    def test_unchanged_files_are_linked(self):
+        first, = self.backup()
+        with open(join(self.source_root, 'a'), 'w') as f:
+            f.write('changed')
+        os.remove(join(self.source_root, 'dir', 'b'))
+        old, new = self.backup()
+        eq_(old, first)
+        with open(join(old, 'a')) as f:
+            eq_(f.read(), 'a')
+        with open(join(new, 'a')) as f:
+            eq_(f.read(), 'changed')
+        ok_(exists(join(old, 'dir', 'b')))
+        ok_(not exists(join(new, 'dir', 'b')))
+        eq_(os.stat(join(old, prep.CONFIG_FILENAME)).st_ino,
+            os.stat(join(new, prep.CONFIG_FILENAME)).st_ino)
+        latest = join(self.dest_root, snapshots.SNAPSHOTS_DIRNAME,
+                      snapshots.LATEST)
+        eq_(os.readlink(latest), basename(new))
+
+    def test_retention(self):
+        self.backup()
+        eq_(len(self.backup(keep_last=1)), 1)
+
+    def test_partial_snapshot_is_removed(self):
+        self.backup()
+        partial, previous = snapshots.start_snapshot(self.dest_root)
+        ok_(partial.endswith(snapshots.PARTIAL_SUFFIX))
+        ok_(previous is not None)
+        self.backup()
+        ok_(not exists(partial))
+
+    def test_no_manifest(self):
+        with assert_raises(prep.InvalidConfigException):
+            self.backup(use_manifest=True)
+
+
+def _name(*args):
+    return datetime(*args).strftime(snapshots.NAME_FORMAT)
+
+
+def test_select_retained():
+    names = [_name(2026, 10, day, hour) for day in range(1, 18)
+             for hour in [1, 13]]
+    eq_(snapshots.select_retained(names), set(names))
+    eq_(snapshots.select_retained(names, keep_last=3), set(names[-3:]))
+    # The latest snapshot of each of the three latest days
+    eq_(snapshots.select_retained(names, keep_daily=3), set(names[-5::2]))
+    # 2026-10-17 is on a Saturday, weeks start on Mondays
+    eq_(snapshots.select_retained(names, keep_weekly=2),
+        {_name(2026, 10, 17, 13), _name(2026, 10, 11, 13)})
+    eq_(snapshots.select_retained(names, keep_last=1, keep_weekly=1),
+        {_name(2026, 10, 17, 13)})
+
+
+def test_snapshot_time():
+    eq_(snapshots.snapshot_time(_name(2026, 1, 2, 3, 4, 5)),
+        datetime(2026, 1, 2, 3, 4, 5))
+    eq_(snapshots.snapshot_time(_name(2026, 1, 2) + '-1'),
+        datetime(2026, 1, 2))
+    eq_(snapshots.snapshot_time(snapshots.LATEST), None)
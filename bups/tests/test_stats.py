@@ -0,0 +1,58 @@
+import json
+import tempfile
+import time
+from os.path import join
+from nose.tools import ok_, eq_
+from .. import stats as bstats
+
+
+def test_counts_and_report():
+    stats = bstats.Stats(slowest=2)
+    stats.scanned(0.0001, 3)
+    stats.scanned(0.5, 2)
+    stats.syscall('stat', 5)
+    for item, seconds in [('a', 0.1), ('b', 0.3), ('c', 0.2)]:
+        stats.copied(item, 10, 'chunked', seconds)
+    stats.error('d')
+    with stats.timer('remove'):
+        pass
+    report = stats.report()
+    eq_(report['counts']['entries_scanned'], 5)
+    eq_(report['counts']['files_copied'], 3)
+    eq_(report['counts']['bytes_copied'], 30)
+    eq_(report['syscalls_per_entry'], 1)
+    eq_(report['scan_latency']['<0.001s'], 1)
+    eq_(report['scan_latency']['<1s'], 1)
+    eq_([f['item'] for f in report['slowest_files']], ['b', 'c'])
+    eq_(report['error_items'], ['d'])
+    ok_(abs(report['phase_times']['copy'] - 0.6) < 1e-9)
+    ok_(report['phase_times']['remove'] >= 0)
+    eq_(report['copy_backends'], {'chunked': 3})
+
+
+def test_write_report():
+    stats = bstats.Stats()
+    stats.count('removed')
+    with tempfile.TemporaryDirectory() as directory:
+        path = join(directory, 'stats.json')
+        stats.write_report(path)
+        with open(path) as f:
+            eq_(json.load(f)['counts'], {'removed': 1})
+
+
+def test_progress_reporter():
+    stats = bstats.Stats()
+    lines = []
+    stats.progress_line = lambda: lines.append(1) or 'progress'
+    reporter = bstats.ProgressReporter(stats, 0.01)
+    time.sleep(0.1)
+    reporter.stop()
+    ok_(lines)
+
+
+def test_peak_rss():
+    report = bstats.Stats().report()
+    if bstats.resource is None:
+        eq_(report['peak_rss_bytes'], None)
+    else:
+        ok_(report['peak_rss_bytes'] > 1024 * 1024)
@@ -0,0 +1,31 @@
+import random
+import tempfile
+from nose.tools import ok_, eq_
+from .. import streaming
+
+
+def test_small_listing_stays_in_memory():
+    names = [b'b', b'a']
+    eq_(streaming.collect(names, threshold=2), names)
+
+
+def test_spilled_names_are_sorted():
+    names = [('f{}\n'.format(i)).encode() for i in range(100)]
+    random.Random(0).shuffle(names)
+    with tempfile.TemporaryDirectory() as spill_dir:
+        spilled = streaming.collect(iter(names), threshold=7,
+                                    spill_dir=spill_dir)
+        ok_(isinstance(spilled, streaming.SpilledNames))
+        eq_(len(spilled), 100)
+        eq_(len(spilled.files), 15)
+        eq_(list(spilled), sorted(names))
+        spilled.close()
+
+
+def test_merge():
+    source = [b'a', b'c', b'd', b'f']
+    dest = [b'b', b'c', b'f', b'g']
+    eq_(list(streaming.merge(source, dest)),
+        [('a', True, False), ('b', False, True), ('c', True, True),
+         ('d', True, False), ('f', True, True), ('g', False, True)])
+    eq_(list(streaming.merge([], [b'x'])), [('x', False, True)])
@@ -0,0 +1,152 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from os.path import join, exists
+from mock import patch
+from nose.tools import ok_, eq_
+from .. import backup_loop as bloop
+from .. import summary as bsummary
+from ..context import RunContext
+from ..journal import Journal
+from ..stats import Stats
+from .test_backup_loop import _make_tree, _walk_tree
+
+
+CONFIG = {'include_list': [], 'ignore_list': []}
+
+
+def _age(path, seconds=3600):
+    """Set the times of ``path`` back, as if it had not changed lately"""
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+class SummaryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.TemporaryDirectory()
+        self.dest = tempfile.TemporaryDirectory()
+        for item in ['a', join('a', 'b'), 'c']:
+            os.mkdir(join(self.source.name, item))
+            with open(join(self.source.name, item, 'file'), 'w') as f:
+                f.write(item)
+        for item in [join('a', 'b'), 'a', 'c', '']:
+            _age(join(self.source.name, item))
+
+    def tearDown(self):
+        self.source.cleanup()
+        self.dest.cleanup()
+
+    def _backup(self, full_walk_hours=24, completed=True):
+        summary = bsummary.TreeSummary(self.dest.name, CONFIG,
+                                       full_walk_hours)
+        run = RunContext(summary=summary)
+        with patch.object(bloop, 'check_include', return_value=True):
+            bloop.make_backup(bloop.BackupNode(self.source.name,
+                                               self.dest.name, '', CONFIG,
+                                               run=run))
+        summary.close(run.stats, completed)
+        return run.stats.counts
+
+    def test_unchanged_directories_are_not_listed(self):
+        counts = self._backup()
+        eq_(counts['directories_scanned'], 4)
+        eq_(counts['directories_skipped'], 0)
+        counts = self._backup()
+        eq_(counts['directories_scanned'], 0)
+        eq_(counts['directories_skipped'], 4)
+
+    def test_new_entry_is_noticed(self):
+        self._backup()
+        with open(join(self.source.name, 'a', 'b', 'new'), 'w') as f:
+            f.write('new')
+        counts = self._backup()
+        eq_(counts['directories_scanned'], 1)
+        eq_(counts['directories_skipped'], 3)
+        eq_(counts['files_copied'], 1)
+        ok_(exists(join(self.dest.name, 'a', 'b', 'new')))
+
+    def test_restored_times_are_noticed(self):
+        self._backup()
+        with open(join(self.source.name, 'c', 'new'), 'w') as f:
+            f.write('new')
+        _age(join(self.source.name, 'c'))
+        counts = self._backup()
+        eq_(counts['files_copied'], 1)
+
+    def test_edit_in_place_is_missed_until_full_walk(self):
+        self._backup()
+        with open(join(self.source.name, 'c', 'file'), 'w') as f:
+            f.write('changed')
+        counts = self._backup()
+        eq_(counts['files_copied'], 0)
+        with patch.object(time, 'time',
+                          return_value=time.time() + 25 * 3600):
+            counts = self._backup()
+        eq_(counts['files_copied'], 1)
+        eq_(counts['directories_scanned'], 4)
+
+    def test_skipped_directories_in_journal(self):
+        self._backup()
+        run = RunContext(summary=bsummary.TreeSummary(self.dest.name,
+                                                      CONFIG))
+        run.journal = Journal(self.dest.name, run.stats)
+        with patch.object(bloop, 'check_include', return_value=True):
+            bloop.make_backup(bloop.BackupNode(self.source.name,
+                                               self.dest.name, '', CONFIG,
+                                               run=run))
+        run.summary.close(run.stats)
+        with open(run.journal.path) as f:
+            done = [json.loads(line)['done'] for line in f]
+        run.journal.close(complete=True)
+        eq_(sorted(done), sorted(['', 'a', join('a', 'b'), 'c']))
+        # A directory is done after its subdirectories
+        ok_(done.index(join('a', 'b')) < done.index('a') < done.index(''))
+
+    def test_incomplete_run_is_not_trusted(self):
+        self._backup(completed=False)
+        counts = self._backup()
+        eq_(counts['directories_skipped'], 0)
+
+    def test_errors_are_listed_again(self):
+        summary = bsummary.TreeSummary(self.dest.name, CONFIG)
+        stat_result = os.stat(join(self.source.name, 'a'))
+        entries = list(os.scandir(join(self.source.name, 'a')))
+        summary.record('a', stat_result, entries)
+        eq_(summary.unchanged('a', stat_result), None)
+        summary.full_walk = False
+        eq_(summary.unchanged('a', stat_result), ['b'])
+        stats = Stats()
+        stats.error(join('a', 'file'))
+        summary.close(stats)
+        summary = bsummary.TreeSummary(self.dest.name, CONFIG)
+        summary.full_walk = False
+        eq_(summary.unchanged('a', stat_result), None)
+        summary.close(Stats())
+
+
+def test_deep_tree_with_summary():
+    """Skipping a deep tree is not limited by the recursion depth"""
+    limit = sys.getrecursionlimit()
+    with tempfile.TemporaryDirectory() as source_root, \
+            tempfile.TemporaryDirectory() as dest_root:
+        _make_tree(source_root, 300, 1)
+        for path, _, _ in os.walk(source_root):
+            _age(path)
+        for _ in range(2):
+            run = RunContext(summary=bsummary.TreeSummary(dest_root, CONFIG))
+            sys.setrecursionlimit(200)
+            try:
+                with patch.object(bloop, 'check_include', return_value=True):
+                    bloop.make_backup(bloop.BackupNode(source_root,
+                                                       dest_root, '', CONFIG,
+                                                       run=run))
+            finally:
+                sys.setrecursionlimit(limit)
+            run.summary.close(run.stats)
+        eq_(run.stats.counts['directories_skipped'], 301)
+        # The root of the destination also holds the summary
+        eq_(_walk_tree(source_root)[1:], _walk_tree(dest_root)[1:])
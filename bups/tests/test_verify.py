@@ -0,0 +1,136 @@
+import os
+import tempfile
+import time
+import unittest
+from os.path import join
+from mock import Mock
+from nose.tools import ok_, eq_
+from .. import verify
+from ..backup_loop import BackupNode, make_backup, include_entry
+from ..context import RunContext
+from ..dedup import hash_file
+
+
+def _write(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def _corrupt(path):
+    """Change the contents of a file but not its size or times"""
+    before = os.stat(path)
+    with open(path, 'r+b') as f:
+        data = f.read()
+        f.seek(0)
+        f.write(bytes([data[0] ^ 0xff]) + data[1:])
+    os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+
+
+class HashCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = join(self.tempdir.name, 'file')
+        _write(self.path, 'contents')
+        self.cache = verify.HashCache(self.tempdir.name, max_age_days=1)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tempdir.cleanup()
+
+    def test_lookup(self):
+        stat_result = os.stat(self.path)
+        eq_(self.cache.lookup(verify.DEST, stat_result), None)
+        self.cache.record(verify.DEST, stat_result, 'hash')
+        eq_(self.cache.lookup(verify.DEST, stat_result), 'hash')
+        eq_(self.cache.lookup(verify.SOURCE, stat_result), None)
+
+    def test_other_device(self):
+        stat_result = os.stat(self.path)
+        self.cache.record(verify.DEST, stat_result, 'hash')
+        other = Mock(st_dev=stat_result.st_dev + 1,
+                     st_ino=stat_result.st_ino, st_size=stat_result.st_size,
+                     st_mtime_ns=stat_result.st_mtime_ns)
+        eq_(self.cache.lookup(verify.DEST, other), None)
+
+    def test_changed_file(self):
+        self.cache.record(verify.DEST, os.stat(self.path), 'hash')
+        _write(self.path, 'other contents')
+        eq_(self.cache.lookup(verify.DEST, os.stat(self.path)), None)
+
+    def test_expired(self):
+        stat_result = os.stat(self.path)
+        self.cache.record(verify.DEST, stat_result, 'hash')
+        eq_(self.cache.lookup(verify.DEST, stat_result,
+                              now=time.time() + 2 * 24 * 3600), None)
+
+
+class VerifyBackupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.TemporaryDirectory()
+        self.dest = tempfile.TemporaryDirectory()
+        self.source_root = self.source.name
+        self.dest_root = self.dest.name
+        for item in ['a', 'dir/b', 'dir/sub/c']:
+            _write(join(self.source_root, item), item * 100)
+        self.config = {'include_list': [], 'ignore_list': [],
+                       'verify_workers': 2}
+        make_backup(BackupNode(self.source_root, self.dest_root, '',
+                               self.config))
+        self.run = RunContext()
+
+    def tearDown(self):
+        self.source.cleanup()
+        self.dest.cleanup()
+
+    def _verify(self):
+        include = lambda directory, name: include_entry(directory, name,
+                                                        self.config)
+        return verify.verify_backup(self.source_root, self.dest_root,
+                                    self.dest_root, self.config, self.run,
+                                    include)
+
+    def test_matching_backup(self):
+        eq_(self._verify(), 0)
+        eq_(self.run.stats.counts['files_verified'], 3)
+        ok_(os.path.exists(join(self.dest_root, verify.HASH_CACHE_FILENAME)))
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        self._verify()
+        eq_(self.run.stats.counts['files_hashed'], 6)
+        self._verify()
+        eq_(self.run.stats.counts['files_hashed'], 6)
+        eq_(self.run.stats.counts['files_verified'], 6)
+
+    def test_corrupt_file(self):
+        _corrupt(join(self.dest_root, 'dir', 'b'))
+        eq_(self._verify(), 1)
+        eq_(self.run.stats.mismatched_items, [join('dir', 'b')])
+        # Not repaired without asking
+        eq_(self._verify(), 1)
+
+    def test_repair(self):
+        _corrupt(join(self.dest_root, 'dir', 'sub', 'c'))
+        os.remove(join(self.dest_root, 'a'))
+        self.config['verify_repair'] = True
+        eq_(self._verify(), 2)
+        eq_(self.run.stats.counts['repaired'], 2)
+        for item in ['a', join('dir', 'sub', 'c')]:
+            eq_(hash_file(join(self.dest_root, item)),
+                hash_file(join(self.source_root, item)))
+        self.run = RunContext()
+        eq_(self._verify(), 0)
+
+    def test_missing_file_with_unreadable_source(self):
+        verifier = verify.Verifier(self.source_root, self.dest_root, None,
+                                   self.config, self.run)
+        source_stat = os.stat(join(self.source_root, 'a'))
+        verifier._compare('a', source_stat, None, None, None)
+        counts = self.run.stats.counts
+        eq_(counts['unverified'], 1)
+        eq_(counts['files_verified'], 0)
+        verifier._compare('a', source_stat, None, 'hash', None)
+        eq_(counts['files_verified'], 0)
+        eq_(self.run.stats.mismatched_items, ['a'])
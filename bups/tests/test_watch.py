@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from os.path import join
+from nose.plugins.skip import SkipTest
+from nose.tools import ok_, eq_
+from .. import watch
+from ..changes import CHANGES_FILENAME
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if not watch.supported():
+            raise SkipTest('inotify is not supported')
+        self.source = tempfile.TemporaryDirectory()
+        self.dest = tempfile.TemporaryDirectory()
+        os.makedirs(join(self.source.name, 'a', 'b'))
+        os.mkdir(join(self.source.name, 'ignored'))
+        self.log = join(self.dest.name, CHANGES_FILENAME)
+        self.watcher = watch.Watcher(
+            self.source.name, self.dest.name,
+            lambda directory, name: name != 'ignored')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.watcher.run, args=(self.stopped.is_set,))
+        self.thread.start()
+        self._wait(lambda: os.path.exists(self.log))
+
+    def tearDown(self):
+        self.stopped.set()
+        self.thread.join()
+        self.source.cleanup()
+        self.dest.cleanup()
+
+    def _records(self):
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+    def _wait(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            ok_(time.monotonic() < deadline, 'Timed out')
+            time.sleep(0.05)
+
+    def test_changes_are_recorded(self):
+        eq_(len(self.watcher.items), 3)
+        ok_('session' in self._records()[0])
+        with open(join(self.source.name, 'a', 'b', 'file'), 'w') as f:
+            f.write('x')
+        os.makedirs(join(self.source.name, 'c', 'd'))
+        with open(join(self.source.name, 'ignored', 'file'), 'w') as f:
+            f.write('x')
+        self._wait(lambda: len(self._records()) > 1)
+        self.stopped.set()
+        self.thread.join()
+        records = self._records()[1:]
+        ok_({'dir': join('a', 'b')} in records)
+        ok_({'dir': ''} in records)
+        ok_({'tree': 'c'} in records)
+        ok_(not any('ignored' in record.get('dir', '')
+                    for record in records))
+
+    def test_log_is_made_anew(self):
+        os.replace(self.log, self.log + '.taken')
+        with open(join(self.source.name, 'a', 'file'), 'w') as f:
+            f.write('x')
+        self._wait(lambda: os.path.exists(self.log))
+        self._wait(lambda: {'dir': 'a'} in self._records())
+        ok_('session' in self._records()[0])
+
+    def test_moved_directory_is_unwatched(self):
+        os.rename(join(self.source.name, 'a'), join(self.source.name, 'x'))
+        self._wait(lambda: {'tree': 'x'} in self._records())
+        self.stopped.set()
+        self.thread.join()
+        eq_(sorted(self.watcher.wds), ['', 'x', join('x', 'b')])
+        eq_(sorted(self.watcher.items.values()),
+            ['', 'x', join('x', 'b')])
@@ -0,0 +1,305 @@
+"""Verifying a back-up by the contents of its files
+
+Change detection compares metadata only, so it misses copies that got
+corrupted on disk and files restored with old modification times.
+With the ``verify`` option the regular files in source and
+destination are hashed after the walk and compared.  The files are
+hashed in a pool of ``verify_workers`` processes, by default one per
+core, each file read sequentially in large chunks.  The files whose
+back-up differs are logged and listed in the statistics, and with
+``verify_repair`` they are copied again.
+
+The hashes are cached in an SQLite database in the destination root,
+keyed by the device and inode of a file, and they are valid as long
+as its size and modification time stay the same.  Files that have not
+changed are then not read again on later runs.  Silent corruption leaves the
+metadata as it was, so a cached hash is trusted for ``hash_cache_days``
+days only, after which the file is read again.
+
+"""
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, dirname
+from stat import S_ISDIR, S_ISREG
+from .copying import copy_file
+from .dedup import hash_file
+
+
+logger = logging.getLogger(__name__)
+file_logger = logging.getLogger('bups.files')
+
+HASH_CACHE_FILENAME = '.bups.hashes'
+# The database and the rollback journal of SQLite
+HASH_CACHE_FILES = frozenset([HASH_CACHE_FILENAME,
+                              HASH_CACHE_FILENAME + '-journal'])
+
+# Cached hashes older than this are computed again
+MAX_AGE_DAYS = 30
+
+READ_SIZE = 8 * 1024 * 1024
+
+# Files handed to the pool of processes at a time
+BATCH_SIZE = 256
+
+# Hashes are committed in batches of this size
+COMMIT_INTERVAL = 1000
+
+SOURCE = 'source'
+DEST = 'dest'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    side TEXT NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    hashed REAL NOT NULL,
+    PRIMARY KEY (side, device, inode)
+);
+"""
+
+
+class HashCache(object):
+    """Hashes of the files of one side by their inodes"""
+    def __init__(self, root, max_age_days=MAX_AGE_DAYS):
+        self.max_age = max_age_days * 24 * 3600
+        self._pending = 0
+        self.db = sqlite3.connect(join(root, HASH_CACHE_FILENAME))
+        columns = [row[1] for row
+                   in self.db.execute('PRAGMA table_info(hashes)')]
+        if columns and 'device' not in columns:
+            # Keyed by the inode only, which may name another file now
+            self.db.execute('DROP TABLE hashes')
+        self.db.executescript(_SCHEMA)
+        self.db.commit()
+
+    def lookup(self, side, stat_result, now=None):
+        """The hash of a file, ``None`` if it changed or is too old"""
+        row = self.db.execute('SELECT size, mtime_ns, hash, hashed FROM '
+                              'hashes WHERE side = ? AND device = ? AND '
+                              'inode = ?', (side, stat_result.st_dev,
+                                            stat_result.st_ino)).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, hash, hashed = row
+        now = time.time() if now is None else now
+        if ((size, mtime_ns) != (stat_result.st_size,
+                                 stat_result.st_mtime_ns) or
+                now - hashed > self.max_age):
+            return None
+        return hash
+
+    def record(self, side, stat_result, hash, now=None):
+        self.db.execute('INSERT OR REPLACE INTO hashes VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?)',
+                        (side, stat_result.st_dev, stat_result.st_ino,
+                         stat_result.st_size,
+                         stat_result.st_mtime_ns, hash,
+                         time.time() if now is None else now))
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.db.commit()
+            self._pending = 0
+
+    def close(self):
+        # Expired hashes would be computed again anyway
+        self.db.execute('DELETE FROM hashes WHERE hashed < ?',
+                        (time.time() - self.max_age,))
+        self.db.commit()
+        self.db.close()
+
+
+def _hash(path):
+    """Hash a file in a worker process, ``None`` if it cannot be read"""
+    try:
+        return hash_file(path, READ_SIZE)
+    except OSError:
+        return None
+
+
+def _regular_files(source_root, dest_root, include):
+    """The files to verify as ``(item, source_stat, dest_stat)``
+
+    The source is walked like in a back-up, entries for which
+    ``include(directory, name)`` is false skipped.  ``dest_stat`` is
+    ``None`` if the file is missing from the destination.
+
+    """
+    directories = ['']
+    while directories:
+        directory = directories.pop()
+        try:
+            with os.scandir(join(source_root, directory)) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            logger.warning('Cannot list %s', directory)
+            continue
+        for entry in entries:
+            if not include(directory, entry.name):
+                continue
+            item = join(directory, entry.name)
+            try:
+                source_stat = entry.stat()
+            except OSError:
+                continue
+            if S_ISDIR(source_stat.st_mode):
+                directories.append(item)
+            elif S_ISREG(source_stat.st_mode):
+                try:
+                    dest_stat = os.stat(join(dest_root, item))
+                except OSError:
+                    dest_stat = None
+                yield item, source_stat, dest_stat
+
+
+def _batches(iterable, size):
+    batch = []
+    for value in iterable:
+        batch.append(value)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _unchanged(path, stat_result):
+    try:
+        after = os.stat(path)
+    except OSError:
+        return False
+    return ((after.st_ino, after.st_size, after.st_mtime_ns) ==
+            (stat_result.st_ino, stat_result.st_size,
+             stat_result.st_mtime_ns))
+
+
+class Verifier(object):
+    """Compare the hashes of the files of a back-up with the source
+
+    ``backup_root`` is where the files are, which is a snapshot or the
+    destination root, see :mod:`bups.snapshots`.  The options are read
+    from ``config`` and the store, the manifest and the statistics from
+    the :class:`bups.context.RunContext` ``run``.
+
+    """
+    def __init__(self, source_root, backup_root, cache, config, run):
+        self.source_root = source_root
+        self.backup_root = backup_root
+        self.cache = cache
+        self.config = config
+        self.stats = run.stats
+        self.store = run.content_store
+        self.manifest = run.manifest
+        self.workers = config.get('verify_workers') or os.cpu_count() or 1
+
+    def run(self, include):
+        """Verify the files for which ``include(directory, name)`` is true"""
+        files = _regular_files(self.source_root, self.backup_root, include)
+        with ProcessPoolExecutor(self.workers) as pool:
+            for batch in _batches(files, BATCH_SIZE):
+                self._verify(batch, pool)
+
+    def _verify(self, batch, pool):
+        hashes = {}
+        todo = []
+        for item, source_stat, dest_stat in batch:
+            for side, root, stat_result in [
+                    (SOURCE, self.source_root, source_stat),
+                    (DEST, self.backup_root, dest_stat)]:
+                if stat_result is None:
+                    continue
+                cached = self.cache.lookup(side, stat_result)
+                if cached is None:
+                    todo.append((side, item, join(root, item), stat_result))
+                else:
+                    hashes[side, item] = cached
+        self.stats.count('files_hashed', len(todo))
+        results = pool.map(_hash, [path for _, _, path, _ in todo],
+                           chunksize=max(1, len(todo) // (4 * self.workers)))
+        for (side, item, path, stat_result), digest in zip(todo, results):
+            # A file that changed while it was read has no valid hash
+            if digest is not None and _unchanged(path, stat_result):
+                self.cache.record(side, stat_result, digest)
+                hashes[side, item] = digest
+        for item, source_stat, dest_stat in batch:
+            self._compare(item, source_stat, dest_stat,
+                          hashes.get((SOURCE, item)),
+                          hashes.get((DEST, item)))
+
+    def _compare(self, item, source_stat, dest_stat, source_hash,
+                 dest_hash):
+        if source_hash is None or (dest_stat is not None and
+                                   dest_hash is None):
+            logger.warning('Cannot verify %s, it was changed or could not '
+                           'be read', item)
+            self.stats.count('unverified')
+            return
+        if dest_stat is None:
+            logger.error('%s is missing from the back-up', item)
+        elif source_hash == dest_hash:
+            self.stats.count('files_verified')
+            return
+        else:
+            logger.error('%s differs from the source', item)
+        self.stats.mismatch(item)
+        if self.config.get('verify_repair'):
+            self._repair(item, source_stat, dest_stat, source_hash)
+
+    def _repair(self, item, source_stat, dest_stat, source_hash):
+        """Copy a file whose back-up is corrupt or missing again"""
+        file_logger.info('Repair %s', item, extra={'op': 'repair',
+                                                   'item': item})
+        source = join(self.source_root, item)
+        dest = join(self.backup_root, item)
+        start = time.perf_counter()
+        try:
+            if self.store is not None and dest_stat is not None:
+                self.store.discard(source_hash, source_stat.st_mode,
+                                   dest_stat.st_ino)
+            if dest_stat is not None:
+                # The inode may be shared with snapshots or the store
+                os.unlink(dest)
+            else:
+                os.makedirs(dirname(dest), exist_ok=True)
+            backend = copy_file(source, dest,
+                                self.config.get('copy_backend', 'auto'))
+            self.stats.copied(item, source_stat.st_size, backend,
+                              time.perf_counter() - start)
+            self.stats.count('repaired')
+            if self.manifest is not None:
+                self.manifest.record(item, os.stat(dest))
+        except Exception:
+            logger.error('Unable to repair %s', item, exc_info=True)
+            self.stats.error(item)
+
+
+def verify_backup(source_root, dest_root, backup_root, config, run,
+                  include):
+    """Verify the back-up of ``source_root`` in ``backup_root``
+
+    The hash cache is kept in ``dest_root``.  ``include(directory,
+    name)`` tells which entries are part of the back-up.  Returns the
+    number of files that differ from the source.
+
+    """
+    stats = run.stats
+    logger.info('Verifying the back-up')
+    cache = HashCache(dest_root, config.get('hash_cache_days', MAX_AGE_DAYS))
+    before = stats.counts['mismatches']
+    try:
+        with stats.timer('verify'):
+            Verifier(source_root, backup_root, cache, config,
+                     run).run(include)
+    finally:
+        cache.close()
+    mismatches = stats.counts['mismatches'] - before
+    if mismatches:
+        logger.error('%d files differ from the source', mismatches)
+    else:
+        logger.info('All files match the source', extra={'color': 'g'})
+    return mismatches
@@ -0,0 +1,275 @@
+"""Watching the source for changes with inotify
+
+``bups watch`` keeps an inotify watch on every included directory of
+the source and records the directories in which something changes
+into the change log of the destination, see :mod:`bups.changes`.
+A back-up with the ``use_changes`` option then walks only those.
+
+A directory that appears in the source, made or moved there, is
+recorded as a whole subtree, because entries may have been made in it
+before it was watched.  The changes are written to the log once a
+second.
+
+Each directory takes a watch, and the number of watches of a user is
+limited by ``/proc/sys/fs/inotify/max_user_watches``.  If a watch
+cannot be added, or the kernel drops events because they came faster
+than they were read, the watcher records that and the next back-up
+walks the whole tree.
+
+inotify is called through :mod:`ctypes`, so this works on Linux only.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import time
+import uuid
+from collections import defaultdict
+from os.path import join, dirname
+from .changes import CHANGES_FILENAME, lock
+
+
+logger = logging.getLogger(__name__)
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR |
+              IN_DONT_FOLLOW)
+
+_EVENT = struct.Struct('iIII')
+
+FLUSH_INTERVAL = 1.0
+
+_READ_SIZE = 64 * 1024
+
+
+class Inotify(object):
+    """An inotify instance of the kernel"""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'No inotify on this platform')
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Events as ``(wd, mask, name)``, waiting up to ``timeout``"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def supported():
+    """Can inotify be used here"""
+    try:
+        Inotify().close()
+    except (OSError, AttributeError, TypeError):
+        return False
+    return True
+
+
+class ChangeWriter(object):
+    """Append records to the change log of ``dest_root``"""
+    def __init__(self, dest_root):
+        self.path = join(dest_root, CHANGES_FILENAME)
+        self.header = {'session': uuid.uuid4().hex, 'pid': os.getpid(),
+                       'host': socket.gethostname()}
+
+    def write(self, records):
+        """Write ``records``, making the log anew if a run took it"""
+        while True:
+            try:
+                f = open(self.path, 'x')
+                new = True
+            except FileExistsError:
+                f = open(self.path, 'a')
+                new = False
+            with f:
+                lock(f)
+                try:
+                    moved = os.stat(self.path).st_ino != os.fstat(
+                        f.fileno()).st_ino
+                except FileNotFoundError:
+                    moved = True
+                if moved:
+                    # A run took the log while this waited for the lock
+                    continue
+                if new:
+                    f.write(json.dumps(self.header) + '\n')
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+                return
+
+
+class Watcher(object):
+    """Record the changes of the source into the change log"""
+    def __init__(self, source_root, dest_root, include):
+        self.source_root = source_root
+        self.include = include
+        self.inotify = Inotify()
+        self.writer = ChangeWriter(dest_root)
+        # Watch descriptors to the items of their directories and back,
+        # and the watched subdirectories of each directory
+        self.items = {}
+        self.wds = {}
+        self.subdirs = defaultdict(set)
+        self.directories = set()
+        self.trees = set()
+        self.overflow = False
+
+    def _watch_tree(self, item):
+        """Watch the directory ``item`` and the directories below it"""
+        stack = [item]
+        while stack:
+            item = stack.pop()
+            path = join(self.source_root, item)
+            try:
+                wd = self.inotify.add_watch(path)
+            except OSError as exc:
+                if exc.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                logger.error('Cannot watch %s: %s', path, exc.strerror)
+                self.overflow = True
+                continue
+            self._add(wd, item)
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if (entry.is_dir(follow_symlinks=False) and
+                                self.include(item, entry.name)):
+                            stack.append(join(item, entry.name))
+            except OSError:
+                continue
+
+    def _add(self, wd, item):
+        self.items[wd] = item
+        self.wds[item] = wd
+        if item:
+            self.subdirs[dirname(item)].add(item)
+
+    def _forget(self, wd):
+        item = self.items.pop(wd, None)
+        if item is None or self.wds.get(item) != wd:
+            return
+        del self.wds[item]
+        siblings = self.subdirs.get(dirname(item))
+        if item and siblings is not None:
+            siblings.discard(item)
+
+    def _unwatch_tree(self, item):
+        """Stop watching the directory ``item`` and those below it"""
+        stack = [item]
+        while stack:
+            item = stack.pop()
+            stack.extend(self.subdirs.pop(item, ()))
+            wd = self.wds.get(item)
+            if wd is not None:
+                self.inotify.rm_watch(wd)
+                self._forget(wd)
+
+    def start(self):
+        """Watch the whole source and make the change log"""
+        self._watch_tree('')
+        logger.info('Watching %d directories', len(self.items))
+        self.flush()
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('Events were lost, the next back-up walks all')
+            self.overflow = True
+            return
+        if mask & IN_IGNORED:
+            self._forget(wd)
+            return
+        directory = self.items.get(wd)
+        if directory is None or not self.include(directory, name):
+            return
+        self.directories.add(directory)
+        if mask & IN_ISDIR:
+            item = join(directory, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(item)
+                self.trees.add(item)
+            elif mask & IN_MOVED_FROM:
+                self._unwatch_tree(item)
+
+    def flush(self):
+        records = ([{'dir': item} for item in sorted(self.directories)] +
+                   [{'tree': item} for item in sorted(self.trees)])
+        if self.overflow:
+            records.append({'overflow': True})
+        # Also makes the log anew if a run took it
+        self.writer.write(records)
+        self.directories.clear()
+        self.trees.clear()
+        self.overflow = False
+
+    def run(self, stop=None):
+        """Watch until ``stop()`` is true or forever"""
+        self.start()
+        flushed = time.monotonic()
+        try:
+            while stop is None or not stop():
+                for wd, mask, name in self.inotify.read(FLUSH_INTERVAL):
+                    self.handle(wd, mask, name)
+                now = time.monotonic()
+                if now - flushed >= FLUSH_INTERVAL:
+                    self.flush()
+                    flushed = now
+            self.flush()
+        finally:
+            self.inotify.close()